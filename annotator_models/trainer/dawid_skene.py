@@ -7,145 +7,315 @@ Series C (Applied Statistics), Vol. 28, No. 1, pp. 20-28.
 """
 
 import argparse
+import collections
+import io
 import logging
 import math
-import sys
+import multiprocessing
 import time
 
 import numpy as np
 import pandas as pd
 from scipy import stats
+from scipy.special import logsumexp
 import tensorflow as tf
 
 
 FLAGS = None
 np.set_printoptions(precision=2)
 
+# Default memory bound of the chunks of ratings of the e_step.
+E_STEP_MAX_CHUNK_BYTES = 64 * 1024 * 1024
+
+# The ratings, as a list of (item, rater, label) indexes, each an int32 array
+# with one entry per rating. Memory scales with the number of ratings rather
+# than with items x raters, as for the dense counts of the *_verbose functions.
+Ratings = collections.namedtuple(
+    'Ratings', ['items', 'raters', 'labels', 'n_items', 'n_raters',
+                'n_classes'])
+
+# What the incremental mode keeps of a trained label between runs: all the
+# Ratings, the item classes and their sufficient_statistics, and the original
+# IDs of the item, rater and class indexes.
+State = collections.namedtuple('State', [
+    'ratings', 'item_classes', 'class_counts', 'rater_counts', 'unit_ids',
+    'worker_ids', 'ys'
+])
+
 
 def run(items,
         raters,
         classes,
-        counts,
+        ratings,
         label,
         psuedo_count,
-        tol=1,
+        tol=1e-6,
         max_iter=25,
-        init='average'):
+        init='average',
+        accelerate=False):
   """
     Run the Dawid-Skene estimator on response data
 
     Input:
-      responses: a pandas DataFrame of ratings where each row is a rating from
-                 some rater ('_worker_id') on some item ('_unit_id')
-      tol: tolerance required for convergence of EM
+      ratings: the Ratings of items by raters
+      tol: EM converges when the relative change of the log posterior (the
+          log likelihood plus the log prior of the pseudo count) between two
+          iterations is less than tol
       max_iter: maximum number of iterations of EM
-    """
+      accelerate: whether to extrapolate the EM updates with SQUAREM, see
+          squarem_step
 
-  # initialize
-  iteration = 0
-  converged = False
-  old_class_marginals = None
-  old_error_rates = None
+    Returns:
+      class_marginals: [classes]
+      error_rates: [raters x classes x classes]
+      item_classes: [items x classes]
+      trace: a DataFrame with the log likelihood, log posterior, relative
+          change, number of E-steps and time of each iteration
+    """
 
   # item_classes is a matrix of estimates of true item classes of size
   # [items, classes]
-  item_classes = initialize(counts)
-  [nItems, nRaters, nClasses] = np.shape(counts)
-
-  logging.info('Iter\tlog-likelihood\tdelta-CM\tdelta-Y_hat')
+  item_classes = initialize(ratings)
 
-  while not converged:
-    iteration += 1
-    start_iter = time.time()
+  # M-step - updated error rates and class marginals given new
+  #          distribution over true item classes
+  class_marginals, error_rates = m_step(ratings, item_classes, psuedo_count)
 
-    # M-step - updated error rates and class marginals given new
-    #          distribution over true item classes
-    old_item_classes = item_classes
+  # E-step - calculate expected item classes given error rates and
+  #          class marginals, and the likelihood of these parameters
+  item_classes, log_L = e_step(ratings, class_marginals, error_rates)
+  log_P = log_posterior(log_L, error_rates, psuedo_count)
 
-    (class_marginals, error_rates) = m_step(counts, item_classes, psuedo_count)
+  logging.info('Iter\tlog-likelihood\trelative change\tE-steps')
+  logging.info('{0}\t{1:.1f}'.format(0, log_L))
+  trace = [(0, log_L, log_P, np.nan, 1, 0.0)]
 
-    # E-step - calculate expected item classes given error rates and
-    #          class marginals
-    item_classes = e_step_verbose(counts, class_marginals, error_rates)
+  for iteration in range(1, max_iter + 1):
+    start_iter = time.time()
+    old_log_P = log_P
 
-    # check likelihood
-    log_L = calc_likelihood(counts, class_marginals, error_rates)
+    if accelerate:
+      (class_marginals, error_rates, item_classes, log_L,
+       n_e_steps) = squarem_step(ratings, class_marginals, error_rates,
+                                 item_classes, psuedo_count)
+    else:
+      class_marginals, error_rates = m_step(ratings, item_classes,
+                                            psuedo_count)
+      item_classes, log_L = e_step(ratings, class_marginals, error_rates)
+      n_e_steps = 1
+    log_P = log_posterior(log_L, error_rates, psuedo_count)
 
     # calculate the number of seconds the last iteration took
     iter_time = time.time() - start_iter
 
+    relative_change = log_posterior_change(log_P, old_log_P)
+    logging.info('{0}\t{1:.1f}\t{2:.3g}\t\t{3}\t({4:3.2f} secs)'.format(
+        iteration, log_L, relative_change, n_e_steps, iter_time))
+    trace.append(
+        (iteration, log_L, log_P, relative_change, n_e_steps, iter_time))
+
     # check for convergence
-    if old_class_marginals is not None:
-      class_marginals_diff = np.sum(
-          np.abs(class_marginals - old_class_marginals))
-      item_class_diff = np.sum(np.abs(item_classes - old_item_classes))
+    if relative_change < tol:
+      break
 
-      logging.info('{0}\t{1:.1f}\t{2:.4f}\t\t{3:.2f}\t({4:3.2f} secs)'.format(
-          iteration, log_L, class_marginals_diff, item_class_diff, iter_time))
+  trace = pd.DataFrame(
+      trace,
+      columns=[
+          'iteration', 'log_likelihood', 'log_posterior', 'relative_change',
+          'e_steps', 'seconds'
+      ])
+  return class_marginals, error_rates, item_classes, trace
 
-      if (class_marginals_diff < tol and item_class_diff < tol) \
-         or iteration > max_iter:
-        converged = True
-    else:
-      logging.info('{0}\t{1:.1f}'.format(iteration, log_L))
 
-    # update current values
-    old_class_marginals = class_marginals
-    old_error_rates = error_rates
+def log_posterior(log_L, error_rates, psuedo_count):
+  """
+    The objective that EM maximizes, up to a constant: the log likelihood
+    plus the log of the Dirichlet prior of the error rates which the
+    psuedo_count of m_step amounts to.
+    """
+  if psuedo_count == 0:
+    return log_L
+  return log_L + psuedo_count * np.sum(np.log(error_rates))
 
-  return class_marginals, error_rates, item_classes
 
+def log_posterior_change(log_P, old_log_P):
+  """
+    Relative change of the log posterior between two iterations. A log
+    posterior of 0, e.g. of a single-class label without pseudo counts, is
+    compared to the smallest positive float instead, so that no change is
+    converged rather than nan.
+    """
+  return abs(log_P - old_log_P) / max(abs(old_log_P), np.finfo(float).tiny)
+
+
+def squarem_step(ratings, class_marginals, error_rates, item_classes,
+                 psuedo_count, max_backtracks=4):
+  """
+    Takes two EM steps from the parameters, and extrapolates them with the
+    SqS3 scheme of Varadhan and Roland (2008), Simple and Globally Convergent
+    Methods for Accelerating the Convergence of Any EM Algorithm.
 
-def load_data(path, unit_id, worker_id, label):
+    The step length is shortened until the extrapolated probabilities are
+    valid, and the extrapolation is only kept if it improves the log
+    posterior of the second EM step, so that the log posterior increases
+    monotonically as in plain EM.
+
+    Input:
+      item_classes: the E-step of class_marginals and error_rates
+    Returns:
+      class_marginals, error_rates: the new parameters
+      item_classes, log_L: the E-step of the new parameters
+      n_e_steps: the number of E-steps taken
+    """
+  params_0 = np.concatenate([class_marginals, error_rates.ravel()])
+  class_marginals_1, error_rates_1 = m_step(ratings, item_classes,
+                                            psuedo_count)
+  item_classes_1, _ = e_step(ratings, class_marginals_1, error_rates_1)
+  class_marginals_2, error_rates_2 = m_step(ratings, item_classes_1,
+                                            psuedo_count)
+  item_classes_2, log_L_2 = e_step(ratings, class_marginals_2, error_rates_2)
+  params_1 = np.concatenate([class_marginals_1, error_rates_1.ravel()])
+  params_2 = np.concatenate([class_marginals_2, error_rates_2.ravel()])
+
+  r = params_1 - params_0
+  v = params_2 - params_1 - r
+  v_norm = np.linalg.norm(v)
+  if v_norm == 0:
+    return (class_marginals_2, error_rates_2, item_classes_2, log_L_2, 2)
+  alpha = min(-np.linalg.norm(r) / v_norm, -1.0)
+
+  # The coefficients of params_0, params_1 and params_2 sum to 1, so the
+  # extrapolated probabilities still sum to 1, and with alpha = -1 the
+  # extrapolation is params_2.
+  for _ in range(max_backtracks):
+    params = params_0 - 2 * alpha * r + alpha**2 * v
+    if np.all(params >= 0) and np.all(params[params_2 > 0] > 0):
+      break
+    alpha = (alpha - 1) / 2
+  else:
+    return (class_marginals_2, error_rates_2, item_classes_2, log_L_2, 2)
+
+  n_classes = ratings.n_classes
+  class_marginals = params[:n_classes]
+  error_rates = params[n_classes:].reshape(error_rates.shape)
+  item_classes, log_L = e_step(ratings, class_marginals, error_rates)
+  if (log_posterior(log_L, error_rates, psuedo_count) <
+      log_posterior(log_L_2, error_rates_2, psuedo_count)):
+    return (class_marginals_2, error_rates_2, item_classes_2, log_L_2, 3)
+  return class_marginals, error_rates, item_classes, log_L, 3
+
+
+def load_data(path, unit_id, worker_id, labels):
+  """Loads the ratings of path, labels is a label column or a list of them."""
   logging.info('Loading data from {0}'.format(path))
 
   with tf.gfile.Open(path, 'rb') as fileobj:
     df = pd.read_csv(fileobj, encoding='utf-8')
 
   # only keep necessary columns
-  df = df[[unit_id, worker_id, label]]
+  if not isinstance(labels, list):
+    labels = [labels]
+  df = df[[unit_id, worker_id] + labels]
   return df
 
 
-def initialize(counts):
+def ratings_to_counts(ratings):
+  """
+    Converts ratings to the dense counts used by the *_verbose functions.
+
+    Returns:
+      counts: counts of the number of times each response was given
+          by each rater for each item: [items x raters x classes]
+    """
+  counts = np.zeros([ratings.n_items, ratings.n_raters, ratings.n_classes])
+  np.add.at(counts, (ratings.items, ratings.raters, ratings.labels), 1)
+  return counts
+
+
+def response_sums(ratings):
+  """
+    Counts the ratings of each item in each class, summed over raters.
+
+    Returns:
+      response_sums: [items x classes]
+    """
+  indexes = ratings.items.astype(np.int64) * ratings.n_classes + ratings.labels
+  return np.bincount(
+      indexes, minlength=ratings.n_items * ratings.n_classes).reshape(
+          [ratings.n_items, ratings.n_classes])
+
+
+def factorize_ratings(df, unit_id, worker_id, label):
+  """
+    Converts rater, item and label IDs to integers starting at 0, numbered
+    in order of first appearance in df. Rows with a missing label are dropped.
+
+    Returns:
+      ratings: the Ratings of the rows of df
+      unit_ids: the original item ID of each item index
+      worker_ids: the original rater ID of each rater index
+      ys: the original label of each class index
+    """
+  items, unit_ids = pd.factorize(df[unit_id])
+  raters, worker_ids = pd.factorize(df[worker_id])
+  labels, ys = pd.factorize(df[label])
+  ratings, item_indexes, rater_indexes = label_ratings(items, raters, labels,
+                                                       len(ys))
+  return ratings, unit_ids[item_indexes], worker_ids[rater_indexes], ys
+
+
+def label_ratings(items, raters, labels, n_classes):
+  """
+    Builds the Ratings of one label from item and rater indexes shared by
+    several labels. Ratings whose label index is -1 (missing) are dropped,
+    and items and raters are renumbered so that each has ratings, in the
+    order of the shared indexes.
+
+    Returns:
+      ratings: the Ratings of the label
+      item_indexes: the shared index of each item index of ratings
+      rater_indexes: the shared index of each rater index of ratings
+    """
+  rated = labels >= 0
+  item_indexes, items = np.unique(items[rated], return_inverse=True)
+  rater_indexes, raters = np.unique(raters[rated], return_inverse=True)
+  ratings = Ratings(
+      items=items.astype(np.int32),
+      raters=raters.astype(np.int32),
+      labels=labels[rated].astype(np.int32),
+      n_items=len(item_indexes),
+      n_raters=len(rater_indexes),
+      n_classes=n_classes)
+  return ratings, item_indexes, rater_indexes
+
+
+def initialize(ratings):
   """
     Get initial estimates for the true item classes using counts
     see equation 3.1 in Dawid-Skene (1979)
 
     Input:
-      counts: counts of the number of times each response was given
-          by each rater for each item: [items x raters x classes]. Note
-          in the crowd rating example, counts will be a 0/1 matrix.
+      ratings: the Ratings of items by raters
 
     Returns:
       item_classes: matrix of estimates of true item classes:
           [items x responses]
     """
-  [nItems, nRaters, nClasses] = np.shape(counts)
-
   # sum over raters
-  response_sums = np.sum(counts, 1)
-
-  # create an empty array
-  item_classes = np.zeros([nItems, nClasses])
+  sums = response_sums(ratings)
 
   # for each item, take the average number of ratings in each class
-  for p in range(nItems):
-    item_classes[p, :] = response_sums[p, :] / np.sum(
-        response_sums[p, :], dtype=float)
-
-  return item_classes
+  return sums / np.sum(sums, axis=1, keepdims=True, dtype=float)
 
 
-def m_step(counts, item_classes, psuedo_count):
+def m_step(ratings, item_classes, psuedo_count):
   """
     Get estimates for the prior class probabilities (p_j) and the error
     rates (pi_jkl) using MLE with current estimates of true item classes
     See equations 2.3 and 2.4 in Dawid-Skene (1979)
 
     Input:
-      counts: Array of how many times each rating was given by each rater
-        for each item
+      ratings: the Ratings of items by raters
       item_classes: Matrix of current assignments of items to classes
       psuedo_count: A psuedo count used to smooth the error rates. For each
       rater k
@@ -157,18 +327,53 @@ def m_step(counts, item_classes, psuedo_count):
       pi_kjl: error rates - the probability of rater k giving
           response l for an item in class j [observers, classes, classes]
     """
-  [nItems, nRaters, nClasses] = np.shape(counts)
+  class_counts, rater_counts = sufficient_statistics(ratings, item_classes)
+  return statistics_to_parameters(class_counts, rater_counts, ratings.n_items,
+                                  psuedo_count)
+
+
+def sufficient_statistics(ratings, item_classes):
+  """
+    The expected counts which the M-step estimates the parameters from.
+
+    Returns:
+      class_counts: the expected number of items of each class [classes]
+      rater_counts: the expected number of times each rater gave each
+          response to an item of each class [raters x classes x classes]
+    """
+  nRaters = ratings.n_raters
+  nClasses = ratings.n_classes
+
+  class_counts = np.sum(item_classes, axis=0)
+
+  # sum the probability of the true class of the rated item over the ratings
+  # of each rater and response
+  rater_responses = ratings.raters.astype(np.int64) * nClasses + ratings.labels
+  rater_counts = np.zeros([nRaters, nClasses, nClasses])
+  for j in range(nClasses):
+    rater_counts[:, j, :] = np.bincount(
+        rater_responses,
+        weights=item_classes[ratings.items, j],
+        minlength=nRaters * nClasses).reshape([nRaters, nClasses])
+  return class_counts, rater_counts
+
 
+def statistics_to_parameters(class_counts, rater_counts, n_items,
+                             psuedo_count):
+  """
+    The M-step estimates of the parameters from the sufficient_statistics
+    of n_items items.
+
+    Returns:
+      p_j: class marginals [classes]
+      pi_kjl: error rates [observers, classes, classes]
+    """
   # compute class marginals
-  class_marginals = np.sum(item_classes, axis=0) / float(nItems)
+  class_marginals = class_counts / float(n_items)
 
   # compute error rates for each rater, each predicted class
   # and each true class
-
-  error_rates = np.matmul(counts.T, item_classes) + psuedo_count
-
-  # reorder axes so its of size [nItems x nClasses x nClasses]
-  error_rates = np.einsum('abc->bca', error_rates)
+  error_rates = rater_counts + psuedo_count
 
   # divide each row by the sum of the error rates over all observation classes
   sum_over_responses = np.sum(error_rates, axis=2)[:, :, None]
@@ -195,7 +400,7 @@ def m_step_verbose(counts, item_classes, psuedo_count):
 
     Input:
       counts: Array of how many times each rating was given by each rater
-        for each item
+        for each item, see ratings_to_counts
       item_classes: Matrix of current assignments of items to classes
       psuedo_count: A psuedo count used to smooth the error rates. For each
       rater k
@@ -230,46 +435,84 @@ def m_step_verbose(counts, item_classes, psuedo_count):
   return (class_marginals, error_rates)
 
 
-def e_step(counts_tiled, class_marginals, error_rates):
+def e_step(ratings, class_marginals, error_rates,
+           max_chunk_bytes=E_STEP_MAX_CHUNK_BYTES):
   """
     Determine the probability of each item belonging to each class,
     given current ML estimates of the parameters from the M-step
     See equation 2.5 in Dawid-Skene (1979)
 
     Inputs:
-      counts_tiled: A matrix of how many times each rating was given
-          by each rater for each item, repeated for each class to make matrix
-          multiplication fasterr. Size: [nItems, nRaters, nClasses, nClasses]
-      class_marginals: probability of a random item belonging to each class.
-          Size: [nClasses]
+      ratings: the Ratings of items by raters
+      class_marginals: probability of a random item belonging to each class
       error_rates: probability of rater k assigning a item in class j
-          to class l. Size [nRaters, nClasses, nClasses]
+          to class l [raters, classes, classes]
+      max_chunk_bytes: approximate memory bound of the chunks of ratings
+          processed at once
 
     Returns:
       item_classes: Soft assignments of items to classes
           [items x classes]
+      log_L: log likelihood of the parameters, see calc_likelihood. It is the
+          sum of the normalizers of the item classes.
+
+    Raises:
+      FloatingPointError: if the likelihood of some item is 0 or not a number.
     """
-  [nItems, _, nClasses, _] = np.shape(counts_tiled)
+  log_estimates = _log_estimates(ratings, class_marginals, error_rates,
+                                 max_chunk_bytes)
+  item_log_likelihoods = logsumexp(log_estimates, axis=1, keepdims=True)
+  log_L = _sum_log_likelihoods(item_log_likelihoods[:, 0])
 
-  error_rates_tiled = np.tile(error_rates, (nItems, 1, 1, 1))
-  power = np.power(error_rates_tiled, counts_tiled)
+  # normalize by dividing by the sum over all classes
+  return np.exp(log_estimates - item_log_likelihoods), log_L
 
-  # Note, multiplying over axis 1 and then 2 is substantially faster than
-  # the equivalent np.prod(power, axis=(1,3)
-  item_classes = class_marginals * np.prod(np.prod(power, axis=1), axis=2)
 
-  # normalize error rates by dividing by the sum over all classes
-  item_sum = np.sum(item_classes, axis=1, keepdims=True)
-  item_classes = np.divide(item_classes, np.tile(item_sum, (1, nClasses)))
+def _log_estimates(ratings, class_marginals, error_rates, max_chunk_bytes):
+  """
+    Computes the log of the unnormalized probability of each item belonging
+    to each class: the log class marginal plus the log error rates of all the
+    ratings of the item, summed one chunk of ratings at a time.
 
-  return item_classes
+    Returns:
+      log_estimates: [items x classes]
+    """
+  nItems = ratings.n_items
+  nClasses = ratings.n_classes
+
+  # error_rates[k, j, l] ** 0 is 1, even when the error rate is 0, so zero
+  # error rates are kept out of the logs and only count for items with a
+  # rating l by rater k.
+  zero_error_rates = (error_rates == 0).astype(float)
+  log_error_rates = np.log(np.where(error_rates > 0, error_rates, 1.0))
+  # Both sums over ratings are done by the same bincount calls. Rows are the
+  # classes j, columns the (rater k, response l) pairs.
+  stacked_rates = np.concatenate(
+      [log_error_rates, zero_error_rates], axis=1).transpose([1, 0, 2]).reshape(
+          [2 * nClasses, -1])
+
+  sums = np.zeros([2 * nClasses, nItems])
+  chunk_size = max(1, max_chunk_bytes // (2 * nClasses * 8))
+  for start in range(0, len(ratings.items), chunk_size):
+    end = start + chunk_size
+    items = ratings.items[start:end]
+    rater_responses = (ratings.raters[start:end].astype(np.int64) * nClasses +
+                       ratings.labels[start:end])
+    rating_rates = np.take(stacked_rates, rater_responses, axis=1)
+    for j in range(2 * nClasses):
+      sums[j] += np.bincount(items, weights=rating_rates[j], minlength=nItems)
+
+  with np.errstate(divide='ignore'):
+    log_estimates = np.log(class_marginals) + sums[:nClasses].T
+  log_estimates[sums[nClasses:].T > 0] = -np.inf
+  return log_estimates
 
 
 def e_step_verbose(counts, class_marginals, error_rates):
   """
     This method is the verbose (i.e. not vectorized) version of
-    the e_step. It is actually faster than the vectorized e_step
-    function (16 seconds vs 25 seconds respectively on 10k ratings).
+    the e_step. It is currently not used because the vectorized version is
+    faster, but we leave it here for future debugging.
 
     Determine the probability of each item belonging to each class,
     given current ML estimates of the parameters from the M-step
@@ -277,7 +520,7 @@ def e_step_verbose(counts, class_marginals, error_rates):
 
     Inputs:
       counts: Array of how many times each rating was given
-          by each rater for each item
+          by each rater for each item, see ratings_to_counts
       class_marginals: probability of a random item belonging to each class
       error_rates: probability of rater k assigning a item in class j
           to class l [raters, classes, classes]
@@ -303,109 +546,473 @@ def e_step_verbose(counts, class_marginals, error_rates):
   return item_classes
 
 
-def calc_likelihood(counts, class_marginals, error_rates):
+def calc_likelihood(ratings, class_marginals, error_rates,
+                    max_chunk_bytes=E_STEP_MAX_CHUNK_BYTES):
   """
     Calculate the likelihood given the current parameter estimates
     This should go up monotonically as EM proceeds
     See equation 2.7 in Dawid-Skene (1979)
 
     Inputs:
-      counts: Array of how many times each response was received
-          by each rater from each item
+      ratings: the Ratings of items by raters
       class_marginals: probability of a random item belonging to each class
       error_rates: probability of rater k assigning a item in class j
           to class l [raters, classes, classes]
 
     Returns:
       Likelihood given current parameter estimates
-    """
-  [nItems, nRaters, nClasses] = np.shape(counts)
-  log_L = 0.0
 
-  for i in range(nItems):
-    item_likelihood = 0.0
-    for j in range(nClasses):
-
-      class_prior = class_marginals[j]
-      item_class_likelihood = np.prod(
-          np.power(error_rates[:, j, :], counts[i, :, :]))
-      item_class_posterior = class_prior * item_class_likelihood
-      item_likelihood += item_class_posterior
+    Raises:
+      FloatingPointError: if the likelihood of some item is 0 or not a number.
+    """
+  log_estimates = _log_estimates(ratings, class_marginals, error_rates,
+                                 max_chunk_bytes)
+  return _sum_log_likelihoods(logsumexp(log_estimates, axis=1))
 
-    temp = log_L + np.log(item_likelihood)
 
-    if np.isnan(temp) or np.isinf(temp):
-      logging.info('{0}, {1}, {2}'.format(i, log_L, np.log(item_likelihood),
-                                          temp))
-      sys.exit()
+def _sum_log_likelihoods(item_log_likelihoods):
+  """
+    Sums the log likelihoods of the items, checking they are all finite.
+    """
+  log_L = np.sum(item_log_likelihoods)
 
-    log_L = temp
+  if np.isnan(log_L) or np.isinf(log_L):
+    i = np.argmin(np.isfinite(item_log_likelihoods))
+    raise FloatingPointError(
+        'Log likelihood of item {0} is {1} (sum of the previous items: {2}).'
+        .format(i, item_log_likelihoods[i], np.sum(item_log_likelihoods[:i])))
 
   return log_L
 
 
-def random_initialization(counts):
+def random_initialization(ratings):
   """
     Similar to initialize() above, except choose one initial class for each
     item, weighted in proportion to the counts.
 
     Input:
-      counts: counts of the number of times each response was received
-          by each rater from each item: [items x raters x classes]
+      ratings: the Ratings of items by raters
 
     Returns:
       item_classes: matrix of estimates of true item classes:
           [items x responses]
     """
-  [nItems, nRaters, nClasses] = np.shape(counts)
+  nItems = ratings.n_items
+  nClasses = ratings.n_classes
 
-  response_sums = np.sum(counts, 1)
+  sums = response_sums(ratings)
 
   # create an empty array
   item_classes = np.zeros([nItems, nClasses])
 
   # for each item, choose a random initial class, weighted in proportion
-  # to the counts from all raters
-  for p in range(nItems):
-    weights = response_sums[p, :] / np.sum(response_sums[p, :], dtype=float)
-    item_classes[p, np.random.choice(np.arange(nClasses), p=weights)] = 1
+  # to the counts from all raters: the first class whose cumulative weight
+  # is above a uniform random number
+  cumulative_weights = np.cumsum(sums, axis=1) / np.sum(
+      sums, axis=1, keepdims=True, dtype=float)
+  draws = np.random.uniform(size=[nItems, 1])
+  choices = np.minimum(
+      np.sum(cumulative_weights <= draws, axis=1), nClasses - 1)
+  item_classes[np.arange(nItems), choices] = 1
 
   return item_classes
 
 
-def majority_voting(counts):
+def majority_voting(ratings):
   """
       An alternative way to initialize assignment of items to classes
       i.e Get initial estimates for the true item classes using majority voting
 
     Input:
-      counts: Counts of the number of times each response was received
-          by each rater from each item: [items x raters x classes]
+      ratings: the Ratings of items by raters
     Returns:
       item_classes: matrix of initial estimates of true item classes:
           [items x responses]
     """
-  [nItems, nRaters, nClasses] = np.shape(counts)
+  nItems = ratings.n_items
+  nClasses = ratings.n_classes
   # sum over observers
-  response_sums = np.sum(counts, 1)
+  sums = response_sums(ratings)
 
   # create an empty array
   item_classes = np.zeros([nItems, nClasses])
 
-  # take the most frequent class for each item
-  for p in range(nItems):
-    indices = np.argwhere(response_sums[p, :] == np.max(response_sums[p, :]))
-    # in the case of ties, take the lowest valued label (could be randomized)
-    item_classes[p, np.min(indices)] = 1
+  # take the most frequent class for each item. In the case of ties, argmax
+  # takes the lowest valued label (could be randomized)
+  item_classes[np.arange(nItems), np.argmax(sums, axis=1)] = 1
 
   return item_classes
 
 
-def parse_item_classes(df, label, item_classes, index_to_unit_id_map,
-                       index_to_y_map, unit_id, worker_id, comment_text_path):
+def initial_state(ratings, item_classes, unit_ids, worker_ids, ys):
+  """The State of ratings trained from scratch."""
+  class_counts, rater_counts = sufficient_statistics(ratings, item_classes)
+  return State(ratings, item_classes, class_counts, rater_counts,
+               np.asarray(list(unit_ids)), np.asarray(list(worker_ids)),
+               np.asarray(list(ys)))
+
+
+def state_path(state_dir, label):
+  return '{0}/state_{1}.npz'.format(state_dir, label)
+
+
+def save_state(path, state):
+  """Writes a State to a compressed .npz file, local or in Cloud Storage."""
+  ratings = state.ratings
+  buf = io.BytesIO()
+  np.savez_compressed(
+      buf,
+      items=ratings.items,
+      raters=ratings.raters,
+      labels=ratings.labels,
+      item_classes=state.item_classes,
+      class_counts=state.class_counts,
+      rater_counts=state.rater_counts,
+      unit_ids=state.unit_ids,
+      worker_ids=state.worker_ids,
+      ys=state.ys)
+  with tf.gfile.Open(path, 'wb') as fileobj:
+    fileobj.write(buf.getvalue())
+
+
+def load_state(path):
+  """Reads a State written by save_state."""
+  with tf.gfile.Open(path, 'rb') as fileobj:
+    arrays = np.load(io.BytesIO(fileobj.read()))
+  ratings = Ratings(
+      items=arrays['items'],
+      raters=arrays['raters'],
+      labels=arrays['labels'],
+      n_items=len(arrays['unit_ids']),
+      n_raters=len(arrays['worker_ids']),
+      n_classes=len(arrays['ys']))
+  return State(ratings, arrays['item_classes'], arrays['class_counts'],
+               arrays['rater_counts'], arrays['unit_ids'], arrays['worker_ids'],
+               arrays['ys'])
+
+
+def _extend_ids(known_ids, ids):
+  """
+    Indexes ids by their position in known_ids, numbering the ids which are
+    not known after them in order of first appearance.
+
+    Returns:
+      indexes: the index of each of ids
+      known_ids: known_ids followed by the new ids
+    """
+  indexes = pd.Index(known_ids).get_indexer(ids)
+  new = indexes < 0
+  new_indexes, new_ids = pd.factorize(ids[new])
+  indexes[new] = len(known_ids) + new_indexes
+  return indexes, np.concatenate([known_ids, new_ids])
+
+
+def add_ratings(state, unit_ids, worker_ids, ys):
+  """
+    Adds new ratings, given by the original IDs of their items, raters and
+    labels, to a State. New items and raters are numbered after the known
+    ones, and the item classes of new items are 0 until run_incremental.
+
+    Returns:
+      state: the State with the new ratings
+      affected_items: the indexes of the items with new ratings
+
+    Raises:
+      ValueError: if a label is not one of the classes of the state.
+    """
+  items, all_unit_ids = _extend_ids(state.unit_ids, unit_ids)
+  raters, all_worker_ids = _extend_ids(state.worker_ids, worker_ids)
+  labels = pd.Index(state.ys).get_indexer(ys)
+  if np.any(labels < 0):
+    raise ValueError('Labels {0} are not classes of the state, which are {1}. '
+                     'Train from scratch to add classes.'.format(
+                         list(pd.unique(ys[labels < 0])), list(state.ys)))
+
+  old = state.ratings
+  new = Ratings(
+      items=items.astype(np.int32),
+      raters=raters.astype(np.int32),
+      labels=labels.astype(np.int32),
+      n_items=len(all_unit_ids),
+      n_raters=len(all_worker_ids),
+      n_classes=old.n_classes)
+  ratings = new._replace(
+      items=np.concatenate([old.items, new.items]),
+      raters=np.concatenate([old.raters, new.raters]),
+      labels=np.concatenate([old.labels, new.labels]))
+
+  # the statistics stay those of all the ratings, with the current item
+  # classes, so that run_incremental can subtract those of the affected items
+  item_classes = np.zeros([new.n_items, new.n_classes])
+  item_classes[:old.n_items] = state.item_classes
+  rater_counts = np.zeros([new.n_raters, new.n_classes, new.n_classes])
+  rater_counts[:old.n_raters] = state.rater_counts
+  rater_counts += sufficient_statistics(new, item_classes)[1]
+  state = State(ratings, item_classes, state.class_counts, rater_counts,
+                all_unit_ids, all_worker_ids, state.ys)
+  return state, np.unique(items)
+
+
+def run_incremental(state,
+                    affected_items,
+                    label,
+                    psuedo_count,
+                    tol=1e-6,
+                    max_iter=25):
+  """
+    Warm-starts EM from a State to which new ratings were added, see
+    add_ratings. Only the item classes of the affected items are updated,
+    with the parameters estimated from their statistics and the statistics
+    of the other items, which are kept as they were.
+
+    Returns:
+      class_marginals: [classes]
+      error_rates: [raters x classes x classes]
+      state: the State with the updated item classes and statistics
+      trace: see run
+    """
+  ratings = state.ratings
+
+  # the ratings of the affected items, which are renumbered from 0
+  item_map = np.full(ratings.n_items, -1, dtype=np.int32)
+  item_map[affected_items] = np.arange(len(affected_items))
+  affected = item_map[ratings.items] >= 0
+  affected_ratings = Ratings(
+      items=item_map[ratings.items[affected]],
+      raters=ratings.raters[affected],
+      labels=ratings.labels[affected],
+      n_items=len(affected_items),
+      n_raters=ratings.n_raters,
+      n_classes=ratings.n_classes)
+
+  # the statistics of the other items
+  item_classes = state.item_classes[affected_items]
+  class_counts, rater_counts = sufficient_statistics(affected_ratings,
+                                                     item_classes)
+  fixed_class_counts = np.maximum(state.class_counts - class_counts, 0)
+  fixed_rater_counts = np.maximum(state.rater_counts - rater_counts, 0)
+
+  logging.info('{0}: updating {1} of {2} items'.format(
+      label, len(affected_items), ratings.n_items))
+  logging.info('Iter\tlog-likelihood\trelative change')
+  trace = []
+  log_P = None
+  for iteration in range(1, max_iter + 1):
+    start_iter = time.time()
+    class_marginals, error_rates = statistics_to_parameters(
+        fixed_class_counts + class_counts, fixed_rater_counts + rater_counts,
+        ratings.n_items, psuedo_count)
+    item_classes, log_L = e_step(affected_ratings, class_marginals,
+                                 error_rates)
+    class_counts, rater_counts = sufficient_statistics(affected_ratings,
+                                                       item_classes)
+
+    # log_L only sums over the affected items
+    old_log_P = log_P
+    log_P = log_posterior(log_L, error_rates, psuedo_count)
+    iter_time = time.time() - start_iter
+    if old_log_P is None:
+      relative_change = np.nan
+    else:
+      relative_change = log_posterior_change(log_P, old_log_P)
+    logging.info('{0}\t{1:.1f}\t{2:.3g}\t\t({3:3.2f} secs)'.format(
+        iteration, log_L, relative_change, iter_time))
+    trace.append((iteration, log_L, log_P, relative_change, 1, iter_time))
+    if relative_change < tol:
+      break
+
+  all_item_classes = state.item_classes.copy()
+  all_item_classes[affected_items] = item_classes
+  state = state._replace(
+      item_classes=all_item_classes,
+      class_counts=fixed_class_counts + class_counts,
+      rater_counts=fixed_rater_counts + rater_counts)
+  trace = pd.DataFrame(
+      trace,
+      columns=[
+          'iteration', 'log_likelihood', 'log_posterior', 'relative_change',
+          'e_steps', 'seconds'
+      ])
+  return class_marginals, error_rates, state, trace
+
+
+def _read_chunks(path, columns, chunk_size):
+  """
+    Yields DataFrames of the columns of path, a CSV file read chunk_size rows
+    at a time, or a Parquet file (.parquet or .pq) read a row group at a
+    time, which requires pyarrow.
+    """
+  with tf.gfile.Open(path, 'rb') as fileobj:
+    if path.endswith(('.parquet', '.pq')):
+      import pyarrow.parquet as pq  # pylint: disable=g-import-not-at-top
+      parquet_file = pq.ParquetFile(fileobj)
+      for i in range(parquet_file.num_row_groups):
+        yield parquet_file.read_row_group(i, columns=columns).to_pandas()
+    else:
+      for chunk in pd.read_csv(
+          fileobj, encoding='utf-8', usecols=columns, chunksize=chunk_size):
+        yield chunk
+
+
+def read_item_blocks(path, unit_id, worker_id, label, block_size):
   """
-    Given the original data df, the predicted item_classes, and
-    the data mappings, returns a DataFrame with the fields:
+    Yields the ratings of path in DataFrames of about block_size rows, which
+    never split the ratings of an item. The ratings of each item must be
+    contiguous in path. Rows with a missing label are dropped.
+    """
+  rest = None
+  for chunk in _read_chunks(path, [unit_id, worker_id, label], block_size):
+    chunk = chunk.dropna(subset=[label])
+    if rest is not None:
+      chunk = pd.concat([rest, chunk], ignore_index=True)
+    if chunk.empty:
+      continue
+
+    # the ratings of the last item may continue in the next chunk
+    unit_ids = chunk[unit_id].values
+    is_last_item = unit_ids == unit_ids[-1]
+    if is_last_item.all():
+      rest = chunk
+      continue
+    n_last = np.argmin(is_last_item[::-1])
+    rest = chunk[len(chunk) - n_last:]
+    yield chunk[:len(chunk) - n_last]
+  if rest is not None and not rest.empty:
+    yield rest
+
+
+class RatingBlocks(object):
+  """
+    The blocks of read_item_blocks as Ratings. The items of each block are
+    numbered from 0, and the raters are numbered across the blocks, in order
+    of first appearance.
+
+    Reading the blocks again keeps the rater indexes of the previous reads.
+    """
+
+  def __init__(self, path, unit_id, worker_id, label, ys, block_size):
+    self.path = path
+    self.unit_id = unit_id
+    self.worker_id = worker_id
+    self.label = label
+    self.ys = ys
+    self.block_size = block_size
+    self.worker_ids = None
+    # the number of ratings of each rater, counted on the first read
+    self.n_annotations = np.zeros(0, dtype=np.int64)
+
+  def __iter__(self):
+    """Yields the DataFrame, Ratings and item IDs of each block."""
+    counted = self.worker_ids is not None
+    for df in read_item_blocks(self.path, self.unit_id, self.worker_id,
+                               self.label, self.block_size):
+      items, unit_ids = pd.factorize(df[self.unit_id])
+      worker_ids = df[self.worker_id].values
+      if self.worker_ids is None:
+        self.worker_ids = worker_ids[:0]
+      raters, self.worker_ids = _extend_ids(self.worker_ids, worker_ids)
+      labels = pd.Index(self.ys).get_indexer(df[self.label].values)
+      ratings = Ratings(
+          items=items.astype(np.int32),
+          raters=raters.astype(np.int32),
+          labels=labels.astype(np.int32),
+          n_items=len(unit_ids),
+          n_raters=len(self.worker_ids),
+          n_classes=len(self.ys))
+      if not counted:
+        n_annotations = np.bincount(ratings.raters, minlength=ratings.n_raters)
+        n_annotations[:len(self.n_annotations)] += self.n_annotations
+        self.n_annotations = n_annotations
+      yield df, ratings, unit_ids
+
+
+def read_classes(path, label, chunk_size):
+  """The label values of path in order of first appearance, for RatingBlocks."""
+  ys = pd.unique(
+      np.concatenate([
+          pd.unique(chunk[label].dropna())
+          for chunk in _read_chunks(path, [label], chunk_size)
+      ]))
+  return ys
+
+
+def stochastic_run(blocks, psuedo_count, epochs=1, step_decay=0.6):
+  """
+    Online EM (Cappe and Moulines (2009), On-line Expectation-Maximization
+    Algorithm for Latent Data Models) over blocks of ratings of disjoint items.
+
+    Each block takes an E-step with the current parameters, and moves the
+    sufficient statistics per item towards the statistics of the block by a
+    step size which decays as block_number^-step_decay. The parameters are
+    estimated from the statistics as by m_step, so that only the statistics
+    of the raters and the current block are held in memory.
+
+    Input:
+      blocks: an iterable of the (DataFrame, Ratings, item IDs) of each block,
+          which can be read epochs times, see RatingBlocks. n_raters is the
+          number of raters of the blocks so far.
+      step_decay: in (0.5, 1]
+    Returns:
+      class_marginals: [classes]
+      error_rates: [raters x classes x classes]
+      trace: a DataFrame with the log likelihood per item and the step size
+          of each block
+    """
+  class_stats = None
+  rater_stats = None
+  n_items = 0
+  block_number = 0
+  trace = []
+  for epoch in range(epochs):
+    for _, ratings, _ in blocks:
+      start_block = time.time()
+      if epoch == 0:
+        n_items += ratings.n_items
+
+      if class_stats is None:
+        item_classes = initialize(ratings)
+        log_L = np.nan
+      else:
+        rater_stats = np.pad(rater_stats, [(0, ratings.n_raters - len(
+            rater_stats)), (0, 0), (0, 0)], 'constant')
+        class_marginals, error_rates = statistics_to_parameters(
+            class_stats * n_items, rater_stats * n_items, n_items,
+            psuedo_count)
+        item_classes, log_L = e_step(ratings, class_marginals, error_rates)
+
+      class_counts, rater_counts = sufficient_statistics(ratings, item_classes)
+      block_number += 1
+      step = block_number**-step_decay
+      if class_stats is None:
+        class_stats = class_counts / ratings.n_items
+        rater_stats = rater_counts / ratings.n_items
+      else:
+        class_stats += step * (class_counts / ratings.n_items - class_stats)
+        rater_stats += step * (rater_counts / ratings.n_items - rater_stats)
+
+      block_time = time.time() - start_block
+      logging.info('{0}\t{1}\t{2:.4f}\t{3:.3f}\t({4:3.2f} secs)'.format(
+          epoch, block_number, log_L / ratings.n_items, step, block_time))
+      trace.append((epoch, block_number, ratings.n_items,
+                    log_L / ratings.n_items, step, block_time))
+
+  class_marginals, error_rates = statistics_to_parameters(
+      class_stats * n_items, rater_stats * n_items, n_items, psuedo_count)
+  trace = pd.DataFrame(
+      trace,
+      columns=[
+          'epoch', 'block', 'n_items', 'log_likelihood_per_item', 'step',
+          'seconds'
+      ])
+  return class_marginals, error_rates, trace
+
+
+def parse_item_classes(df, label, item_classes, unit_ids, ys, unit_id,
+                       worker_id, comment_text_path):
+  """
+    Given the original data df, the predicted item_classes, and the
+    original item ID of each item index and label of each class index,
+    returns a DataFrame sorted by item ID with the fields:
       * _unit_index: the 0,1,...nItems index
       * _unit_id: the original item ID
       * {LABEL}_hat: the predicted probability of the item being labeled 1 as
@@ -415,41 +1022,34 @@ def parse_item_classes(df, label, item_classes, index_to_unit_id_map,
   LABEL_HAT = '{}_hat'.format(label)
   LABEL_MEAN = '{}_mean'.format(label)
   ROUND_DEC = 8
-  _, N_ClASSES = np.shape(item_classes)
-
-  df_predictions = pd.DataFrame()
-
-  # Add columns for predictions for each class
-  col_names = []
-  for k in range(N_ClASSES):
-    # y is the original value of the class. When we train, we re-map
-    # all the classes to 0,1,....K. But our data has classes like
-    # -2,-1,0,1,2. In that case, of k is 0, then y would be -2
-    y = index_to_y_map[k]
-    col_name = '{0}_{1}'.format(LABEL_HAT, y)
-    col_names.append(col_name)
-
-    df_predictions[col_name] = [round(i[k], ROUND_DEC) for i in item_classes]
+  n_items = len(item_classes)
+
+  # Calculate the y_mean from the original data, by the item index of each
+  # rating
+  items = pd.Index(unit_ids).get_indexer(df[unit_id])
+  mean_labels = np.bincount(
+      items, weights=df[label].values.astype(float),
+      minlength=n_items) / np.bincount(
+          items, minlength=n_items)
+
+  df_predictions = pd.DataFrame({
+      unit_id: np.asarray(unit_ids),
+      LABEL_MEAN: np.round(mean_labels, ROUND_DEC)
+  }, columns=[unit_id, LABEL_MEAN])
+
+  # Add columns for predictions for each class. y is the original value of
+  # the class. When we train, we re-map all the classes to 0,1,....K. But our
+  # data has classes like -2,-1,0,1,2. In that case, of k is 0, then y would
+  # be -2
+  hats = np.round(item_classes, ROUND_DEC)
+  for k, y in enumerate(ys):
+    df_predictions['{0}_{1}'.format(LABEL_HAT, y)] = hats[:, k]
 
   # To get a prediction of the mean label, multiply our predictions with the
   # true y values.
-  y_values = list(index_to_y_map.values())
-  col_name = '{0}_hat_mean'.format(label)
-  df_predictions[col_name] = np.dot(df_predictions[col_names], list(y_values))
-
-  # Use the _unit_index to map to the original _unit_id
-  df_predictions['_unit_index'] = range(len(item_classes))
-  df_predictions[unit_id] = df_predictions['_unit_index']\
-                               .apply(lambda i: index_to_unit_id_map[i])
-
-  # Calculate the y_mean from the original data and join on _unit_id
-  # Add a column for the mean predictions
-  df[label] = df[label].astype(float)
-  mean_labels = df.groupby(unit_id, as_index=False)[label]\
-                 .mean()\
-                 .round(ROUND_DEC)\
-                 .rename(index=int, columns={label: LABEL_MEAN})
-  df_predictions = pd.merge(mean_labels, df_predictions, on=unit_id)
+  df_predictions['{0}_hat_mean'.format(label)] = np.dot(hats, list(ys))
+  df_predictions['_unit_index'] = np.arange(n_items)
+  df_predictions = df_predictions.sort_values(unit_id, kind='mergesort')
 
   # join with data that contains the item-level comment text
   if comment_text_path:
@@ -462,142 +1062,381 @@ def parse_item_classes(df, label, item_classes, index_to_unit_id_map,
       df_comments = df_comments.drop_duplicates(subset=unit_id)
 
     df_predictions = df_predictions.merge(df_comments, on=unit_id)
-  return df_predictions
+  return df_predictions.reset_index(drop=True)
 
 
-def parse_error_rates(df, error_rates, index_to_worker_id_map, index_to_y_map,
-                      unit_id, worker_id):
+def parse_error_rates(df,
+                      error_rates,
+                      worker_ids,
+                      ys,
+                      unit_id,
+                      worker_id,
+                      n_annotations=None):
   """
-    Given the original data DataFrame, the predicted error_rates and the
-    mappings
-    between the indexes and ids, returns a DataFrame with the fields:
+    Given the original data DataFrame, the predicted error_rates, and the
+    original rater ID of each rater index and label of each class index,
+    returns a DataFrame with the fields:
 
       * _worker_index: the 0,1,...nItems index
       * _worker_id: the original item ID
       * _error_rate_{k}_{k}: probability the worker would choose class k when
           the true class is k (for accurate workers, these numbers are high).
-    """
-  columns = [worker_id, '_worker_index']
-
-  df_error_rates = pd.DataFrame()
-
-  # add the integer _worker_index
-  df_error_rates['_worker_index'] = index_to_worker_id_map.keys()
-
-  # add the original _worker_id
-  df_error_rates[worker_id] = [j for (i, j) in index_to_worker_id_map.items()]
 
+    The number of annotations of each worker index can be given as
+    n_annotations instead of being counted in df.
+    """
   # add annotation counts for each worker
-  worker_counts = df.groupby(
-      by=worker_id, as_index=False)[unit_id]\
-                    .count()\
-                    .rename(index=int, columns={unit_id: 'n_annotations'})
+  if n_annotations is None:
+    n_annotations = np.bincount(
+        pd.Index(worker_ids).get_indexer(df[worker_id]),
+        minlength=len(worker_ids))
 
-  df_error_rates = pd.merge(df_error_rates, worker_counts, on=worker_id)
+  df_error_rates = pd.DataFrame({
+      '_worker_index': np.arange(len(worker_ids)),
+      worker_id: np.asarray(worker_ids),
+      'n_annotations': n_annotations
+  }, columns=['_worker_index', worker_id, 'n_annotations'])
 
   # add the diagonal error rates, which are the per-class accuracy rates,
   # for each class k, we add a column for p(rater will pick k | item's true class is k)
 
   # y_label is the original y value in the data and y_index is the
   # integer we mapped it to, i.e. 0, 1, ..., |Y|
-  for y_index, y_label in index_to_y_map.items():
+  accuracy_rates = np.diagonal(error_rates, axis1=1, axis2=2)
+  for y_index, y_label in enumerate(ys):
     col_name = 'accuracy_rate_{0}'.format(y_label)
-    df_error_rates[col_name] = [e[y_index, y_index] for e in error_rates]
+    df_error_rates[col_name] = accuracy_rates[:, y_index]
 
   return df_error_rates
 
 
+def train_label(items, raters, labels, n_classes, label, psuedo_count, tol,
+                max_iter, accelerate):
+  """
+    Runs EM on the ratings of one label, see label_ratings for the inputs.
+
+    Returns:
+      item_indexes: the shared index of each item index of item_classes
+      rater_indexes: the shared index of each rater index of error_rates
+      error_rates: [raters x classes x classes]
+      item_classes: [items x classes]
+      trace: see run
+    """
+  ratings, item_indexes, rater_indexes = label_ratings(items, raters, labels,
+                                                       n_classes)
+  logging.info('{0}: {1} items, {2} raters, {3} classes'.format(
+      label, ratings.n_items, ratings.n_raters, ratings.n_classes))
+  _, error_rates, item_classes, trace = run(
+      range(ratings.n_items),
+      range(ratings.n_raters),
+      range(ratings.n_classes),
+      ratings,
+      label,
+      psuedo_count,
+      tol=tol,
+      max_iter=max_iter,
+      accelerate=accelerate)
+  return item_indexes, rater_indexes, error_rates, item_classes, trace
+
+
+# The item, rater and label indexes of the ratings in the processes of
+# train_labels, as views of memory shared with the parent process.
+_shared_ratings = {}
+
+
+def _shared_array(values):
+  """Copies an array of indexes to memory shared with child processes."""
+  array = multiprocessing.RawArray('i', values.size)
+  np.ctypeslib.as_array(array)[:] = values.ravel()
+  return array
+
+
+def _init_shared_ratings(items, raters, labels, n_ratings):
+  logging.basicConfig(level=logging.INFO)
+  _shared_ratings['items'] = np.ctypeslib.as_array(items)
+  _shared_ratings['raters'] = np.ctypeslib.as_array(raters)
+  _shared_ratings['labels'] = np.ctypeslib.as_array(labels).reshape(
+      [-1, n_ratings])
+
+
+def _train_shared_label(args):
+  label_index, n_classes, label, psuedo_count, tol, max_iter, accelerate = args
+  return train_label(_shared_ratings['items'], _shared_ratings['raters'],
+                     _shared_ratings['labels'][label_index], n_classes, label,
+                     psuedo_count, tol, max_iter, accelerate)
+
+
+def train_labels(items, raters, labels, n_classes, label_names, psuedo_count,
+                 tol, max_iter, accelerate, n_processes):
+  """
+    Runs train_label on several labels of the same ratings concurrently, in a
+    pool of n_processes processes. The item, rater and label indexes are
+    copied once to shared memory instead of being sent to each process.
+
+    Input:
+      labels: the class indexes of each label, -1 if missing [labels x ratings]
+      n_classes: the number of classes of each label
+    Returns:
+      the results of train_label, for each label
+    """
+  initargs = (_shared_array(items), _shared_array(raters),
+              _shared_array(labels), len(items))
+  tasks = [(i, n_classes[i], label_names[i], psuedo_count, tol, max_iter,
+            accelerate) for i in range(len(label_names))]
+  with multiprocessing.Pool(n_processes, _init_shared_ratings,
+                            initargs) as pool:
+    return pool.map(_train_shared_label, tasks, chunksize=1)
+
+
+class TableWriter(object):
+  """
+    Writes DataFrames with the same columns one after the other to a CSV or,
+    with pyarrow, a Parquet file, local or in Cloud Storage.
+    """
+
+  def __init__(self, path, output_format):
+    self.path = path
+    self.output_format = output_format
+    self._parquet_writer = None
+    self._header = True
+    if output_format == 'parquet':
+      self._fileobj = tf.gfile.Open(path, 'wb')
+    else:
+      self._fileobj = tf.gfile.Open(path, 'w')
+
+  def write(self, df):
+    if self.output_format == 'parquet':
+      import pyarrow as pa  # pylint: disable=g-import-not-at-top
+      import pyarrow.parquet as pq  # pylint: disable=g-import-not-at-top
+      table = pa.Table.from_pandas(df, preserve_index=False)
+      if self._parquet_writer is None:
+        self._parquet_writer = pq.ParquetWriter(self._fileobj, table.schema)
+      self._parquet_writer.write_table(table)
+    else:
+      df.to_csv(
+          self._fileobj, index=False, encoding='utf-8', header=self._header)
+      self._header = False
+
+  def close(self):
+    if self._parquet_writer is not None:
+      self._parquet_writer.close()
+    self._fileobj.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self.close()
+
+
+def output_path(job_dir, name, label, n, output_format):
+  return '{0}/{1}_{2}_{3}.{4}'.format(job_dir, name, label, n, output_format)
+
+
+def write_label_outputs(df, label, item_classes, error_rates, trace, unit_ids,
+                        worker_ids, ys, unit_id, worker_id, comment_text_path,
+                        job_dir, output_format):
+  """
+    Writes the predictions and error rates of one label as output_format
+    files, and the trace CSV.
+    """
+  df = df[[unit_id, worker_id, label]].dropna(subset=[label])
+
+  # join comment_text, old labels and new labels
+  df_predictions = parse_item_classes(df, label, item_classes, unit_ids, ys,
+                                      unit_id, worker_id, comment_text_path)
+
+  # join rater error_rates
+  df_error_rates = parse_error_rates(df, error_rates, worker_ids, ys, unit_id,
+                                     worker_id)
+
+  # write predictions and error_rates out
+  n = len(df)
+  prediction_path = output_path(job_dir, 'predictions', label, n,
+                                output_format)
+  error_rates_path = output_path(job_dir, 'error_rates', label, n,
+                                 output_format)
+  trace_path = output_path(job_dir, 'trace', label, n, 'csv')
+
+  logging.info('Writing predictions to {}'.format(prediction_path))
+  with TableWriter(prediction_path, output_format) as writer:
+    writer.write(df_predictions)
+
+  logging.info('Writing error rates to {}'.format(error_rates_path))
+  with TableWriter(error_rates_path, output_format) as writer:
+    writer.write(df_error_rates)
+
+  logging.info('Writing EM trace to {}'.format(trace_path))
+  with tf.gfile.Open(trace_path, 'w') as fileobj:
+    trace.to_csv(fileobj, index=False, encoding='utf-8')
+
+
+def train_label_stochastic(label, FLAGS):
+  """
+    Trains label with stochastic_run on item blocks streamed from
+    FLAGS.data_path, and streams the predictions of each block to the
+    predictions file. --comment-text-path is not joined.
+    """
+  if FLAGS.comment_text_path:
+    logging.warning(
+        '--comment-text-path is ignored with --stochastic: comment text is '
+        'not joined to the predictions of {}.'.format(label))
+  unit_id = FLAGS.unit_id_col
+  worker_id = FLAGS.worker_id_col
+  start = time.time()
+  ys = read_classes(FLAGS.data_path, label, FLAGS.block_size)
+  blocks = RatingBlocks(FLAGS.data_path, unit_id, worker_id, label, ys,
+                        FLAGS.block_size)
+  logging.info('Epoch\tBlock\tlog-likelihood per item\tstep')
+  class_marginals, error_rates, trace = stochastic_run(
+      blocks,
+      FLAGS.pseudo_count,
+      epochs=FLAGS.epochs,
+      step_decay=FLAGS.step_decay)
+  logging.info('training time: {0:.4f} seconds'.format(time.time() - start))
+
+  start = time.time()
+  n = blocks.n_annotations.sum()
+  prediction_path = output_path(FLAGS.job_dir, 'predictions', label, n,
+                                FLAGS.output_format)
+  error_rates_path = output_path(FLAGS.job_dir, 'error_rates', label, n,
+                                 FLAGS.output_format)
+  trace_path = output_path(FLAGS.job_dir, 'trace', label, n, 'csv')
+
+  logging.info('Writing predictions to {}'.format(prediction_path))
+  with TableWriter(prediction_path, FLAGS.output_format) as writer:
+    n_items = 0
+    for df, ratings, unit_ids in blocks:
+      item_classes, _ = e_step(ratings, class_marginals, error_rates)
+      df_predictions = parse_item_classes(df, label, item_classes, unit_ids,
+                                          ys, unit_id, worker_id, None)
+      df_predictions['_unit_index'] += n_items
+      n_items += ratings.n_items
+      writer.write(df_predictions)
+
+  df_error_rates = parse_error_rates(
+      None,
+      error_rates,
+      blocks.worker_ids,
+      ys,
+      unit_id,
+      worker_id,
+      n_annotations=blocks.n_annotations)
+  logging.info('Writing error rates to {}'.format(error_rates_path))
+  with TableWriter(error_rates_path, FLAGS.output_format) as writer:
+    writer.write(df_error_rates)
+
+  logging.info('Writing training trace to {}'.format(trace_path))
+  with tf.gfile.Open(trace_path, 'w') as fileobj:
+    trace.to_csv(fileobj, index=False, encoding='utf-8')
+  logging.info('output time: {0:.4f} seconds'.format(time.time() - start))
+
+
 def main(FLAGS):
   logging.basicConfig(level=logging.INFO)
 
   # load data, each row is an annotation
   n_examples = FLAGS.n_examples
-  label = FLAGS.label
+  labels = FLAGS.labels.split(',') if FLAGS.labels else [FLAGS.label]
   unit_id = FLAGS.unit_id_col
   worker_id = FLAGS.worker_id_col
-  comment_text_path = FLAGS.comment_text_path
-  df = load_data(FLAGS.data_path, unit_id, worker_id, label)[0:n_examples]
-
-  logging.info('Running on {0} examples for label {1}'.format(len(df), label))
-
-  # convert rater, item and label IDs to integers starting at 0
-  #
-  #   * worker_id_to_index_map: _worker_id -> index
-  #   * index_to_worker_id_map: index -> worker
-  #   * unit_id_to_index_map: _unit_id -> index
-  #   * index_to_unit_id_map: index -> _unit_id
-  #   * y_to_index_map: label -> index
-  #   * index_to_y_map: index -> label
-  worker_id_to_index_map = {
-      w: i for (i, w) in enumerate(df[worker_id].unique())
-  }
-  index_to_worker_id_map = {i: w for (w, i) in worker_id_to_index_map.items()}
-  unit_id_to_index_map = {w: i for (i, w) in enumerate(df[unit_id].unique())}
-  index_to_unit_id_map = {i: w for (w, i) in unit_id_to_index_map.items()}
-  y_to_index_map = {w: i for (i, w) in enumerate(df[label].unique())}
-  index_to_y_map = {i: w for (w, i) in y_to_index_map.items()}
-
-  # create list of unique raters, items and labels
-  raters = list(df[worker_id].apply(lambda x: worker_id_to_index_map[x]))
-  items = list(df[unit_id].apply(lambda x: unit_id_to_index_map[x]))
-  y = list(df[label].apply(lambda x: y_to_index_map[x]))
-
-  nClasses = len(df[label].unique())
-  nItems = len(df[unit_id].unique())
-  nRaters = len(df[worker_id].unique())
-  counts = np.zeros([nItems, nRaters, nClasses])
-
-  # convert responses to counts
-  for i, item_index in enumerate(items):
-    rater_index = raters[i]
-    y_index = y[i]
-    counts[item_index, rater_index, y_index] += 1
-
-  raters_unique = index_to_worker_id_map.keys()
-  items_unique = index_to_unit_id_map.keys()
-  classes_unique = index_to_y_map.keys()
-
-  logging.info('num items: {0}'.format(len(items_unique)))
-  logging.info('num raters: {0}'.format(len(raters_unique)))
-  logging.info('num classes: {0}'.format(len(classes_unique)))
+  if FLAGS.stochastic:
+    for label in labels:
+      train_label_stochastic(label, FLAGS)
+    return
+
+  start = time.time()
+  df = load_data(FLAGS.data_path, unit_id, worker_id, labels)[0:n_examples]
+  logging.info('loading time: {0:.4f} seconds'.format(time.time() - start))
+
+  logging.info('Running on {0} examples for labels {1}'.format(
+      len(df), ', '.join(labels)))
+
+  if FLAGS.incremental:
+    for label in labels:
+      update_label(df, label, FLAGS)
+    return
+
+  # convert rater and item IDs to integers starting at 0 once for all the
+  # labels, and the values of each label to class indexes
+  start = time.time()
+  items, unit_ids = pd.factorize(df[unit_id])
+  raters, worker_ids = pd.factorize(df[worker_id])
+  label_classes, label_ys = zip(*[pd.factorize(df[label]) for label in labels])
+  n_classes = [len(ys) for ys in label_ys]
+  logging.info('indexing time: {0:.4f} seconds'.format(time.time() - start))
 
   # run EM
   start = time.time()
-  class_marginals, error_rates, item_classes = run(
-      items_unique,
-      raters_unique,
-      classes_unique,
-      counts,
+  n_processes = min(len(labels), FLAGS.num_processes or
+                    multiprocessing.cpu_count())
+  if n_processes > 1:
+    results = train_labels(items, raters, np.stack(label_classes), n_classes,
+                           labels, FLAGS.pseudo_count, FLAGS.tolerance,
+                           FLAGS.max_iter, FLAGS.accelerate, n_processes)
+  else:
+    results = [
+        train_label(items, raters, classes, len(ys), label, FLAGS.pseudo_count,
+                    FLAGS.tolerance, FLAGS.max_iter, FLAGS.accelerate)
+        for label, classes, ys in zip(labels, label_classes, label_ys)
+    ]
+  logging.info('training time: {0:.4f} seconds'.format(time.time() - start))
+
+  start = time.time()
+  for label, classes, ys, (item_indexes, rater_indexes, error_rates,
+                           item_classes, trace) in zip(labels, label_classes,
+                                                       label_ys, results):
+    write_label_outputs(df, label, item_classes, error_rates, trace,
+                        unit_ids[item_indexes], worker_ids[rater_indexes], ys,
+                        unit_id, worker_id, FLAGS.comment_text_path,
+                        FLAGS.job_dir, FLAGS.output_format)
+
+    if FLAGS.state_dir:
+      ratings, _, _ = label_ratings(items, raters, classes, len(ys))
+      save_state(
+          state_path(FLAGS.state_dir, label),
+          initial_state(ratings, item_classes, unit_ids[item_indexes],
+                        worker_ids[rater_indexes], ys))
+  logging.info('output time: {0:.4f} seconds'.format(time.time() - start))
+
+
+def update_label(df, label, FLAGS):
+  """
+    Adds the ratings of df to the State of label saved in FLAGS.state_dir,
+    updates it with run_incremental, and writes the outputs for all the
+    ratings of the State.
+    """
+  unit_id = FLAGS.unit_id_col
+  worker_id = FLAGS.worker_id_col
+  path = state_path(FLAGS.state_dir, label)
+  state = load_state(path)
+  df = df.dropna(subset=[label])
+
+  start = time.time()
+  state, affected_items = add_ratings(state, df[unit_id].values,
+                                      df[worker_id].values, df[label].values)
+  _, error_rates, state, trace = run_incremental(
+      state,
+      affected_items,
       label,
       FLAGS.pseudo_count,
       tol=FLAGS.tolerance,
       max_iter=FLAGS.max_iter)
-  end = time.time()
-  logging.info('training time: {0:.4f} seconds'.format(end - start))
-
-  # join comment_text, old labels and new labels
-  df_predictions = parse_item_classes(df, label, item_classes,
-                                      index_to_unit_id_map, index_to_y_map,
-                                      unit_id, worker_id, comment_text_path)
-
-  # join rater error_rates
-  df_error_rates = parse_error_rates(df, error_rates, index_to_worker_id_map,
-                                     index_to_y_map, unit_id, worker_id)
-
-  # write predictions and error_rates out as CSV
-  n = len(df)
-  prediction_path = '{0}/predictions_{1}_{2}.csv'.format(
-      FLAGS.job_dir, label, n)
-  error_rates_path = '{0}/error_rates_{1}_{2}.csv'.format(
-      FLAGS.job_dir, label, n)
-
-  logging.info('Writing predictions to {}'.format(prediction_path))
-  with tf.gfile.Open(prediction_path, 'w') as fileobj:
-    df_predictions.to_csv(fileobj, index=False, encoding='utf-8')
+  logging.info('training time: {0:.4f} seconds'.format(time.time() - start))
 
-  logging.info('Writing error rates to {}'.format(error_rates_path))
-  with tf.gfile.Open(error_rates_path, 'w') as fileobj:
-    df_error_rates.to_csv(fileobj, index=False, encoding='utf-8')
+  start = time.time()
+  save_state(path, state)
+  ratings = state.ratings
+  df_all = pd.DataFrame({
+      unit_id: state.unit_ids[ratings.items],
+      worker_id: state.worker_ids[ratings.raters],
+      label: state.ys[ratings.labels]
+  })
+  write_label_outputs(df_all, label, state.item_classes, error_rates, trace,
+                      state.unit_ids, state.worker_ids, state.ys, unit_id,
+                      worker_id, FLAGS.comment_text_path, FLAGS.job_dir,
+                      FLAGS.output_format)
+  logging.info('output time: {0:.4f} seconds'.format(time.time() - start))
 
 
 if __name__ == '__main__':
@@ -621,6 +1460,17 @@ if __name__ == '__main__':
       '--label',
       help='The label to train on, e.g. "obscene" or "threat"',
       default='obscene')
+  parser.add_argument(
+      '--labels',
+      help='Comma-separated labels to train on from the same data, e.g. '
+      '"obscene,threat,insult". Overrides --label.',
+      default='')
+  parser.add_argument(
+      '--num-processes',
+      help='The number of labels to train concurrently with --labels. '
+      'Defaults to the number of CPUs.',
+      type=int,
+      default=0)
   parser.add_argument(
       '--job-dir',
       type=str,
@@ -638,9 +1488,53 @@ if __name__ == '__main__':
       default=1.0)
   parser.add_argument(
       '--tolerance',
-      help='Stop training when variables change less than this value.',
+      help='Stop training when the log likelihood changes by less than this '
+      'fraction of its value.',
+      type=float,
+      default=1e-6)
+  parser.add_argument(
+      '--accelerate',
+      help='Accelerate EM with SQUAREM extrapolation.',
+      action='store_true')
+  parser.add_argument(
+      '--state-dir',
+      help='The directory to save the state of each label to after training, '
+      'for --incremental.',
+      default='')
+  parser.add_argument(
+      '--incremental',
+      help='Add the ratings of --data-path to the states saved in '
+      '--state-dir, and only update the items they rate instead of training '
+      'from scratch.',
+      action='store_true')
+  parser.add_argument(
+      '--stochastic',
+      help='Train with online EM on blocks of --block-size ratings streamed '
+      'from --data-path, a CSV or Parquet file in which the ratings of each '
+      'item are contiguous, instead of loading all the data in memory.',
+      action='store_true')
+  parser.add_argument(
+      '--block-size',
+      help='The approximate number of ratings of a block of --stochastic.',
+      type=int,
+      default=1000000)
+  parser.add_argument(
+      '--epochs',
+      help='The number of passes of --stochastic over the data.',
       type=int,
       default=1)
+  parser.add_argument(
+      '--step-decay',
+      help='The step size of the n-th block of --stochastic is n^-step_decay, '
+      'in (0.5, 1].',
+      type=float,
+      default=0.6)
+  parser.add_argument(
+      '--output-format',
+      help='The format of the predictions and error rates files. parquet '
+      'requires pyarrow.',
+      choices=['csv', 'parquet'],
+      default='csv')
 
   FLAGS = parser.parse_args()
 
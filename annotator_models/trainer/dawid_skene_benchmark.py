@@ -0,0 +1,300 @@
+"""Benchmarks of the Dawid-Skene steps on synthetic ratings.
+
+Raters label each item correctly with their own accuracy, and uniformly at
+random otherwise.
+
+Usage:
+  python dawid_skene_benchmark.py --n-items 100000 --n-raters 1000
+  python dawid_skene_benchmark.py --benchmark stochastic --n-items 5000000
+  python dawid_skene_benchmark.py --benchmark accelerate --n-classes 4 \
+    --min-accuracy 0.2 --max-accuracy 0.6
+"""
+
+import argparse
+import logging
+import time
+import tracemalloc
+
+import numpy as np
+
+import dawid_skene
+
+
+def synthetic_ratings(n_items,
+                      n_raters,
+                      n_classes,
+                      ratings_per_item,
+                      min_accuracy=0.5,
+                      max_accuracy=0.95,
+                      seed=0):
+  """
+    Generates random ratings of items with random true classes.
+
+    Returns:
+      ratings: the dawid_skene.Ratings of the items
+      true_classes: the true class of each item [items]
+    """
+  rng = np.random.RandomState(seed)
+  true_classes = rng.randint(n_classes, size=n_items)
+  accuracies = rng.uniform(min_accuracy, max_accuracy, size=n_raters)
+  ratings = _rate_items(rng, true_classes, accuracies, n_classes,
+                        ratings_per_item)
+  return ratings, true_classes
+
+
+def _rate_items(rng, true_classes, accuracies, n_classes, ratings_per_item):
+  """Ratings of items by raters with the given accuracies."""
+  n_items = len(true_classes)
+  n_raters = len(accuracies)
+  items = np.repeat(np.arange(n_items), ratings_per_item)
+  # ratings_per_item distinct raters for each item: the raters of items with
+  # duplicate raters are drawn again.
+  raters = rng.randint(n_raters, size=(n_items, ratings_per_item))
+  while True:
+    sorted_raters = np.sort(raters, axis=1)
+    duplicates = np.any(sorted_raters[:, 1:] == sorted_raters[:, :-1], axis=1)
+    if not duplicates.any():
+      break
+    raters[duplicates] = rng.randint(
+        n_raters, size=(duplicates.sum(), ratings_per_item))
+  raters = raters.ravel()
+  correct = rng.rand(len(items)) < accuracies[raters]
+  labels = np.where(correct, true_classes[items],
+                    rng.randint(n_classes, size=len(items)))
+
+  return dawid_skene.Ratings(
+      items=items.astype(np.int32),
+      raters=raters.astype(np.int32),
+      labels=labels.astype(np.int32),
+      n_items=n_items,
+      n_raters=n_raters,
+      n_classes=n_classes)
+
+
+class SyntheticBlocks(object):
+  """
+    Blocks of synthetic ratings for dawid_skene.stochastic_run, which are
+    generated again on each read instead of being held in memory. Each block
+    is (None, Ratings, the true classes of its items).
+    """
+
+  def __init__(self,
+               n_blocks,
+               block_items,
+               n_raters,
+               n_classes,
+               ratings_per_item,
+               min_accuracy=0.5,
+               max_accuracy=0.95,
+               seed=0):
+    self.n_blocks = n_blocks
+    self.block_items = block_items
+    self.n_classes = n_classes
+    self.ratings_per_item = ratings_per_item
+    self.seed = seed
+    self.accuracies = np.random.RandomState(seed).uniform(
+        min_accuracy, max_accuracy, size=n_raters)
+
+  def __iter__(self):
+    for block in range(self.n_blocks):
+      rng = np.random.RandomState([self.seed, block + 1])
+      true_classes = rng.randint(self.n_classes, size=self.block_items)
+      ratings = _rate_items(rng, true_classes, self.accuracies, self.n_classes,
+                            self.ratings_per_item)
+      yield None, ratings, true_classes
+
+
+def first_items(ratings, n_items):
+  """The Ratings of the first n_items items."""
+  keep = ratings.items < n_items
+  return ratings._replace(
+      items=ratings.items[keep],
+      raters=ratings.raters[keep],
+      labels=ratings.labels[keep],
+      n_items=n_items)
+
+
+def benchmark_e_step(ratings, n_verbose_items):
+  """Times e_step, and e_step_verbose on the first n_verbose_items items."""
+  item_classes = dawid_skene.initialize(ratings)
+  class_marginals, error_rates = dawid_skene.m_step(ratings, item_classes, 1.0)
+
+  start = time.time()
+  item_classes, _ = dawid_skene.e_step(ratings, class_marginals, error_rates)
+  e_step_time = time.time() - start
+
+  verbose_counts = dawid_skene.ratings_to_counts(
+      first_items(ratings, n_verbose_items))
+  start = time.time()
+  verbose_item_classes = dawid_skene.e_step_verbose(
+      verbose_counts, class_marginals, error_rates)
+  verbose_time = (time.time() - start) * ratings.n_items / n_verbose_items
+
+  max_diff = np.max(
+      np.abs(item_classes[:n_verbose_items] - verbose_item_classes))
+  logging.info('e_step: {0:.2f} secs'.format(e_step_time))
+  logging.info('e_step_verbose: {0:.2f} secs (extrapolated from {1} items)'
+               .format(verbose_time, len(verbose_counts)))
+  logging.info('speedup: {0:.1f}x, max posterior difference: {1:.2g}'.format(
+      verbose_time / e_step_time, max_diff))
+
+
+def benchmark_acceleration(ratings, tol, max_iter):
+  """Times plain and SQUAREM accelerated EM until the same tolerance."""
+  results = {}
+  for accelerate in [False, True]:
+    start = time.time()
+    results[accelerate] = dawid_skene.run(
+        None,
+        None,
+        None,
+        ratings,
+        'label',
+        1.0,
+        tol=tol,
+        max_iter=max_iter,
+        accelerate=accelerate)
+    trace = results[accelerate][3]
+    logging.info(
+        '{0}: {1} iterations, {2} E-steps, log posterior {3:.6f}, '
+        '{4:.2f} secs'.format('SQUAREM' if accelerate else 'plain EM',
+                              len(trace) - 1, trace['e_steps'].sum(),
+                              trace['log_posterior'].iloc[-1],
+                              time.time() - start))
+  max_diff = np.max(np.abs(results[False][2] - results[True][2]))
+  logging.info('max posterior difference: {0:.2g}'.format(max_diff))
+
+
+def benchmark_stochastic(blocks, tol, max_iter, epochs, step_decay):
+  """
+    Compares the accuracy and peak memory of stochastic_run on blocks with
+    the batch algorithm on all the ratings of the blocks.
+    """
+  tracemalloc.start()
+  start = time.time()
+  class_marginals, error_rates, _ = dawid_skene.stochastic_run(
+      blocks, 1.0, epochs=epochs, step_decay=step_decay)
+  n_correct = 0
+  n_items = 0
+  for _, ratings, true_classes in blocks:
+    item_classes, _ = dawid_skene.e_step(ratings, class_marginals, error_rates)
+    n_correct += np.sum(item_classes.argmax(axis=1) == true_classes)
+    n_items += ratings.n_items
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  logging.info('stochastic: accuracy {0:.4f}, peak memory {1:.1f} MB, '
+               '{2:.2f} secs'.format(n_correct / n_items, peak / 2.0**20,
+                                     time.time() - start))
+
+  tracemalloc.start()
+  start = time.time()
+  block_ratings, block_true_classes = zip(
+      *[(ratings, true_classes) for _, ratings, true_classes in blocks])
+  offsets = np.cumsum([0] + [ratings.n_items for ratings in block_ratings])
+  ratings = dawid_skene.Ratings(
+      items=np.concatenate([
+          ratings.items + offset
+          for ratings, offset in zip(block_ratings, offsets)
+      ]).astype(np.int32),
+      raters=np.concatenate([ratings.raters for ratings in block_ratings]),
+      labels=np.concatenate([ratings.labels for ratings in block_ratings]),
+      n_items=offsets[-1],
+      n_raters=block_ratings[0].n_raters,
+      n_classes=block_ratings[0].n_classes)
+  true_classes = np.concatenate(block_true_classes)
+  del block_ratings, block_true_classes
+  batch_class_marginals, batch_error_rates, item_classes, _ = dawid_skene.run(
+      None, None, None, ratings, 'label', 1.0, tol=tol, max_iter=max_iter)
+  accuracy = np.mean(item_classes.argmax(axis=1) == true_classes)
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  logging.info('batch: accuracy {0:.4f}, peak memory {1:.1f} MB, '
+               '{2:.2f} secs'.format(accuracy, peak / 2.0**20,
+                                     time.time() - start))
+  logging.info('max error rate difference: {0:.2g}'.format(
+      np.max(np.abs(error_rates - batch_error_rates))))
+
+
+def main(FLAGS):
+  logging.basicConfig(level=logging.INFO)
+
+  if FLAGS.benchmark == 'stochastic':
+    blocks = SyntheticBlocks(FLAGS.n_items // FLAGS.block_items,
+                             FLAGS.block_items, FLAGS.n_raters,
+                             FLAGS.n_classes, FLAGS.ratings_per_item,
+                             FLAGS.min_accuracy, FLAGS.max_accuracy)
+    benchmark_stochastic(blocks, FLAGS.tolerance, FLAGS.max_iter,
+                         FLAGS.epochs, FLAGS.step_decay)
+    return
+
+  ratings, _ = synthetic_ratings(FLAGS.n_items, FLAGS.n_raters,
+                                 FLAGS.n_classes, FLAGS.ratings_per_item,
+                                 FLAGS.min_accuracy, FLAGS.max_accuracy)
+  logging.info('{0} ratings of {1} items by {2} raters'.format(
+      len(ratings.items), FLAGS.n_items, FLAGS.n_raters))
+  if FLAGS.benchmark == 'accelerate':
+    benchmark_acceleration(ratings, FLAGS.tolerance, FLAGS.max_iter)
+  else:
+    benchmark_e_step(ratings, FLAGS.n_verbose_items)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--benchmark',
+      help='What to time.',
+      choices=['e_step', 'accelerate', 'stochastic'],
+      default='e_step')
+  parser.add_argument(
+      '--n-items', help='The number of items.', type=int, default=100000)
+  parser.add_argument(
+      '--n-raters', help='The number of raters.', type=int, default=200)
+  parser.add_argument(
+      '--n-classes', help='The number of classes.', type=int, default=2)
+  parser.add_argument(
+      '--ratings-per-item',
+      help='The number of raters rating each item.',
+      type=int,
+      default=10)
+  parser.add_argument(
+      '--min-accuracy',
+      help='The lowest accuracy of the raters.',
+      type=float,
+      default=0.5)
+  parser.add_argument(
+      '--max-accuracy',
+      help='The highest accuracy of the raters.',
+      type=float,
+      default=0.95)
+  parser.add_argument(
+      '--n-verbose-items',
+      help='The number of items to time e_step_verbose on.',
+      type=int,
+      default=5000)
+  parser.add_argument(
+      '--tolerance',
+      help='The relative log likelihood change of the accelerate benchmark.',
+      type=float,
+      default=1e-10)
+  parser.add_argument(
+      '--max-iter',
+      help='The max number of iterations of the accelerate benchmark.',
+      type=int,
+      default=1000)
+  parser.add_argument(
+      '--block-items',
+      help='The number of items of a block of the stochastic benchmark.',
+      type=int,
+      default=100000)
+  parser.add_argument(
+      '--epochs',
+      help='The number of passes of the stochastic benchmark.',
+      type=int,
+      default=1)
+  parser.add_argument(
+      '--step-decay',
+      help='The step size decay of the stochastic benchmark.',
+      type=float,
+      default=0.6)
+
+  main(parser.parse_args())
@@ -5,12 +5,15 @@ from __future__ import division
 from __future__ import print_function
 
 import collections
+import importlib.util
 import os
+import numpy as np
 import pandas as pd
 import tempfile
 import unittest
 
 import dawid_skene
+import dawid_skene_benchmark
 
 class DawidSkeneTest(unittest.TestCase):
 
@@ -50,31 +53,430 @@ class DawidSkeneTest(unittest.TestCase):
         ]
     })
 
+  def paper_example_data(self):
+    data = self.table_1.set_index('patient').stack().rename_axis(['patient', 'observer']).to_frame('label').reset_index()
+    data['observer'] = data['observer'].map({11:1, 12:1, 13:1, 2:2, 3:3, 4:4, 5:5})
+    return data
+
+  def flags(self, data_path, job_dir):
+    Flags = collections.namedtuple('Flags', 'n_examples label labels num_processes unit_id_col worker_id_col comment_text_path data_path pseudo_count tolerance max_iter accelerate state_dir incremental stochastic block_size epochs step_decay output_format job_dir')
+    Flags.data_path = data_path
+    Flags.label = 'label'
+    Flags.labels = ''
+    Flags.num_processes = 0
+    Flags.worker_id_col = 'observer'
+    Flags.unit_id_col = 'patient'
+    Flags.n_examples = 350
+    Flags.pseudo_count = 1.0
+    Flags.comment_text_path = None
+    Flags.max_iter = 25
+    Flags.tolerance = 1e-6
+    Flags.accelerate = False
+    Flags.state_dir = ''
+    Flags.incremental = False
+    Flags.stochastic = False
+    Flags.block_size = 1000000
+    Flags.epochs = 1
+    Flags.step_decay = 0.6
+    Flags.output_format = 'csv'
+    Flags.job_dir = job_dir
+    return Flags
+
   def test_paper_example(self):
     with tempfile.TemporaryDirectory() as tempdirname:
       f = tempfile.NamedTemporaryFile(delete=False)
       f.file.close()
-      data = self.table_1.set_index('patient').stack().rename_axis(['patient', 'observer']).to_frame('label').reset_index()
-      data['observer'] = data['observer'].map({11:1, 12:1, 13:1, 2:2, 3:3, 4:4, 5:5})
-      data.to_csv(f.name, header=True)
-
-      Flags = collections.namedtuple('Flags', 'n_examples label unit_id_col worker_id_col comment_text_path data_path pseudo_count tolerance max_iter job_dir')
-      Flags.data_path = f.name
-      Flags.label = 'label'
-      Flags.worker_id_col = 'observer'
-      Flags.unit_id_col = 'patient'
-      Flags.n_examples = 350
-      Flags.pseudo_count = 1.0
-      Flags.comment_text_path = None
-      Flags.max_iter = 25
-      Flags.tolerance = 1
-      Flags.job_dir = tempdirname
-      dawid_skene.main(Flags)
+      self.paper_example_data().to_csv(f.name, header=True)
+
+      dawid_skene.main(self.flags(f.name, tempdirname))
       os.unlink(f.name)
       predictions = pd.read_csv(os.path.join(tempdirname, 'predictions_label_315.csv'))
       print(predictions)
       error_rates = pd.read_csv(os.path.join(tempdirname, 'error_rates_label_315.csv'))
       print(error_rates)
+      trace = pd.read_csv(os.path.join(tempdirname, 'trace_label_315.csv'))
+      self.assertTrue(np.all(np.diff(trace['log_posterior']) >= 0))
+
+  def test_paper_example_incremental(self):
+    with tempfile.TemporaryDirectory() as tempdirname:
+      data = self.paper_example_data()
+      data_path = os.path.join(tempdirname, 'data.csv')
+      flags = self.flags(data_path, tempdirname)
+      flags.state_dir = tempdirname
+
+      # the last 5 patients are rated in a new batch
+      data[data['patient'] <= 40].to_csv(data_path)
+      dawid_skene.main(flags)
+      data[data['patient'] > 40].to_csv(data_path)
+      flags.incremental = True
+      dawid_skene.main(flags)
+      predictions = pd.read_csv(
+          os.path.join(tempdirname, 'predictions_label_315.csv'))
+
+      data.to_csv(data_path)
+      flags.job_dir = os.path.join(tempdirname, 'full')
+      os.mkdir(flags.job_dir)
+      flags.incremental = False
+      dawid_skene.main(flags)
+      full_predictions = pd.read_csv(
+          os.path.join(flags.job_dir, 'predictions_label_315.csv'))
+      self.assertEqual(list(predictions.columns), list(full_predictions.columns))
+      np.testing.assert_array_equal(predictions['patient'],
+                                    full_predictions['patient'])
+      np.testing.assert_allclose(predictions, full_predictions, atol=0.1)
+
+  def test_paper_example_stochastic(self):
+    with tempfile.TemporaryDirectory() as tempdirname:
+      data_path = os.path.join(tempdirname, 'data.csv')
+      self.paper_example_data().to_csv(data_path)
+      flags = self.flags(data_path, tempdirname)
+      flags.stochastic = True
+      flags.block_size = 50
+      flags.epochs = 3
+      dawid_skene.main(flags)
+      predictions = pd.read_csv(
+          os.path.join(tempdirname, 'predictions_label_315.csv'))
+      self.assertEqual(list(predictions['patient']), list(range(1, 46)))
+      self.assertEqual(list(predictions['_unit_index']), list(range(45)))
+      error_rates = pd.read_csv(
+          os.path.join(tempdirname, 'error_rates_label_315.csv'))
+      self.assertEqual(list(error_rates['n_annotations']), [135, 45, 45, 45, 45])
+
+  def test_parse_outputs(self):
+    df = pd.DataFrame({
+        'item': ['b', 'a', 'b', 'c'],
+        'rater': [7, 7, 5, 5],
+        'label': [1, 0, 0, 1]
+    })
+    item_classes = np.array([[0.25, 0.75], [0.123456789, 0.876543211],
+                             [1.0, 0.0]])
+    predictions = dawid_skene.parse_item_classes(
+        df, 'label', item_classes, pd.Index(['b', 'a', 'c']), [1, 0], 'item',
+        'rater', None)
+    self.assertEqual(list(predictions.columns), [
+        'item', 'label_mean', 'label_hat_1', 'label_hat_0', 'label_hat_mean',
+        '_unit_index'
+    ])
+    self.assertEqual(list(predictions['item']), ['a', 'b', 'c'])
+    self.assertEqual(list(predictions['_unit_index']), [1, 0, 2])
+    np.testing.assert_allclose(predictions['label_mean'], [0, 0.5, 1])
+    np.testing.assert_allclose(predictions['label_hat_1'],
+                               [0.12345679, 0.25, 1.0])
+    np.testing.assert_allclose(predictions['label_hat_mean'],
+                               [0.12345679, 0.25, 1.0])
+
+    error_rates = np.array([[[0.9, 0.1], [0.2, 0.8]], [[0.6, 0.4], [0.3, 0.7]]])
+    df_error_rates = dawid_skene.parse_error_rates(
+        df, error_rates, pd.Index([7, 5]), [1, 0], 'item', 'rater')
+    self.assertEqual(list(df_error_rates.columns), [
+        '_worker_index', 'rater', 'n_annotations', 'accuracy_rate_1',
+        'accuracy_rate_0'
+    ])
+    self.assertEqual(list(df_error_rates['rater']), [7, 5])
+    self.assertEqual(list(df_error_rates['n_annotations']), [2, 2])
+    np.testing.assert_allclose(df_error_rates['accuracy_rate_0'], [0.8, 0.7])
+
+  @unittest.skipUnless(importlib.util.find_spec('pyarrow'), 'needs pyarrow')
+  def test_parquet_outputs(self):
+    with tempfile.TemporaryDirectory() as tempdirname:
+      data_path = os.path.join(tempdirname, 'data.csv')
+      self.paper_example_data().to_csv(data_path)
+      flags = self.flags(data_path, tempdirname)
+      dawid_skene.main(flags)
+      flags.output_format = 'parquet'
+      dawid_skene.main(flags)
+      for name in ['predictions', 'error_rates']:
+        path = os.path.join(tempdirname, '{}_label_315'.format(name))
+        df_parquet = pd.read_parquet(path + '.parquet')
+        df_csv = pd.read_csv(path + '.csv')
+        self.assertEqual(list(df_parquet.columns), list(df_csv.columns))
+        np.testing.assert_allclose(df_parquet, df_csv)
+
+  def test_read_item_blocks(self):
+    with tempfile.TemporaryDirectory() as tempdirname:
+      data_path = os.path.join(tempdirname, 'data.csv')
+      pd.DataFrame({
+          'item': [1, 1, 1, 1, 2, 3, 3, 4],
+          'rater': [1, 2, 3, 4, 1, 2, 3, 4],
+          'label': [0, 1, np.nan, 1, 0, 0, 1, 1]
+      }).to_csv(data_path, index=False)
+      blocks = list(
+          dawid_skene.read_item_blocks(data_path, 'item', 'rater', 'label', 3))
+    self.assertEqual([list(block['item']) for block in blocks],
+                     [[1, 1, 1, 2], [3, 3], [4]])
+    self.assertEqual(list(blocks[0]['rater']), [1, 2, 4, 1])
+
+  def test_stochastic_run(self):
+    blocks = dawid_skene_benchmark.SyntheticBlocks(
+        n_blocks=20,
+        block_items=1000,
+        n_raters=50,
+        n_classes=3,
+        ratings_per_item=4)
+    class_marginals, error_rates, trace = dawid_skene.stochastic_run(
+        blocks, 1.0, epochs=2)
+    self.assertEqual(len(trace), 40)
+
+    ratings = [block[1] for block in blocks]
+    all_ratings = dawid_skene.Ratings(
+        items=np.concatenate(
+            [r.items + 1000 * i for i, r in enumerate(ratings)]),
+        raters=np.concatenate([r.raters for r in ratings]),
+        labels=np.concatenate([r.labels for r in ratings]),
+        n_items=20000,
+        n_raters=50,
+        n_classes=3)
+    batch_class_marginals, batch_error_rates, batch_item_classes, _ = (
+        dawid_skene.run(None, None, None, all_ratings, 'label', 1.0))
+    np.testing.assert_allclose(
+        class_marginals, batch_class_marginals, atol=0.01)
+    np.testing.assert_allclose(error_rates, batch_error_rates, atol=0.05)
+    item_classes, _ = dawid_skene.e_step(all_ratings, class_marginals,
+                                         error_rates)
+    self.assertGreater(
+        np.mean(item_classes.argmax(1) == batch_item_classes.argmax(1)), 0.99)
+
+  def test_incremental(self):
+    ratings, _ = dawid_skene_benchmark.synthetic_ratings(
+        n_items=20000, n_raters=100, n_classes=3, ratings_per_item=5)
+    _, error_rates, item_classes, _ = dawid_skene.run(
+        None, None, None, ratings, 'label', 1.0, tol=1e-10, max_iter=200)
+
+    # the ratings of the last 200 items, and the last rating of the first 200
+    # items, are new
+    old = ratings.items < 19800
+    old[4:1000:5] = False
+    old_ratings = dawid_skene.Ratings(
+        items=ratings.items[old],
+        raters=ratings.raters[old],
+        labels=ratings.labels[old],
+        n_items=19800,
+        n_raters=100,
+        n_classes=3)
+    _, _, old_item_classes, _ = dawid_skene.run(
+        None, None, None, old_ratings, 'label', 1.0, tol=1e-10, max_iter=200)
+    state = dawid_skene.initial_state(old_ratings, old_item_classes,
+                                      np.arange(19800), np.arange(100),
+                                      np.arange(3))
+    state, affected_items = dawid_skene.add_ratings(
+        state, ratings.items[~old], ratings.raters[~old],
+        ratings.labels[~old])
+    self.assertEqual(len(affected_items), 400)
+    _, incremental_error_rates, state, _ = dawid_skene.run_incremental(
+        state, affected_items, 'label', 1.0, tol=1e-10, max_iter=200)
+
+    # the other items keep their classes, which are close to a full rerun
+    np.testing.assert_allclose(incremental_error_rates, error_rates, atol=0.01)
+    np.testing.assert_allclose(state.item_classes, item_classes, atol=0.06)
+    self.assertLess(np.mean(np.abs(state.item_classes - item_classes)), 0.002)
+    class_counts, rater_counts = dawid_skene.sufficient_statistics(
+        state.ratings, state.item_classes)
+    np.testing.assert_allclose(state.class_counts, class_counts)
+    np.testing.assert_allclose(state.rater_counts, rater_counts, atol=1e-9)
+
+  def test_single_class_converges(self):
+    # Without pseudo counts, the log posterior of a single class is 0.
+    ratings, _, _ = dawid_skene.label_ratings(
+        np.array([0, 0, 1, 1, 2]), np.array([0, 1, 0, 1, 0]),
+        np.zeros(5, dtype=int), 1)
+    with np.errstate(all='raise'):
+      _, _, item_classes, trace = dawid_skene.run(None, None, None, ratings,
+                                                  'label', 0)
+      self.assertEqual(list(trace['relative_change'][1:]), [0.])
+
+      state = dawid_skene.initial_state(ratings, item_classes, np.arange(3),
+                                        np.arange(2), np.arange(1))
+      state, affected_items = dawid_skene.add_ratings(
+          state, np.array([3]), np.array([1]), np.array([0]))
+      _, _, _, trace = dawid_skene.run_incremental(state, affected_items,
+                                                   'label', 0)
+      self.assertLess(len(trace), 25)
+      self.assertEqual(trace['relative_change'].iloc[-1], 0.)
+
+  def test_state(self):
+    ratings = self.random_ratings()
+    item_classes = dawid_skene.initialize(ratings)
+    state = dawid_skene.initial_state(ratings, item_classes,
+                                      ['item{}'.format(i) for i in range(50)],
+                                      range(6), [0, 1, 2])
+    with tempfile.TemporaryDirectory() as tempdirname:
+      path = dawid_skene.state_path(tempdirname, 'label')
+      dawid_skene.save_state(path, state)
+      loaded_state = dawid_skene.load_state(path)
+    for value, loaded_value in zip(state, loaded_state):
+      if isinstance(value, dawid_skene.Ratings):
+        self.assertEqual(value[3:], loaded_value[3:])
+        value, loaded_value = value[:3], loaded_value[:3]
+      np.testing.assert_array_equal(value, loaded_value)
+
+    state, affected_items = dawid_skene.add_ratings(
+        state, np.array(['item3', 'new', 'item3']), np.array([7, 0, 0]),
+        np.array([2, 0, 1]))
+    self.assertEqual(list(affected_items), [3, 50])
+    self.assertEqual(state.ratings.n_items, 51)
+    self.assertEqual(state.ratings.n_raters, 7)
+    self.assertEqual(list(state.ratings.items[-3:]), [3, 50, 3])
+    self.assertEqual(list(state.ratings.raters[-3:]), [6, 0, 0])
+    self.assertEqual(list(state.ratings.labels[-3:]), [2, 0, 1])
+    np.testing.assert_array_equal(state.item_classes[50], [0, 0, 0])
+    with self.assertRaises(ValueError):
+      dawid_skene.add_ratings(state, np.array(['new']), np.array([0]),
+                              np.array([3]))
+
+  def random_ratings(self):
+    rng = np.random.RandomState(0)
+    items = np.repeat(np.arange(50), 3)
+    raters = np.concatenate([rng.choice(6, 3, replace=False) for _ in range(50)])
+    labels = rng.randint(3, size=150)
+    return dawid_skene.Ratings(
+        items=items.astype(np.int32),
+        raters=raters.astype(np.int32),
+        labels=labels.astype(np.int32),
+        n_items=50,
+        n_raters=6,
+        n_classes=3)
+
+  def test_factorize_ratings(self):
+    df = pd.DataFrame({
+        'item': ['b', 'a', 'b', 'c'],
+        'rater': [7, 7, 5, 5],
+        'label': [1, 0, 0, 1]
+    })
+    ratings, unit_ids, worker_ids, ys = dawid_skene.factorize_ratings(
+        df, 'item', 'rater', 'label')
+    self.assertEqual(list(ratings.items), [0, 1, 0, 2])
+    self.assertEqual(list(ratings.raters), [0, 0, 1, 1])
+    self.assertEqual(list(ratings.labels), [0, 1, 1, 0])
+    self.assertEqual((ratings.n_items, ratings.n_raters, ratings.n_classes),
+                     (3, 2, 2))
+    self.assertEqual(list(unit_ids), ['b', 'a', 'c'])
+    self.assertEqual(list(worker_ids), [7, 5])
+    self.assertEqual(list(ys), [1, 0])
+
+  def test_factorize_ratings_missing_labels(self):
+    df = pd.DataFrame({
+        'item': ['b', 'a', 'b', 'c'],
+        'rater': [7, 7, 5, 5],
+        'label': [1, np.nan, 0, 1]
+    })
+    ratings, unit_ids, worker_ids, ys = dawid_skene.factorize_ratings(
+        df, 'item', 'rater', 'label')
+    self.assertEqual(list(ratings.items), [0, 0, 1])
+    self.assertEqual(list(ratings.raters), [0, 1, 1])
+    self.assertEqual(list(ratings.labels), [0, 1, 0])
+    self.assertEqual(list(unit_ids), ['b', 'c'])
+    self.assertEqual(list(worker_ids), [7, 5])
+    self.assertEqual(list(ys), [1, 0])
+
+  def test_train_labels(self):
+    ratings = self.random_ratings()
+    rng = np.random.RandomState(1)
+    other_labels = np.where(rng.rand(len(ratings.labels)) < 0.2, -1,
+                            rng.randint(2, size=len(ratings.labels)))
+    labels = np.stack([ratings.labels, other_labels])
+    results = dawid_skene.train_labels(ratings.items, ratings.raters, labels,
+                                       [3, 2], ['a', 'b'], 1.0, 1e-6, 10,
+                                       False, 2)
+    for label, n_classes, result in zip(labels, [3, 2], results):
+      expected = dawid_skene.train_label(ratings.items, ratings.raters, label,
+                                         n_classes, 'label', 1.0, 1e-6, 10,
+                                         False)
+      for value, expected_value in zip(result[:4], expected[:4]):
+        np.testing.assert_allclose(value, expected_value)
+
+  def test_accelerate(self):
+    # Noisy raters, for which plain EM converges slowly.
+    ratings, _ = dawid_skene_benchmark.synthetic_ratings(
+        n_items=1000,
+        n_raters=30,
+        n_classes=4,
+        ratings_per_item=4,
+        min_accuracy=0.2,
+        max_accuracy=0.6)
+    results = {}
+    for accelerate in [False, True]:
+      results[accelerate] = dawid_skene.run(
+          None, None, None, ratings, 'label', 1.0, tol=1e-14, max_iter=1000,
+          accelerate=accelerate)
+      trace = results[accelerate][3]
+      self.assertLess(trace['relative_change'].iloc[-1], 1e-14)
+      self.assertTrue(np.all(np.diff(trace['log_posterior']) >= -1e-9))
+    for value, accelerated_value in zip(results[False][:3], results[True][:3]):
+      np.testing.assert_allclose(value, accelerated_value, atol=1e-4)
+    self.assertLess(results[True][3]['e_steps'].sum(),
+                    results[False][3]['e_steps'].sum() / 2)
+
+  def test_initializations(self):
+    ratings = dawid_skene.Ratings(
+        items=np.array([0, 0, 0, 1, 1], dtype=np.int32),
+        raters=np.array([0, 1, 2, 0, 1], dtype=np.int32),
+        labels=np.array([1, 1, 0, 0, 1], dtype=np.int32),
+        n_items=2,
+        n_raters=3,
+        n_classes=2)
+    np.testing.assert_allclose(
+        dawid_skene.initialize(ratings), [[1 / 3, 2 / 3], [0.5, 0.5]])
+    np.testing.assert_array_equal(
+        dawid_skene.majority_voting(ratings), [[0, 1], [1, 0]])
+    random_item_classes = dawid_skene.random_initialization(ratings)
+    np.testing.assert_array_equal(random_item_classes.sum(axis=1), [1, 1])
+
+  def test_m_step(self):
+    ratings = self.random_ratings()
+    item_classes = dawid_skene.initialize(ratings)
+    counts = dawid_skene.ratings_to_counts(ratings)
+    for psuedo_count in [0.0, 1.0]:
+      class_marginals, error_rates = dawid_skene.m_step(
+          ratings, item_classes, psuedo_count)
+      expected_class_marginals, expected_error_rates = (
+          dawid_skene.m_step_verbose(counts, item_classes, psuedo_count))
+      np.testing.assert_allclose(class_marginals, expected_class_marginals)
+      np.testing.assert_allclose(error_rates, expected_error_rates)
+
+  def test_e_step(self):
+    ratings = self.random_ratings()
+    counts = dawid_skene.ratings_to_counts(ratings)
+    class_marginals, error_rates = dawid_skene.m_step(
+        ratings, dawid_skene.initialize(ratings), 0.0)
+    # Rater 0 never gives rating 2 to items of class 1.
+    error_rates[0, 1, :] = [0.5, 0.5, 0.0]
+
+    expected = dawid_skene.e_step_verbose(counts, class_marginals, error_rates)
+    expected_log_L = dawid_skene.calc_likelihood(ratings, class_marginals,
+                                                 error_rates)
+    item_classes, log_L = dawid_skene.e_step(ratings, class_marginals,
+                                             error_rates)
+    np.testing.assert_allclose(item_classes, expected)
+    self.assertAlmostEqual(log_L, expected_log_L)
+    item_classes, log_L = dawid_skene.e_step(
+        ratings, class_marginals, error_rates, max_chunk_bytes=100)
+    np.testing.assert_allclose(item_classes, expected)
+    self.assertAlmostEqual(log_L, expected_log_L)
+
+  def test_calc_likelihood(self):
+    ratings = self.random_ratings()
+    counts = dawid_skene.ratings_to_counts(ratings)
+    class_marginals, error_rates = dawid_skene.m_step(
+        ratings, dawid_skene.initialize(ratings), 1.0)
+    expected = 0.0
+    for i in range(ratings.n_items):
+      expected += np.log(
+          np.sum(class_marginals * np.prod(
+              np.power(error_rates, counts[i, :, None, :]), axis=(0, 2))))
+    self.assertAlmostEqual(
+        dawid_skene.calc_likelihood(ratings, class_marginals, error_rates),
+        expected)
+
+  def test_e_step_impossible_item(self):
+    ratings = self.random_ratings()
+    class_marginals, error_rates = dawid_skene.m_step(
+        ratings, dawid_skene.initialize(ratings), 1.0)
+    # No rater ever gives the first rating of item 0.
+    error_rates[:, :, ratings.labels[0]] = 0
+    with self.assertRaises(FloatingPointError):
+      dawid_skene.e_step(ratings, class_marginals, error_rates)
+    with self.assertRaises(FloatingPointError):
+      dawid_skene.calc_likelihood(ratings, class_marginals, error_rates)
 
 
 if __name__ == '__main__':
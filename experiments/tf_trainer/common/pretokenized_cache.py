@@ -0,0 +1,126 @@
+# coding=utf-8
+# Copyright 2018 The Conversation-AI.github.io Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Cache of TFRecord files whose text is already converted to token indexes.
+
+Tokenizing comments with a Python tokenizer is the most expensive step of the
+TFRecordInputWithTokenizer input pipeline, and every training run over the same
+data repeats it. WriteCache tokenizes the records once: the text feature is
+replaced by a `tokens` int64 feature and a `sequence_length` feature, and the
+other features (the labels) are copied as they are.
+
+A cache is keyed by a fingerprint of the tokenization (the vocabulary and the
+tokenizer configuration, see TextPreprocessor.tokenization_fingerprint) and by
+the source files it was written from.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import hashlib
+import os
+
+import numpy as np
+import tensorflow as tf
+from tf_trainer.common import base_model
+from typing import Callable
+
+TOKENS_FEATURE = base_model.TOKENS_FEATURE_KEY
+SEQUENCE_LENGTH_FEATURE = 'sequence_length'
+
+# Written once all the shards of a cache are complete.
+_SUCCESS_FILENAME = '_SUCCESS'
+_SHARD_FILENAME = 'part-{:05d}-of-{:05d}.tfrecord'
+
+
+def CachePath(cache_dir: str, fingerprint: str, source_pattern: str,
+              text_feature: str) -> str:
+  """Returns the directory caching the files matching source_pattern.
+
+  The directory depends on the names and sizes of the source files, so that
+  a cache is not used anymore once the source files are rewritten.
+
+  Args:
+    cache_dir: Local, GCS or HDFS directory of all the caches.
+    fingerprint: The fingerprint of the tokenization.
+    source_pattern: File pattern of the source TFRecord files.
+    text_feature: Name of the tokenized feature of the source examples.
+  """
+  source_hash = hashlib.sha1(text_feature.encode('utf-8'))
+  for path in sorted(tf.gfile.Glob(source_pattern)):
+    source_hash.update('\0{}:{}'.format(
+        path, tf.gfile.Stat(path).length).encode('utf-8'))
+  return os.path.join(cache_dir, fingerprint, source_hash.hexdigest()[:16])
+
+
+def IsComplete(cache_path: str) -> bool:
+  """Whether all the shards of the cache at cache_path have been written."""
+  return tf.gfile.Exists(os.path.join(cache_path, _SUCCESS_FILENAME))
+
+
+def FilePattern(cache_path: str) -> str:
+  """File pattern of the shards of the cache at cache_path."""
+  return os.path.join(cache_path, 'part-*')
+
+
+def WriteCache(source_pattern: str, cache_path: str, text_feature: str,
+               text_to_indexes: Callable[[bytes], np.ndarray],
+               num_shards: int) -> int:
+  """Writes the tokenized copy of the files matching source_pattern.
+
+  Any previous (e.g. partially written) cache at cache_path is removed first.
+
+  Args:
+    source_pattern: File pattern of the source TFRecord files.
+    cache_path: Directory to write the cache to, see CachePath.
+    text_feature: Name of the feature of the source examples to tokenize.
+    text_to_indexes: Function converting a utf-8 encoded text to a 1-D array
+      of token indexes.
+    num_shards: Number of TFRecord files to write.
+
+  Returns:
+    The number of examples written.
+  """
+  if tf.gfile.Exists(cache_path):
+    tf.gfile.DeleteRecursively(cache_path)
+  tf.gfile.MakeDirs(cache_path)
+
+  writers = [
+      tf.python_io.TFRecordWriter(
+          os.path.join(cache_path, _SHARD_FILENAME.format(i, num_shards)))
+      for i in range(num_shards)
+  ]
+  num_examples = 0
+  try:
+    for path in sorted(tf.gfile.Glob(source_pattern)):
+      for record in tf.python_io.tf_record_iterator(path):
+        example = tf.train.Example.FromString(record)
+        feature = example.features.feature
+        if not feature[text_feature].bytes_list.value:
+          raise ValueError('Example {} of {} has no {} feature.'.format(
+              num_examples, path, text_feature))
+        tokens = text_to_indexes(feature[text_feature].bytes_list.value[0])
+        del feature[text_feature]
+        feature[TOKENS_FEATURE].int64_list.value.extend(tokens)
+        feature[SEQUENCE_LENGTH_FEATURE].int64_list.value.append(len(tokens))
+        writers[num_examples % num_shards].write(example.SerializeToString())
+        num_examples += 1
+  finally:
+    for writer in writers:
+      writer.close()
+
+  with tf.gfile.GFile(os.path.join(cache_path, _SUCCESS_FILENAME), 'w') as f:
+    f.write('{}\n'.format(num_examples))
+  return num_examples
@@ -0,0 +1,109 @@
+# coding=utf-8
+# Copyright 2018 The Conversation-AI.github.io Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tests for pretokenized_cache."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+
+import numpy as np
+import tensorflow as tf
+from tf_trainer.common import pretokenized_cache
+
+
+class PretokenizedCacheTest(tf.test.TestCase):
+
+  def setUp(self):
+    self.source_dir = self.get_temp_dir()
+    self.source_path = os.path.join(self.source_dir, 'train.tfrecord')
+    self.write_source(['Hi there Bob', 'there'])
+    self.word_to_idx = {'Hi': 12, 'there': 13}
+
+  def write_source(self, comments):
+    with tf.python_io.TFRecordWriter(self.source_path) as writer:
+      for i, comment in enumerate(comments):
+        ex = tf.train.Example(
+            features=tf.train.Features(
+                feature={
+                    'label':
+                        tf.train.Feature(
+                            float_list=tf.train.FloatList(value=[i])),
+                    'comment':
+                        tf.train.Feature(
+                            bytes_list=tf.train.BytesList(
+                                value=[comment.encode('utf-8')]))
+                }))
+        writer.write(ex.SerializeToString())
+
+  def text_to_indexes(self, text):
+    return np.asarray(
+        [self.word_to_idx.get(w, 999) for w in text.decode('utf-8').split(' ')],
+        dtype=np.int64)
+
+  def test_WriteCache(self):
+    cache_path = pretokenized_cache.CachePath(
+        os.path.join(self.source_dir, 'cache'), 'fingerprint',
+        self.source_path, 'comment')
+    self.assertFalse(pretokenized_cache.IsComplete(cache_path))
+
+    num_examples = pretokenized_cache.WriteCache(
+        self.source_path, cache_path, 'comment', self.text_to_indexes, 2)
+    self.assertEqual(num_examples, 2)
+    self.assertTrue(pretokenized_cache.IsComplete(cache_path))
+
+    examples = [
+        tf.train.Example.FromString(record)
+        for path in sorted(
+            tf.gfile.Glob(pretokenized_cache.FilePattern(cache_path)))
+        for record in tf.python_io.tf_record_iterator(path)
+    ]
+    self.assertEqual(len(examples), 2)
+    feature = examples[0].features.feature
+    self.assertCountEqual(list(feature), ['label', 'tokens', 'sequence_length'])
+    self.assertEqual(list(feature['tokens'].int64_list.value), [12, 13, 999])
+    self.assertEqual(list(feature['sequence_length'].int64_list.value), [3])
+    self.assertEqual(list(feature['label'].float_list.value), [0.0])
+    feature = examples[1].features.feature
+    self.assertEqual(list(feature['tokens'].int64_list.value), [13])
+    self.assertEqual(list(feature['label'].float_list.value), [1.0])
+
+  def test_CachePath(self):
+    cache_dir = os.path.join(self.source_dir, 'cache')
+    cache_path = pretokenized_cache.CachePath(cache_dir, 'fingerprint',
+                                              self.source_path, 'comment')
+    self.assertEqual(
+        cache_path,
+        pretokenized_cache.CachePath(cache_dir, 'fingerprint',
+                                     self.source_path, 'comment'))
+    self.assertNotEqual(
+        cache_path,
+        pretokenized_cache.CachePath(cache_dir, 'other_fingerprint',
+                                     self.source_path, 'comment'))
+    self.assertNotEqual(
+        cache_path,
+        pretokenized_cache.CachePath(cache_dir, 'fingerprint',
+                                     self.source_path, 'text'))
+
+    self.write_source(['Hi there Bob', 'there', 'Hi'])
+    self.assertNotEqual(
+        cache_path,
+        pretokenized_cache.CachePath(cache_dir, 'fingerprint',
+                                     self.source_path, 'comment'))
+
+
+if __name__ == '__main__':
+  tf.test.main()
@@ -6,6 +6,7 @@ from __future__ import print_function
 
 import tensorflow as tf
 from tensorflow.python.ops import array_ops
+from tf_trainer.common.token_embedding_index import VocabularyLookupTable
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -45,12 +46,7 @@ def create_serving_input_fn(word_to_idx,
 
     features = tf.parse_example(serialized_example, feature_spec)
 
-    keys = list(word_to_idx.keys())
-    values = list(word_to_idx.values())
-    vocabulary_table = tf.contrib.lookup.HashTable(
-        tf.contrib.lookup.KeyValueTensorInitializer(
-            keys, values, key_dtype=tf.string, value_dtype=tf.int64),
-        unknown_token)
+    vocabulary_table = VocabularyLookupTable(word_to_idx, unknown_token)
     words_int_sparse = vocabulary_table.lookup(features[text_feature_name])
     words_int_dense = tf.sparse_tensor_to_dense(
         words_int_sparse, default_value=0)
@@ -19,6 +19,8 @@ from __future__ import division
 from __future__ import print_function
 
 import functools
+import hashlib
+import weakref
 
 from absl import flags
 import numpy as np
@@ -26,12 +28,36 @@ import tensorflow as tf
 from tf_trainer.common import base_model
 from tf_trainer.common import types
 from tf_trainer.common.token_embedding_index import LoadTokenIdxEmbeddings
+from tf_trainer.common.token_embedding_index import VocabularyLookupTable
 from typing import Callable, Dict, List, Optional, Tuple
 
 FLAGS = flags.FLAGS
 
 tf.app.flags.DEFINE_bool('is_embedding_trainable', False,
                          'Enable fine tuning of embeddings.')
+tf.app.flags.DEFINE_string(
+    'embeddings_cache_dir', None,
+    'Local directory for a binary copy of the embeddings file. The copy is '
+    'written on the first run and memory-mapped by later runs.')
+tf.app.flags.DEFINE_integer(
+    'embeddings_max_vocab_size', None,
+    'If set, only load the first (most frequent) words of the embeddings file.')
+tf.app.flags.DEFINE_bool(
+    'tokenize_in_graph', False,
+    'Tokenize training text with TensorFlow string ops instead of a Python '
+    'tokenizer wrapped in tf.py_func, so that the parallel calls of the input '
+    'pipeline are not serialized by the GIL.')
+
+# Regular expressions approximating nltk.word_tokenize with TensorFlow string
+# ops: punctuation other than apostrophes becomes a token of its own, and
+# english contractions are split off the preceding word ("don't" -> "do n't").
+# RE2's \w and \s only match ASCII, so letters and digits are matched with the
+# Unicode classes \pL and \pN.
+_PUNCTUATION_REGEX = r"([^\pL\pN\s'])"
+_CONTRACTIONS_REGEX = r"(?i)([\pL\pN])(n't|'s|'re|'ve|'ll|'d|'m)\b"
+
+# Characters tokens are separated by, after applying the regular expressions.
+_WHITESPACE_CHARACTERS = ' \t\n\r'
 
 
 class TextPreprocessor(object):
@@ -43,12 +69,18 @@ class TextPreprocessor(object):
   Note: Due to the lack of text preprocessing functions in tensorflow, we expect
   that the text is already preprocessed (list of words) in inference. In
   training, due to the availability of tf.py_func, we can handle the
-  preprocessing.
+  preprocessing. Alternatively, in_graph_train_preprocess_fn tokenizes with
+  TensorFlow string ops only.
   """
 
-  def __init__(self, embeddings_path: str) -> None:
+  def __init__(self,
+               embeddings_path: str,
+               embeddings_cache_dir: Optional[str] = None,
+               max_vocab_size: Optional[int] = None) -> None:
     self._word_to_idx, self._embeddings_matrix, self._unknown_token, self._embedding_size = \
-      LoadTokenIdxEmbeddings(embeddings_path)  # type: Tuple[Dict[str, int], np.ndarray, int, int]
+      LoadTokenIdxEmbeddings(embeddings_path, embeddings_cache_dir,
+                             max_vocab_size)  # type: Tuple[Dict[str, int], np.ndarray, int, int]
+    self._vocabulary_tables = weakref.WeakKeyDictionary()
 
   def train_preprocess_fn(self,
                           tokenizer: Callable[[str], List[str]],
@@ -67,12 +99,7 @@ class TextPreprocessor(object):
         A list of strings (words).
       """
 
-      words = tokenizer(text.decode('utf-8'))
-      if lowercase:
-        words = [w.lower() for w in words]
-      return np.asarray(
-          [self._word_to_idx.get(w, self._unknown_token) for w in words],
-          dtype=np.int64)
+      return self.text_to_indexes(text, tokenizer, lowercase)
 
     def _preprocess_fn(text: types.Tensor) -> types.Tensor:
       """Converts a text into a list of integers.
@@ -89,6 +116,129 @@ class TextPreprocessor(object):
 
     return _preprocess_fn
 
+  def train_preprocess_batch_fn(
+      self,
+      tokenizer: Callable[[str], List[str]],
+      lowercase: Optional[bool] = True
+  ) -> Callable[[types.Tensor], Tuple[types.Tensor, types.Tensor]]:
+    """Returns a preprocess fn which tokenizes a batch of texts at once.
+
+    Equivalent to train_preprocess_fn, except that a whole batch is converted
+    by a single tf.py_func call, amortizing the cost of the call over the
+    batch.
+    """
+
+    def _tokenize_batch(texts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+      """Converts texts to a padded matrix of token indexes and lengths."""
+      token_lists = [
+          self.text_to_indexes(text, tokenizer, lowercase) for text in texts
+      ]
+      lengths = np.asarray([len(tokens) for tokens in token_lists],
+                           dtype=np.int32)
+      padded_tokens = np.zeros(
+          (len(token_lists), lengths.max() if len(lengths) else 0),
+          dtype=np.int64)
+      for i, tokens in enumerate(token_lists):
+        padded_tokens[i, :len(tokens)] = tokens
+      return padded_tokens, lengths
+
+    def _preprocess_batch_fn(
+        texts: types.Tensor) -> Tuple[types.Tensor, types.Tensor]:
+      """Converts texts into lists of integers.
+
+      Args:
+        texts: a 1-D string Tensor.
+
+      Returns:
+        A tuple of a 2-D int64 Tensor of token indexes, padded with 0, and a
+        1-D int32 Tensor of the number of tokens of each text.
+      """
+      tokens, lengths = tf.py_func(
+          _tokenize_batch, [texts], [tf.int64, tf.int32],
+          stateful=False,
+          name='PreprocessBatchFn')
+      tokens.set_shape([None, None])
+      lengths.set_shape([None])
+      return tokens, lengths
+
+    return _preprocess_batch_fn
+
+  def text_to_indexes(self, text: bytes, tokenizer: Callable[[str], List[str]],
+                      lowercase: bool) -> np.ndarray:
+    """Tokenizes text with a Python tokenizer and maps words to indexes."""
+    words = tokenizer(text.decode('utf-8'))
+    if lowercase:
+      words = [w.lower() for w in words]
+    return np.asarray(
+        [self._word_to_idx.get(w, self._unknown_token) for w in words],
+        dtype=np.int64)
+
+  def tokenization_fingerprint(self,
+                               tokenizer: Callable[[str], List[str]],
+                               lowercase: Optional[bool] = True) -> str:
+    """Returns a hash identifying the tokens of train_preprocess_fn.
+
+    Preprocessors with the same fingerprint map texts to the same token
+    indexes, so the tokens computed by one of them can be reused by the others
+    (see pretokenized_cache). The tokenizer is identified by its name only.
+    """
+    fingerprint = hashlib.sha1('{}.{}:{}:{}\n'.format(
+        tokenizer.__module__, getattr(tokenizer, '__qualname__',
+                                      type(tokenizer).__name__), lowercase,
+        self._unknown_token).encode('utf-8'))
+    fingerprint.update('\n'.join(
+        '{} {}'.format(word, idx)
+        for word, idx in self._word_to_idx.items()).encode('utf-8'))
+    return fingerprint.hexdigest()[:16]
+
+  def in_graph_train_preprocess_fn(self, lowercase: Optional[bool] = True
+                                  ) -> Callable[[types.Tensor], types.Tensor]:
+    """Returns a preprocess fn which tokenizes with TensorFlow string ops.
+
+    Unlike train_preprocess_fn, which runs a Python tokenizer through
+    tf.py_func, the returned fn does not hold the GIL, so the examples of a
+    parallel dataset map are tokenized concurrently. The text is split on
+    whitespace after separating punctuation and contractions (see
+    _PUNCTUATION_REGEX), which approximates nltk.word_tokenize. Tokens are then
+    mapped to indexes with the same lookup table as
+    serving_input.create_serving_input_fn.
+
+    Args:
+      lowercase: whether to include lowercasing in preprocessing (boolean).
+    """
+
+    def _preprocess_fn(text: types.Tensor) -> types.Tensor:
+      """Converts a text into a list of integers.
+
+      Args:
+        text: a 0-D string Tensor.
+
+      Returns:
+        A 1-D int64 Tensor.
+      """
+      if lowercase:
+        text = tf.strings.lower(text, encoding='utf-8')
+      text = tf.strings.regex_replace(text, _PUNCTUATION_REGEX, r' \1 ')
+      text = tf.strings.regex_replace(text, _CONTRACTIONS_REGEX, r'\1 \2')
+      words = tf.string_split([text], delimiter=_WHITESPACE_CHARACTERS).values
+      return self._vocabulary_table().lookup(words)
+
+    return _preprocess_fn
+
+  def _vocabulary_table(self) -> tf.contrib.lookup.HashTable:
+    """Returns the vocabulary lookup table of the current graph.
+
+    The table is created once per graph. It is created outside of the dataset
+    function being traced, if any, as tf.data does not support creating tables
+    inside the function passed to Dataset.map().
+    """
+    with tf.init_scope():
+      graph = tf.get_default_graph()
+      if graph not in self._vocabulary_tables:
+        self._vocabulary_tables[graph] = VocabularyLookupTable(
+            self._word_to_idx, self._unknown_token)
+      return self._vocabulary_tables[graph]
+
   def add_embedding_to_model(self, model: base_model.BaseModel,
                              text_feature_name: str) -> base_model.BaseModel:
     """Returns a new BaseModel with an embedding layer prepended.
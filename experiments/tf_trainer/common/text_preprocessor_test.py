@@ -18,6 +18,11 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import multiprocessing
+import os
+import time
+
+from nltk.tokenize import treebank
 import tensorflow as tf
 from tf_trainer.common import text_preprocessor
 
@@ -42,6 +47,127 @@ class TextPreprocessorTest(tf.test.TestCase):
       tokens = preprocess_fn('Dogs GOOD Cats BAD rabbits not')
       self.assertEqual(list(tokens.eval()), [1, 3, 2, 4, 7, 6])
 
+  def test_TokenizationFingerprint(self):
+    preprocessor = text_preprocessor.TextPreprocessor(
+        'testdata/cats_and_dogs_onehot.vocab.txt')
+    other_preprocessor = text_preprocessor.TextPreprocessor(
+        'testdata/cats_and_dogs_onehot.vocab.txt')
+    small_preprocessor = text_preprocessor.TextPreprocessor(
+        'testdata/cats_and_dogs_onehot.vocab.txt', max_vocab_size=3)
+    tokenizer = treebank.TreebankWordTokenizer().tokenize
+    fingerprint = preprocessor.tokenization_fingerprint(tokenizer)
+    self.assertEqual(fingerprint,
+                     other_preprocessor.tokenization_fingerprint(tokenizer))
+    self.assertNotEqual(
+        fingerprint,
+        preprocessor.tokenization_fingerprint(tokenizer, lowercase=False))
+    self.assertNotEqual(fingerprint,
+                        preprocessor.tokenization_fingerprint(str.split))
+    self.assertNotEqual(fingerprint,
+                        small_preprocessor.tokenization_fingerprint(tokenizer))
+
+  def test_InGraphTokenize(self):
+    preprocessor = text_preprocessor.TextPreprocessor(
+        'testdata/cats_and_dogs_onehot.vocab.txt')
+    with self.test_session() as session:
+      preprocess_fn = preprocessor.in_graph_train_preprocess_fn(
+          lowercase=False)
+      tokens = preprocess_fn('dogs good,cats  Bad rabbits\tnot')
+      session.run(tf.tables_initializer())
+      self.assertEqual(list(tokens.eval()), [1, 3, 7, 2, 7, 7, 6])
+
+  def test_InGraphLowercase(self):
+    preprocessor = text_preprocessor.TextPreprocessor(
+        'testdata/cats_and_dogs_onehot.vocab.txt')
+    with self.test_session() as session:
+      preprocess_fn = preprocessor.in_graph_train_preprocess_fn(
+          lowercase=True)
+      tokens = preprocess_fn('Dogs GOOD Cats BAD rabbits not')
+      session.run(tf.tables_initializer())
+      self.assertEqual(list(tokens.eval()), [1, 3, 2, 4, 7, 6])
+
+  def test_InGraphNonAsciiMatchesPyFunc(self):
+    vocab_path = os.path.join(self.get_temp_dir(), 'non_ascii.vocab.txt')
+    with open(vocab_path, 'w', encoding='utf-8') as f:
+      for i, word in enumerate(['café', 'élan', 'naïve', 'über', ',', '!']):
+        f.write('{} {}\n'.format(word, ' '.join(
+            '1.0' if j == i else '0.0' for j in range(6))))
+    preprocessor = text_preprocessor.TextPreprocessor(vocab_path)
+    text = 'CAFÉ Élan, naïve ÜBER straße!'
+    with self.test_session() as session:
+      in_graph_tokens = preprocessor.in_graph_train_preprocess_fn(
+          lowercase=True)(text)
+      py_func_tokens = preprocessor.train_preprocess_fn(
+          treebank.TreebankWordTokenizer().tokenize, lowercase=True)(text)
+      session.run(tf.tables_initializer())
+      in_graph_tokens, py_func_tokens = session.run(
+          [in_graph_tokens, py_func_tokens])
+      self.assertEqual(list(in_graph_tokens), [1, 2, 5, 3, 4, 7, 6])
+      self.assertEqual(list(in_graph_tokens), list(py_func_tokens))
+
+  def test_InGraphTokenizeInDatasetMap(self):
+    preprocessor = text_preprocessor.TextPreprocessor(
+        'testdata/cats_and_dogs_onehot.vocab.txt')
+    with self.test_session() as session:
+      preprocess_fn = preprocessor.in_graph_train_preprocess_fn()
+      dataset = tf.data.Dataset.from_tensor_slices(
+          ['Dogs and cats', "Rabbits aren't good!"]).map(preprocess_fn)
+      iterator = dataset.make_initializable_iterator()
+      next_tokens = iterator.get_next()
+      session.run([tf.tables_initializer(), iterator.initializer])
+      self.assertEqual(list(session.run(next_tokens)), [1, 5, 2])
+      self.assertEqual(list(session.run(next_tokens)), [7, 7, 7, 3, 7])
+
+
+class TextPreprocessorBenchmark(tf.test.Benchmark):
+  """Compares the throughput of the py_func and in-graph tokenizers.
+
+  Run with:
+    python -m tf_trainer.common.text_preprocessor_test --benchmarks=.
+  """
+
+  _NUM_EXAMPLES = 20000
+  _BATCH_SIZE = 100
+  _TEXT = ('Dogs are GOOD, cats are not bad; and rabbits? '
+           "They don't care. ") * 10
+
+  def _benchmark_preprocess_fn(self, name, preprocess_fn, num_parallel_calls):
+    with tf.Graph().as_default():
+      dataset = tf.data.Dataset.from_tensors(self._TEXT).repeat(
+          self._NUM_EXAMPLES).map(
+              preprocess_fn, num_parallel_calls=num_parallel_calls).batch(
+                  self._BATCH_SIZE)
+      iterator = dataset.make_initializable_iterator()
+      next_tokens = iterator.get_next()
+      with tf.Session() as session:
+        session.run([tf.tables_initializer(), iterator.initializer])
+        start = time.time()
+        for _ in range(self._NUM_EXAMPLES // self._BATCH_SIZE):
+          session.run(next_tokens)
+        wall_time = time.time() - start
+    examples_per_sec = self._NUM_EXAMPLES / wall_time
+    self.report_benchmark(
+        name='{}_{}_calls'.format(name, num_parallel_calls),
+        iters=self._NUM_EXAMPLES,
+        wall_time=wall_time,
+        extras={
+            'examples_per_sec': examples_per_sec,
+            'examples_per_sec_per_core': examples_per_sec / num_parallel_calls
+        })
+
+  def benchmark_tokenizers(self):
+    preprocessor = text_preprocessor.TextPreprocessor(
+        'testdata/cats_and_dogs_onehot.vocab.txt')
+    # TreebankWordTokenizer is what nltk.word_tokenize uses for each sentence.
+    py_func_preprocess_fn = preprocessor.train_preprocess_fn(
+        treebank.TreebankWordTokenizer().tokenize)
+    in_graph_preprocess_fn = preprocessor.in_graph_train_preprocess_fn()
+    for num_parallel_calls in [1, multiprocessing.cpu_count()]:
+      self._benchmark_preprocess_fn('py_func', py_func_preprocess_fn,
+                                    num_parallel_calls)
+      self._benchmark_preprocess_fn('in_graph', in_graph_preprocess_fn,
+                                    num_parallel_calls)
+
 
 if __name__ == '__main__':
   tf.test.main()
@@ -5,11 +5,13 @@ from __future__ import division
 from __future__ import print_function
 
 import multiprocessing
+import numpy as np
 import tensorflow as tf
-from typing import Callable, List, Dict, Tuple
+from typing import Callable, List, Dict, Optional, Tuple
 
 from tf_trainer.common import base_model
 from tf_trainer.common import dataset_input
+from tf_trainer.common import pretokenized_cache
 from tf_trainer.common import types
 
 tf.app.flags.DEFINE_string('train_path', None,
@@ -32,6 +34,63 @@ tf.app.flags.DEFINE_integer(
   'num_prefetch', 5,
   'An optimization parameter for the number of elements to prefetch. See: '
   'https://www.tensorflow.org/api_docs/python/tf/data/Dataset#prefetch')
+tf.app.flags.DEFINE_integer(
+    'read_cycle_length', 1,
+    'Number of input files read concurrently, with their records interleaved. '
+    'Files are read one after the other if 1.')
+tf.app.flags.DEFINE_integer(
+    'read_block_length', 1,
+    'Number of consecutive records taken from each file when several files '
+    'are read concurrently.')
+tf.app.flags.DEFINE_bool(
+    'read_sloppy', False,
+    'When several files are read concurrently, take records from whichever '
+    'file is ready instead of following a deterministic order.')
+tf.app.flags.DEFINE_integer(
+    'read_buffer_size', None,
+    'Size in bytes of the read buffer of each input file. Uses the TensorFlow '
+    'default if unset.')
+tf.app.flags.DEFINE_bool(
+    'batch_before_parse', False,
+    'Make TFRecordInput batch the serialized records first and parse each '
+    'batch with a single tf.parse_example, instead of parsing records one by '
+    'one.')
+tf.app.flags.DEFINE_string(
+    'bucket_boundaries', None,
+    'Comma separated, increasing sequence lengths separating the buckets of '
+    'examples of similar lengths which TFRecordInputWithTokenizer batches '
+    'together. Defaults to multiples of 20 up to 200.')
+tf.app.flags.DEFINE_integer(
+    'length_quantile_buckets', 0,
+    'If positive, TFRecordInputWithTokenizer ignores bucket_boundaries and '
+    'splits examples into this many buckets of about the same number of '
+    'examples, from the lengths of the first length_sample_size examples of '
+    'each input.')
+tf.app.flags.DEFINE_integer(
+    'length_sample_size', 10000,
+    'Number of examples whose lengths are sampled to compute the boundaries '
+    'of length_quantile_buckets.')
+tf.app.flags.DEFINE_integer(
+    'bucket_tokens_per_batch', 0,
+    'If positive, the batch size of each bucket of TFRecordInputWithTokenizer '
+    'is this number of tokens divided by the longest sequence length of the '
+    'bucket, instead of batch_size.')
+tf.app.flags.DEFINE_integer(
+    'max_tokens_per_batch', 0,
+    'If positive, TFRecordInputWithTokenizer ignores batch_size and the other '
+    'bucket flags, and batches examples into many narrow buckets of lengths, '
+    'with batch sizes such that batches have at most about this number of '
+    'tokens, padding included.')
+tf.app.flags.DEFINE_integer(
+    'tokenize_batch_size', 0,
+    'If positive, TFRecordInputWithTokenizer parses and tokenizes records in '
+    'batches of this size, with a single tf.py_func call per batch, when it '
+    'is given a train_preprocess_batch_fn.')
+tf.app.flags.DEFINE_string(
+    'pretokenized_cache_dir', None,
+    'Directory of the TFRecord files tokenized by '
+    'tools/pretokenize_tfrecords.py. TFRecordInputWithTokenizer reads them '
+    'instead of tokenizing its input when they match the tokenization.')
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -39,6 +98,13 @@ DTYPE_MAPPING = {'float': tf.float32, 'int': tf.int64}
 
 DTYPE_DEFAULT = {'float': -1.0, 'int': -1}
 
+DEFAULT_BUCKET_BOUNDARIES = [(i + 1) * 20 for i in range(10)]
+
+# Smallest bucket boundary and ratio of consecutive bucket boundaries for
+# FLAGS.max_tokens_per_batch.
+_MIN_TOKEN_BUDGET_BOUNDARY = 8
+_TOKEN_BUDGET_BOUNDARY_SCALE = 1.1
+
 
 class TFRecordInput(dataset_input.DatasetInput):
   """Simple no-preprocessing TFRecord based DatasetInput.
@@ -60,6 +126,11 @@ class TFRecordInput(dataset_input.DatasetInput):
     self._num_prefetch = FLAGS.num_prefetch
     self._text_feature = FLAGS.text_feature
     self._round_labels = FLAGS.round_labels
+    self._read_cycle_length = FLAGS.read_cycle_length
+    self._read_block_length = FLAGS.read_block_length
+    self._read_sloppy = FLAGS.read_sloppy
+    self._read_buffer_size = FLAGS.read_buffer_size
+    self._batch_before_parse = FLAGS.batch_before_parse
 
   def labels(self) -> List[str]:
     """List of the names of the float label features."""
@@ -91,13 +162,37 @@ class TFRecordInput(dataset_input.DatasetInput):
                                                    DTYPE_DEFAULT[dtype])
     return keys_to_features
 
-  def _input_fn_from_file(self, filepath: str) -> tf.data.TFRecordDataset:
+  def _read_tfrecord_files(self, filepath: str) -> tf.data.Dataset:
+    """Dataset of the serialized records of the files matching filepath.
+
+    With FLAGS.read_cycle_length > 1, that many files are read concurrently
+    and their records are interleaved, FLAGS.read_block_length records at a
+    time.
+    """
     filenames_dataset = tf.data.Dataset.list_files(filepath)
-    dataset = tf.data.TFRecordDataset(
-        filenames_dataset)  # type: tf.data.TFRecordDataset
-    parsed_dataset = dataset.map(
-        self._read_tf_example, num_parallel_calls=multiprocessing.cpu_count())
-    return parsed_dataset.batch(self._batch_size).prefetch(self._num_prefetch)
+    if self._read_cycle_length <= 1:
+      return tf.data.TFRecordDataset(
+          filenames_dataset, buffer_size=self._read_buffer_size)
+    return filenames_dataset.apply(
+        tf.contrib.data.parallel_interleave(
+            lambda filename: tf.data.TFRecordDataset(
+                filename, buffer_size=self._read_buffer_size),
+            cycle_length=self._read_cycle_length,
+            block_length=self._read_block_length,
+            sloppy=self._read_sloppy))
+
+  def _input_fn_from_file(self, filepath: str) -> tf.data.TFRecordDataset:
+    dataset = self._read_tfrecord_files(filepath)
+    if self._batch_before_parse:
+      batched_dataset = dataset.batch(self._batch_size).map(
+          self._read_tf_example_batch,
+          num_parallel_calls=multiprocessing.cpu_count())
+    else:
+      batched_dataset = dataset.map(
+          self._read_tf_example,
+          num_parallel_calls=multiprocessing.cpu_count()).batch(
+              self._batch_size)
+    return batched_dataset.prefetch(self._num_prefetch)
 
   def _process_labels(self, features, parsed):
     """Applies rounding and computes weights tied to feature presence.
@@ -107,7 +202,8 @@ class TFRecordInput(dataset_input.DatasetInput):
     label name, suffixed by '_weight' will be added to the features
     with a value of 1.0 is present, and 0.0 if absent. The label
     value is rounded up or down (if enabled) and then mapped to
-    zero if missing.
+    zero if missing. All operations are element-wise, so the features
+    and labels can be those of a single example or of a batch.
 
     Args:
         features: the input features read from a TF Example.
@@ -144,6 +240,20 @@ class TFRecordInput(dataset_input.DatasetInput):
     features = {base_model.TEXT_FEATURE_KEY: parsed[self._text_feature]}
     return self._process_labels(features, parsed)
 
+  def _read_tf_example_batch(
+      self,
+      records: tf.Tensor,
+  ) -> types.FeatureAndLabelTensors:
+    """Parses a batch of TF Example protobufs into text features and labels.
+
+    Same as _read_tf_example, for a 1-D Tensor of records.
+    """
+    parsed = tf.parse_example(
+        records, self._keys_to_features())  # type: Dict[str, types.Tensor]
+
+    features = {base_model.TEXT_FEATURE_KEY: parsed[self._text_feature]}
+    return self._process_labels(features, parsed)
+
 
 class TFRecordInputWithTokenizer(TFRecordInput):
   """TFRecord based DatasetInput.
@@ -155,26 +265,128 @@ class TFRecordInputWithTokenizer(TFRecordInput):
   as a new key in the output changing both the type and contents - from
   a string to a tensor of in integers representing tokens of some kind.
   TODO: preserve the original string and write a new key.
+
+  If a train_preprocess_batch_fn is given and FLAGS.tokenize_batch_size is
+  positive, records are parsed and tokenized a batch at a time, and then split
+  back into examples before being bucketed by length.
+
+  If a pretokenized_fingerprint is given and FLAGS.pretokenized_cache_dir
+  contains a copy of the input files tokenized with the same fingerprint (see
+  pretokenized_cache), the copy is read instead and nothing is tokenized.
+
+  Examples are batched with examples of similar lengths, to limit padding. The
+  buckets of lengths are given by FLAGS.bucket_boundaries, or computed from a
+  sample of the input with FLAGS.length_quantile_buckets. With
+  FLAGS.max_tokens_per_batch, batches have a number of tokens rather than a
+  number of examples, so short comments make large batches.
   """
 
   def __init__(self,
                train_preprocess_fn: Callable[[str], List[str]],
-               max_seq_len: int = 30000) -> None:
+               max_seq_len: int = 30000,
+               train_preprocess_batch_fn: Optional[Callable[
+                   [types.Tensor], Tuple[types.Tensor, types.Tensor]]] = None,
+               pretokenized_fingerprint: Optional[str] = None) -> None:
     super().__init__()
     self._train_preprocess_fn = train_preprocess_fn
     self._max_seq_len = max_seq_len
+    self._train_preprocess_batch_fn = train_preprocess_batch_fn
+    self._tokenize_batch_size = FLAGS.tokenize_batch_size
+    self._pretokenized_fingerprint = pretokenized_fingerprint
+    self._pretokenized_cache_dir = FLAGS.pretokenized_cache_dir
+    if FLAGS.bucket_boundaries:
+      self._bucket_boundaries = [
+          int(b) for b in FLAGS.bucket_boundaries.split(',')
+      ]
+    else:
+      self._bucket_boundaries = DEFAULT_BUCKET_BOUNDARIES
+    self._length_quantile_buckets = FLAGS.length_quantile_buckets
+    self._length_sample_size = FLAGS.length_sample_size
+    self._bucket_tokens_per_batch = FLAGS.bucket_tokens_per_batch
+    self._max_tokens_per_batch = FLAGS.max_tokens_per_batch
+    # Bucket boundaries sampled from each input file pattern.
+    self._sampled_bucket_boundaries = {}  # type: Dict[str, List[int]]
 
   def _input_fn_from_file(self, filepath: str) -> types.FeatureAndLabelTensors:
+    return self._batch_by_sequence_length(
+        self._parsed_dataset(filepath), filepath)
 
-    filenames_dataset = tf.data.Dataset.list_files(filepath)
-    dataset = tf.data.TFRecordDataset(
-        filenames_dataset)  # type: tf.data.TFRecordDataset
-
-    parsed_dataset = dataset.map(
-        self._read_tf_example, num_parallel_calls=multiprocessing.cpu_count())
-    parsed_dataset = parsed_dataset.filter(lambda x, _: tf.less(
+  def _parsed_dataset(self, filepath: str) -> tf.data.Dataset:
+    """Dataset of the tokenized examples of filepath, up to max_seq_len."""
+    return self._tokenized_dataset(filepath).filter(lambda x, _: tf.less(
         x['sequence_length'], self._max_seq_len))
 
+  def _tokenized_dataset(self, filepath: str) -> tf.data.Dataset:
+    pretokenized_pattern = self._pretokenized_file_pattern(filepath)
+    if pretokenized_pattern:
+      return self._read_pretokenized_files(pretokenized_pattern)
+    return self._read_and_tokenize_files(filepath)
+
+  def _pretokenized_file_pattern(self, filepath: str) -> Optional[str]:
+    """Returns the pattern of the pre-tokenized copy of filepath, if any."""
+    if not (self._pretokenized_cache_dir and self._pretokenized_fingerprint):
+      return None
+    cache_path = pretokenized_cache.CachePath(self._pretokenized_cache_dir,
+                                              self._pretokenized_fingerprint,
+                                              filepath, self._text_feature)
+    if not pretokenized_cache.IsComplete(cache_path):
+      tf.logging.info('No pre-tokenized copy of %s at %s, tokenizing it.',
+                      filepath, cache_path)
+      return None
+    tf.logging.info('Reading pre-tokenized copy of %s from %s.', filepath,
+                    cache_path)
+    return pretokenized_cache.FilePattern(cache_path)
+
+  def _read_pretokenized_files(self, filepath: str) -> tf.data.Dataset:
+    dataset = self._read_tfrecord_files(filepath)
+    return dataset.map(
+        self._read_pretokenized_tf_example,
+        num_parallel_calls=multiprocessing.cpu_count())
+
+  def _read_and_tokenize_files(self, filepath: str) -> tf.data.Dataset:
+    dataset = self._read_tfrecord_files(filepath)
+
+    if self._train_preprocess_batch_fn and self._tokenize_batch_size > 0:
+      parsed_dataset = dataset.batch(self._tokenize_batch_size).map(
+          self._read_tf_example_batch,
+          num_parallel_calls=multiprocessing.cpu_count())
+      parsed_dataset = parsed_dataset.apply(
+          tf.contrib.data.unbatch()).map(self._remove_padding)
+    else:
+      parsed_dataset = dataset.map(
+          self._read_tf_example,
+          num_parallel_calls=multiprocessing.cpu_count())
+    return parsed_dataset
+
+  def _batch_by_sequence_length(self, parsed_dataset: tf.data.Dataset,
+                                filepath: str) -> tf.data.Dataset:
+    """Batches the examples of filepath with examples of similar lengths."""
+    tokens_per_batch = self._bucket_tokens_per_batch
+    if self._max_tokens_per_batch > 0:
+      bucket_boundaries = _geometric_bucket_boundaries(
+          _MIN_TOKEN_BUDGET_BOUNDARY, self._max_seq_len,
+          _TOKEN_BUDGET_BOUNDARY_SCALE)
+      max_length = self._max_seq_len
+      tokens_per_batch = self._max_tokens_per_batch
+    elif self._length_quantile_buckets > 0:
+      if filepath not in self._sampled_bucket_boundaries:
+        self._sampled_bucket_boundaries[filepath] = (
+            self._sample_bucket_boundaries(filepath))
+      bucket_boundaries = self._sampled_bucket_boundaries[filepath]
+      max_length = self._max_seq_len
+    else:
+      bucket_boundaries, max_length = self._bucket_boundaries, self._max_seq_len
+
+    if tokens_per_batch > 0:
+      bucket_batch_sizes = [
+          max(1, tokens_per_batch // length)
+          for length in bucket_boundaries + [max_length]
+      ]
+    else:
+      bucket_batch_sizes = [self._batch_size] * (len(bucket_boundaries) + 1)
+    tf.logging.info('Batching %s by lengths %s with batch sizes %s.', filepath,
+                    bucket_boundaries, bucket_batch_sizes)
+
     feature_shapes = {
         base_model.TOKENS_FEATURE_KEY: [None],
         'sequence_length': []
@@ -188,12 +400,35 @@ class TFRecordInputWithTokenizer(TFRecordInput):
     parsed_dataset = parsed_dataset.apply(
         tf.contrib.data.bucket_by_sequence_length(
             element_length_func=lambda x, _: x['sequence_length'],
-            bucket_boundaries=[(i + 1) * 20 for i in range(10)],
-            bucket_batch_sizes=[self._batch_size] * 11,
+            bucket_boundaries=bucket_boundaries,
+            bucket_batch_sizes=bucket_batch_sizes,
             padded_shapes=padded_shapes))
     batched_dataset = parsed_dataset.prefetch(self._num_prefetch)
     return batched_dataset
 
+  def _sample_bucket_boundaries(self, filepath: str) -> List[int]:
+    """Computes quantile bucket boundaries from the lengths of a sample.
+
+    The last boundary is one past the longest sampled length, so the longer
+    examples the sample missed go to a last bucket of lengths up to
+    max_seq_len, whose batches are sized for max_seq_len.
+    """
+    with tf.Graph().as_default():
+      lengths_dataset = self._parsed_dataset(filepath).map(
+          lambda x, _: x['sequence_length']).take(
+              self._length_sample_size).batch(self._length_sample_size)
+      iterator = lengths_dataset.make_initializable_iterator()
+      next_lengths = iterator.get_next()
+      with tf.Session() as session:
+        session.run([tf.tables_initializer(), iterator.initializer])
+        lengths = session.run(next_lengths)
+    boundaries = _quantile_bucket_boundaries(lengths,
+                                             self._length_quantile_buckets)
+    longest_boundary = int(lengths.max()) + 1
+    if not boundaries or boundaries[-1] < longest_boundary:
+      boundaries.append(longest_boundary)
+    return boundaries
+
   def _read_tf_example(
       self,
       record: tf.Tensor,
@@ -213,3 +448,103 @@ class TFRecordInputWithTokenizer(TFRecordInput):
         'sequence_length': tf.shape(tokens)[0],
     }
     return self._process_labels(features, parsed)
+
+  def _read_pretokenized_tf_example(
+      self,
+      record: tf.Tensor,
+  ) -> types.FeatureAndLabelTensors:
+    """Parses a TF Example protobuf written by pretokenized_cache.WriteCache."""
+    keys_to_features = self._keys_to_features()
+    del keys_to_features[self.text_feature()]
+    keys_to_features[pretokenized_cache.TOKENS_FEATURE] = tf.VarLenFeature(
+        tf.int64)
+    keys_to_features[pretokenized_cache.SEQUENCE_LENGTH_FEATURE] = (
+        tf.FixedLenFeature([], tf.int64))
+    parsed = tf.parse_single_example(
+        record, keys_to_features)  # type: Dict[str, types.Tensor]
+
+    features = {
+        base_model.TOKENS_FEATURE_KEY:
+            tf.sparse.to_dense(parsed[pretokenized_cache.TOKENS_FEATURE]),
+        'sequence_length':
+            tf.cast(parsed[pretokenized_cache.SEQUENCE_LENGTH_FEATURE],
+                    tf.int32),
+    }
+    return self._process_labels(features, parsed)
+
+  def _read_tf_example_batch(
+      self,
+      records: tf.Tensor,
+  ) -> types.FeatureAndLabelTensors:
+    """Parses a batch of TF Example protobufs into text features and labels.
+
+    Same as _read_tf_example, for a 1-D Tensor of records. The tokens of the
+    batch are padded with 0 to the length of the longest text.
+    """
+    parsed = tf.parse_example(
+        records, self._keys_to_features())  # type: Dict[str, types.Tensor]
+
+    text = parsed[self.text_feature()]
+    tokens, sequence_length = self._train_preprocess_batch_fn(text)
+    features = {
+        base_model.TOKENS_FEATURE_KEY: tokens,
+        'sequence_length': sequence_length,
+    }
+    return self._process_labels(features, parsed)
+
+  def _remove_padding(self, features: types.TensorDict,
+                      labels: types.TensorDict) -> types.FeatureAndLabelTensors:
+    """Trims the batch padding off the tokens of an unbatched example."""
+    new_features = {k: v for k, v in features.items()}
+    new_features[base_model.TOKENS_FEATURE_KEY] = features[
+        base_model.TOKENS_FEATURE_KEY][:features['sequence_length']]
+    return new_features, labels
+
+
+class PreTokenizedTFRecordInput(TFRecordInputWithTokenizer):
+  """TFRecord based DatasetInput for examples which are already tokenized.
+
+  Reads the TFRecord files written by pretokenized_cache.WriteCache (e.g. with
+  tools/pretokenize_tfrecords.py): train_path and validate_path are the file
+  patterns of the tokenized files, with a `tokens` int64 feature instead of the
+  text feature.
+  """
+
+  def __init__(self, max_seq_len: int = 30000) -> None:
+    super().__init__(train_preprocess_fn=None, max_seq_len=max_seq_len)
+
+  def _tokenized_dataset(self, filepath: str) -> tf.data.Dataset:
+    return self._read_pretokenized_files(filepath)
+
+
+def _quantile_bucket_boundaries(lengths: np.ndarray,
+                                num_buckets: int) -> List[int]:
+  """Boundaries splitting lengths into num_buckets buckets of similar sizes.
+
+  Buckets of lengths [boundary_i-1, boundary_i), as in
+  tf.contrib.data.bucket_by_sequence_length. Duplicate boundaries, e.g. when
+  many lengths are equal, are merged so there can be fewer buckets.
+
+  Raises:
+    ValueError: if num_buckets is less than 2.
+  """
+  if num_buckets < 2:
+    raise ValueError(
+        'Quantile buckets need at least 2 buckets, got {}.'.format(num_buckets))
+  quantiles = np.percentile(lengths, np.linspace(0, 100, num_buckets + 1)[1:-1])
+  return sorted(set(int(np.ceil(q)) + 1 for q in quantiles))
+
+
+def _geometric_bucket_boundaries(min_length: int, max_length: int,
+                                 scale: float) -> List[int]:
+  """Boundaries from min_length to max_length, growing by a scale factor.
+
+  The buckets are narrow relative to their lengths, so batches of any bucket
+  are padded by at most about (scale - 1) of their tokens.
+  """
+  boundaries = []
+  boundary = min_length
+  while boundary < max_length:
+    boundaries.append(boundary)
+    boundary = max(boundary + 1, int(boundary * scale))
+  return boundaries
@@ -18,10 +18,16 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import tempfile
+import time
+
 import numpy as np
 import tensorflow as tf
+from nltk.tokenize import treebank
 
 from tf_trainer.common import base_model
+from tf_trainer.common import text_preprocessor
 from tf_trainer.common import tfrecord_input
 from tf_trainer.common import types
 
@@ -93,6 +99,54 @@ class TFRecordInputTest(tf.test.TestCase):
       np.testing.assert_almost_equal(labels['label'].eval(), 1.0)
       np.testing.assert_almost_equal(features['label_weight'].eval(), 1.0)
 
+  def test_TFRecordInput_batch(self):
+    FLAGS.labels = 'label,fake_label,int_label'
+    FLAGS.label_dtypes = 'float,float,int'
+    FLAGS.round_labels = True
+    dataset_input = tfrecord_input.TFRecordInput()
+    records = tf.stack([self.ex_tensor, self.ex_tensor])
+
+    with self.test_session():
+      features, labels = dataset_input._read_tf_example_batch(records)
+      self.assertEqual(list(features[base_model.TEXT_FEATURE_KEY].eval()),
+                       [b'Hi there Bob', b'Hi there Bob'])
+      np.testing.assert_almost_equal(labels['label'].eval(), [1.0, 1.0])
+      np.testing.assert_almost_equal(labels['int_label'].eval(), [0.0, 0.0])
+      np.testing.assert_almost_equal(labels['fake_label'].eval(), [0.0, 0.0])
+      np.testing.assert_almost_equal(features['label_weight'].eval(),
+                                     [1.0, 1.0])
+      np.testing.assert_almost_equal(features['int_label_weight'].eval(),
+                                     [1.0, 1.0])
+      np.testing.assert_almost_equal(features['fake_label_weight'].eval(),
+                                     [0.0, 0.0])
+
+  def test_TFRecordInput_interleaved_shards(self):
+    FLAGS.read_cycle_length = 2
+    FLAGS.read_block_length = 2
+    self.addCleanup(setattr, FLAGS, 'read_cycle_length', 1)
+    self.addCleanup(setattr, FLAGS, 'read_block_length', 1)
+    dataset_input = tfrecord_input.TFRecordInput()
+    shards_dir = self.get_temp_dir()
+    for shard in range(3):
+      path = os.path.join(shards_dir, 'train-{:05d}-of-00003'.format(shard))
+      with tf.python_io.TFRecordWriter(path) as writer:
+        for i in range(5):
+          writer.write('{}-{}'.format(shard, i).encode('utf-8'))
+
+    with self.test_session() as session:
+      next_record = dataset_input._read_tfrecord_files(
+          os.path.join(shards_dir, 'train-*')).make_one_shot_iterator(
+          ).get_next()
+      records = []
+      with self.assertRaises(tf.errors.OutOfRangeError):
+        while True:
+          records.append(session.run(next_record).decode('utf-8'))
+      self.assertCountEqual(
+          records, ['{}-{}'.format(s, i) for s in range(3) for i in range(5)])
+      # Blocks of 2 records of one shard alternate with the other shard.
+      self.assertEqual(records[0][0], records[1][0])
+      self.assertNotEqual(records[1][0], records[2][0])
+
 
 class TFRecordInputWithTokenizerTest(tf.test.TestCase):
 
@@ -124,6 +178,21 @@ class TFRecordInputWithTokenizerTest(tf.test.TestCase):
             for x in t.decode('utf-8').split(' ')
         ]), [text], tf.int64)
 
+  def batch_preprocessor(self, texts):
+
+    def _tokenize_batch(texts):
+      token_lists = [[
+          self.word_to_idx.get(x, self.unknown_token)
+          for x in t.decode('utf-8').split(' ')
+      ] for t in texts]
+      lengths = np.asarray([len(t) for t in token_lists], dtype=np.int32)
+      tokens = np.zeros((len(token_lists), lengths.max()), dtype=np.int64)
+      for i, t in enumerate(token_lists):
+        tokens[i, :len(t)] = t
+      return tokens, lengths
+
+    return tf.py_func(_tokenize_batch, [texts], [tf.int64, tf.int32])
+
   def test_TFRecordInputWithTokenizer_unrounded(self):
     FLAGS.labels = 'label,fake_label,int_label,fake_int_label'
     FLAGS.label_dtypes = 'float,float,int,int'
@@ -172,6 +241,383 @@ class TFRecordInputWithTokenizerTest(tf.test.TestCase):
       self.assertEqual(labels['label'].eval(), 1.0)
       self.assertEqual(features['label_weight'].eval(), 1.0)
 
+  def test_TFRecordInputWithTokenizer_batch(self):
+    FLAGS.labels = 'label,fake_label'
+    FLAGS.round_labels = False
+    dataset_input = tfrecord_input.TFRecordInputWithTokenizer(
+        train_preprocess_fn=self.preprocessor,
+        train_preprocess_batch_fn=self.batch_preprocessor)
+    short_ex = tf.train.Example(
+        features=tf.train.Features(
+            feature={
+                'comment':
+                    tf.train.Feature(
+                        bytes_list=tf.train.BytesList(
+                            value=['there'.encode('utf-8')]))
+            }))
+    records = tf.stack([
+        self.ex_tensor,
+        tf.convert_to_tensor(short_ex.SerializeToString(), dtype=tf.string)
+    ])
+
+    with self.test_session():
+      features, labels = dataset_input._read_tf_example_batch(records)
+      self.assertEqual(features[base_model.TOKENS_FEATURE_KEY].eval().tolist(),
+                       [[12, 13, 999], [13, 0, 0]])
+      self.assertEqual(list(features['sequence_length'].eval()), [3, 1])
+      np.testing.assert_almost_equal(labels['label'].eval(), [0.8, 0.0])
+      np.testing.assert_almost_equal(features['label_weight'].eval(),
+                                     [1.0, 0.0])
+      np.testing.assert_almost_equal(labels['fake_label'].eval(), [0.0, 0.0])
+
+      dataset = tf.data.Dataset.from_tensors(
+          (features, labels)).apply(tf.contrib.data.unbatch()).map(
+              dataset_input._remove_padding)
+      next_features, _ = dataset.make_one_shot_iterator().get_next()
+      self.assertEqual(
+          list(next_features[base_model.TOKENS_FEATURE_KEY].eval()),
+          [12, 13, 999])
+      self.assertEqual(
+          list(next_features[base_model.TOKENS_FEATURE_KEY].eval()), [13])
+
+  def test_PreTokenizedTFRecordInput(self):
+    FLAGS.labels = 'label,fake_label'
+    FLAGS.round_labels = False
+    dataset_input = tfrecord_input.PreTokenizedTFRecordInput()
+    ex = tf.train.Example(
+        features=tf.train.Features(
+            feature={
+                'label':
+                    tf.train.Feature(
+                        float_list=tf.train.FloatList(value=[0.8])),
+                'tokens':
+                    tf.train.Feature(
+                        int64_list=tf.train.Int64List(value=[12, 13, 999])),
+                'sequence_length':
+                    tf.train.Feature(int64_list=tf.train.Int64List(value=[3]))
+            }))
+    ex_tensor = tf.convert_to_tensor(ex.SerializeToString(), dtype=tf.string)
+
+    with self.test_session():
+      features, labels = dataset_input._read_pretokenized_tf_example(ex_tensor)
+      self.assertEqual(
+          list(features[base_model.TOKENS_FEATURE_KEY].eval()), [12, 13, 999])
+      self.assertEqual(features['sequence_length'].eval(), 3)
+      self.assertAlmostEqual(labels['label'].eval(), 0.8)
+      self.assertAlmostEqual(labels['fake_label'].eval(), 0.0)
+      self.assertAlmostEqual(features['label_weight'].eval(), 1.0)
+      self.assertAlmostEqual(features['fake_label_weight'].eval(), 0.0)
+
+  def test_PreTokenizedTFRecordInput_quantile_buckets(self):
+    FLAGS.labels = 'label'
+    FLAGS.length_quantile_buckets = 2
+    FLAGS.bucket_tokens_per_batch = 220
+    self.addCleanup(setattr, FLAGS, 'length_quantile_buckets', 0)
+    self.addCleanup(setattr, FLAGS, 'bucket_tokens_per_batch', 0)
+    dataset_input = tfrecord_input.PreTokenizedTFRecordInput()
+    path = os.path.join(self.get_temp_dir(), 'tokenized.tfrecord')
+    with tf.python_io.TFRecordWriter(path) as writer:
+      for length in range(1, 41):
+        ex = tf.train.Example(
+            features=tf.train.Features(
+                feature={
+                    'label':
+                        tf.train.Feature(
+                            float_list=tf.train.FloatList(value=[1.0])),
+                    'tokens':
+                        tf.train.Feature(
+                            int64_list=tf.train.Int64List(
+                                value=[12] * length)),
+                    'sequence_length':
+                        tf.train.Feature(
+                            int64_list=tf.train.Int64List(value=[length]))
+                }))
+        writer.write(ex.SerializeToString())
+
+    with self.test_session() as session:
+      next_features, _ = dataset_input._input_fn_from_file(
+          path).make_one_shot_iterator().get_next()
+      num_examples = 0
+      with self.assertRaises(tf.errors.OutOfRangeError):
+        while True:
+          tokens = session.run(next_features[base_model.TOKENS_FEATURE_KEY])
+          self.assertLessEqual(tokens.size, 220)
+          num_examples += tokens.shape[0]
+      self.assertEqual(num_examples, 40)
+    self.assertEqual(dataset_input._sampled_bucket_boundaries[path], [22, 41])
+
+  def test_PreTokenizedTFRecordInput_quantile_buckets_longer_than_sample(self):
+    FLAGS.labels = 'label'
+    FLAGS.length_quantile_buckets = 2
+    FLAGS.length_sample_size = 10
+    FLAGS.bucket_tokens_per_batch = 220
+    self.addCleanup(setattr, FLAGS, 'length_quantile_buckets', 0)
+    self.addCleanup(setattr, FLAGS, 'length_sample_size', 10000)
+    self.addCleanup(setattr, FLAGS, 'bucket_tokens_per_batch', 0)
+    dataset_input = tfrecord_input.PreTokenizedTFRecordInput(max_seq_len=300)
+    path = os.path.join(self.get_temp_dir(), 'tokenized.tfrecord')
+    with tf.python_io.TFRecordWriter(path) as writer:
+      # Only the first 10 examples are sampled, the long ones come after.
+      for length in list(range(1, 11)) + [200] * 5:
+        ex = tf.train.Example(
+            features=tf.train.Features(
+                feature={
+                    'tokens':
+                        tf.train.Feature(
+                            int64_list=tf.train.Int64List(
+                                value=[12] * length)),
+                    'sequence_length':
+                        tf.train.Feature(
+                            int64_list=tf.train.Int64List(value=[length]))
+                }))
+        writer.write(ex.SerializeToString())
+
+    with self.test_session() as session:
+      next_features, _ = dataset_input._input_fn_from_file(
+          path).make_one_shot_iterator().get_next()
+      num_examples = 0
+      with self.assertRaises(tf.errors.OutOfRangeError):
+        while True:
+          tokens = session.run(next_features[base_model.TOKENS_FEATURE_KEY])
+          self.assertLessEqual(tokens.size, 220)
+          num_examples += tokens.shape[0]
+      self.assertEqual(num_examples, 15)
+    self.assertEqual(dataset_input._sampled_bucket_boundaries[path], [7, 11])
+
+  def test_PreTokenizedTFRecordInput_max_tokens_per_batch(self):
+    FLAGS.labels = 'label'
+    FLAGS.max_tokens_per_batch = 64
+    self.addCleanup(setattr, FLAGS, 'max_tokens_per_batch', 0)
+    dataset_input = tfrecord_input.PreTokenizedTFRecordInput(max_seq_len=100)
+    path = os.path.join(self.get_temp_dir(), 'tokenized.tfrecord')
+    with tf.python_io.TFRecordWriter(path) as writer:
+      for length in list(range(1, 41)) * 5:
+        ex = tf.train.Example(
+            features=tf.train.Features(
+                feature={
+                    'tokens':
+                        tf.train.Feature(
+                            int64_list=tf.train.Int64List(
+                                value=[12] * length)),
+                    'sequence_length':
+                        tf.train.Feature(
+                            int64_list=tf.train.Int64List(value=[length]))
+                }))
+        writer.write(ex.SerializeToString())
+
+    with self.test_session() as session:
+      next_features, next_labels = dataset_input._input_fn_from_file(
+          path).make_one_shot_iterator().get_next()
+      batch_sizes = []
+      with self.assertRaises(tf.errors.OutOfRangeError):
+        while True:
+          features, labels = session.run([next_features, next_labels])
+          tokens = features[base_model.TOKENS_FEATURE_KEY]
+          self.assertLessEqual(tokens.size, 64)
+          self.assertEqual(features['sequence_length'].shape,
+                           (tokens.shape[0],))
+          self.assertEqual(features['label_weight'].shape, (tokens.shape[0],))
+          self.assertEqual(labels['label'].shape, (tokens.shape[0],))
+          batch_sizes.append(tokens.shape[0])
+      self.assertEqual(sum(batch_sizes), 200)
+      # Short comments are batched 8 at a time, long ones only 1 at a time.
+      self.assertEqual(max(batch_sizes), 8)
+      self.assertEqual(min(batch_sizes), 1)
+
+  def test_geometric_bucket_boundaries(self):
+    self.assertEqual(
+        tfrecord_input._geometric_bucket_boundaries(8, 30, 1.1),
+        [8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 20, 22, 24, 26, 28])
+    self.assertEqual(
+        tfrecord_input._geometric_bucket_boundaries(1, 100, 2.0),
+        [1, 2, 4, 8, 16, 32, 64])
+
+  def test_quantile_bucket_boundaries(self):
+    self.assertEqual(
+        tfrecord_input._quantile_bucket_boundaries(np.arange(1, 101), 4),
+        [27, 52, 77])
+    self.assertEqual(
+        tfrecord_input._quantile_bucket_boundaries(
+            np.array([3] * 50 + [10] * 50), 4), [4, 8, 11])
+    self.assertEqual(
+        tfrecord_input._quantile_bucket_boundaries(np.array([5] * 10), 4), [6])
+    with self.assertRaises(ValueError):
+      tfrecord_input._quantile_bucket_boundaries(np.arange(1, 101), 1)
+
+
+class TFRecordInputBenchmark(tf.test.Benchmark):
+  """Compares the throughput of the input pipelines for different flags.
+
+  Run with:
+    python -m tf_trainer.common.tfrecord_input_test --benchmarks=.
+  """
+
+  _NUM_EXAMPLES = 20000
+  _TEXT = ('Dogs are GOOD, cats are not bad; and rabbits? '
+           "They don't care. ") * 10
+
+  def _set_flags(self):
+    FLAGS.text_feature = 'comment'
+    FLAGS.labels = 'label'
+    FLAGS.label_dtypes = ''
+    FLAGS.round_labels = False
+
+  def _write_records(self, path, num_examples):
+    ex = tf.train.Example(
+        features=tf.train.Features(
+            feature={
+                'label':
+                    tf.train.Feature(
+                        float_list=tf.train.FloatList(value=[0.8])),
+                'comment':
+                    tf.train.Feature(
+                        bytes_list=tf.train.BytesList(
+                            value=[self._TEXT.encode('utf-8')]))
+            }))
+    with tf.python_io.TFRecordWriter(path) as writer:
+      for _ in range(num_examples):
+        writer.write(ex.SerializeToString())
+
+  def _benchmark_input(self, name, dataset_input, path):
+    with tf.Graph().as_default():
+      dataset = dataset_input._input_fn_from_file(path)
+      next_features, next_labels = dataset.make_one_shot_iterator().get_next()
+      num_examples = 0
+      with tf.Session() as session:
+        session.run(tf.tables_initializer())
+        start = time.time()
+        try:
+          while True:
+            labels = session.run(next_labels)
+            num_examples += len(labels['label'])
+        except tf.errors.OutOfRangeError:
+          pass
+        wall_time = time.time() - start
+    self.report_benchmark(
+        name=name,
+        iters=num_examples,
+        wall_time=wall_time,
+        extras={'examples_per_sec': num_examples / wall_time})
+
+  def benchmark_read_cycle_length(self):
+    self._set_flags()
+    num_shards = 8
+    shards_dir = tempfile.mkdtemp()
+    for shard in range(num_shards):
+      self._write_records(
+          os.path.join(shards_dir,
+                       'train-{:05d}-of-{:05d}'.format(shard, num_shards)),
+          self._NUM_EXAMPLES // num_shards)
+
+    for read_cycle_length in [1, 4, num_shards]:
+      FLAGS.read_cycle_length = read_cycle_length
+      for read_sloppy in [False, True]:
+        FLAGS.read_sloppy = read_sloppy
+        self._benchmark_input(
+            'read_cycle_length_{}_sloppy_{}'.format(read_cycle_length,
+                                                    read_sloppy),
+            tfrecord_input.TFRecordInput(), os.path.join(shards_dir, 'train-*'))
+    FLAGS.read_cycle_length = 1
+    FLAGS.read_sloppy = False
+
+  def benchmark_batch_before_parse(self):
+    self._set_flags()
+    path = os.path.join(tempfile.mkdtemp(), 'examples.tfrecord')
+    self._write_records(path, self._NUM_EXAMPLES)
+
+    for batch_before_parse in [False, True]:
+      FLAGS.batch_before_parse = batch_before_parse
+      self._benchmark_input(
+          'batch_before_parse_{}'.format(batch_before_parse),
+          tfrecord_input.TFRecordInput(), path)
+    FLAGS.batch_before_parse = False
+
+  def benchmark_tokenize_batch_size(self):
+    self._set_flags()
+    path = os.path.join(tempfile.mkdtemp(), 'examples.tfrecord')
+    self._write_records(path, self._NUM_EXAMPLES)
+
+    preprocessor = text_preprocessor.TextPreprocessor(
+        'testdata/cats_and_dogs_onehot.vocab.txt')
+    tokenizer = treebank.TreebankWordTokenizer().tokenize
+    for tokenize_batch_size in [0, 32, 256]:
+      FLAGS.tokenize_batch_size = tokenize_batch_size
+      dataset_input = tfrecord_input.TFRecordInputWithTokenizer(
+          train_preprocess_fn=preprocessor.train_preprocess_fn(tokenizer),
+          train_preprocess_batch_fn=preprocessor.train_preprocess_batch_fn(
+              tokenizer))
+      self._benchmark_input(
+          'tokenize_batch_size_{}'.format(tokenize_batch_size), dataset_input,
+          path)
+
+  def _write_tokenized_records(self, path, lengths):
+    with tf.python_io.TFRecordWriter(path) as writer:
+      for length in lengths:
+        ex = tf.train.Example(
+            features=tf.train.Features(
+                feature={
+                    'label':
+                        tf.train.Feature(
+                            float_list=tf.train.FloatList(value=[0.8])),
+                    'tokens':
+                        tf.train.Feature(
+                            int64_list=tf.train.Int64List(
+                                value=[1] * length)),
+                    'sequence_length':
+                        tf.train.Feature(
+                            int64_list=tf.train.Int64List(value=[length]))
+                }))
+        writer.write(ex.SerializeToString())
+
+  def _benchmark_batching(self, name, dataset_input, path):
+    with tf.Graph().as_default():
+      dataset = dataset_input._input_fn_from_file(path)
+      next_features, _ = dataset.make_one_shot_iterator().get_next()
+      num_steps = 0
+      num_tokens = 0
+      num_padded_tokens = 0
+      with tf.Session() as session:
+        start = time.time()
+        try:
+          while True:
+            tokens, lengths = session.run([
+                next_features[base_model.TOKENS_FEATURE_KEY],
+                next_features['sequence_length']
+            ])
+            num_steps += 1
+            num_tokens += lengths.sum()
+            num_padded_tokens += tokens.size
+        except tf.errors.OutOfRangeError:
+          pass
+        wall_time = time.time() - start
+    self.report_benchmark(
+        name=name,
+        iters=num_steps,
+        wall_time=wall_time,
+        extras={
+            'steps_per_sec': num_steps / wall_time,
+            'tokens_per_sec': num_tokens / wall_time,
+            'padding_ratio': 1.0 - num_tokens / num_padded_tokens,
+        })
+
+  def benchmark_max_tokens_per_batch(self):
+    self._set_flags()
+    path = os.path.join(tempfile.mkdtemp(), 'tokenized.tfrecord')
+    # Long tailed comment lengths, with a median of 50 tokens.
+    lengths = np.clip(
+        np.random.lognormal(np.log(50), 1.0, self._NUM_EXAMPLES), 1,
+        5000).astype(int)
+    self._write_tokenized_records(path, lengths)
+
+    self._benchmark_batching('default_buckets',
+                             tfrecord_input.PreTokenizedTFRecordInput(), path)
+    for max_tokens_per_batch in [16384, 65536]:
+      FLAGS.max_tokens_per_batch = max_tokens_per_batch
+      self._benchmark_batching(
+          'max_tokens_per_batch_{}'.format(max_tokens_per_batch),
+          tfrecord_input.PreTokenizedTFRecordInput(), path)
+    FLAGS.max_tokens_per_batch = 0
+
 
 if __name__ == '__main__':
   tf.test.main()
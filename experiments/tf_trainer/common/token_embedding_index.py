@@ -17,9 +17,23 @@
 from typing import Tuple, Dict, Optional, List, Callable
 import numpy as np
 import functools
+import hashlib
+import itertools
+import os
+import warnings
 import tensorflow as tf
 
-def LoadTokenIdxEmbeddings(embeddings_path: str) \
+# Suffixes of the files making up the binary cache of an embeddings file.
+_CACHE_MATRIX_SUFFIX = '.npy'
+_CACHE_VOCAB_SUFFIX = '.vocab'
+
+# Number of lines of an embeddings file converted to floats at once.
+_PARSE_CHUNK_LINES = 10000
+
+
+def LoadTokenIdxEmbeddings(embeddings_path: str,
+                           cache_dir: Optional[str] = None,
+                           max_vocab_size: Optional[int] = None) \
   -> Tuple[Dict[str, int], np.ndarray, int, int]:
   """Generate word to idx mapping and word embeddings numpy array.
 
@@ -30,6 +44,13 @@ def LoadTokenIdxEmbeddings(embeddings_path: str) \
   Args:
     embeddings_path: Local, GCS, or HDFS path to embedding file. Each line
       should be a word and its vector representation separated by a space.
+    cache_dir: Optional local directory for a binary copy of the embeddings.
+      When a copy of embeddings_path exists there, the matrix is memory-mapped
+      from it (read-only) instead of parsing the text file. Otherwise the text
+      file is parsed and the copy is written for the next load.
+    max_vocab_size: If set, only the first max_vocab_size words of the file are
+      loaded. Files such as GloVe are sorted by decreasing word frequency, so
+      this keeps the most frequent words.
 
   Returns:
     Tuple of:
@@ -38,31 +59,183 @@ def LoadTokenIdxEmbeddings(embeddings_path: str) \
       A unique unknown token index (greater than all other token indexes)
       The size of the embeddings for words that is being used
   """
-  word_to_idx = {}
-  word_embeddings = []
-
   if not tf.gfile.Exists(embeddings_path):
     raise ValueError('File at %s does not exist.' % embeddings_path)
 
-  with tf.gfile.Open(embeddings_path) as f:
-    for idx, line in enumerate(f):
-      values = line.split()
-      word = values[0]
-      word_embedding = np.asarray(values[1:], dtype='float32')
-      word_to_idx[word] = idx + 1  # Reserve first row for padding
-      word_embeddings.append(word_embedding)
-
-  if not word_embeddings:
+  if cache_dir:
+    cache_prefix = _CachePrefix(embeddings_path, cache_dir, max_vocab_size)
+    if os.path.exists(cache_prefix + _CACHE_MATRIX_SUFFIX):
+      tf.logging.info('Loading cached embeddings from %s.' % cache_prefix)
+      return _LoadCache(cache_prefix)
+
+  words, embeddings_matrix = _ParseEmbeddings(embeddings_path, max_vocab_size)
+
+  if cache_dir:
+    tf.logging.info('Writing embeddings cache to %s.' % cache_prefix)
+    _WriteCache(cache_prefix, words, embeddings_matrix)
+
+  return _BuildResult(words, embeddings_matrix)
+
+
+def VocabularyLookupTable(word_to_idx: Dict[str, int], unknown_token: int
+                         ) -> tf.contrib.lookup.HashTable:
+  """Creates a table mapping words (strings) to their int64 index.
+
+  Words missing from word_to_idx are mapped to unknown_token. The table needs
+  to be initialized, e.g. by tf.tables_initializer().
+  """
+  keys = list(word_to_idx.keys())
+  values = list(word_to_idx.values())
+  return tf.contrib.lookup.HashTable(
+      tf.contrib.lookup.KeyValueTensorInitializer(
+          keys, values, key_dtype=tf.string, value_dtype=tf.int64),
+      unknown_token)
+
+
+def _ParseEmbeddings(embeddings_path: str,
+                     max_vocab_size: Optional[int] = None) \
+  -> Tuple[List[str], np.ndarray]:
+  """Parses a text embeddings file.
+
+  The file is read twice: once to count the words and find the embedding size,
+  and once to fill a preallocated matrix, converting _PARSE_CHUNK_LINES lines
+  to floats at a time. Peak memory stays close to the size of the final matrix.
+
+  Returns:
+    Tuple of the words, in file order, and the embeddings matrix. Row 0 of the
+    matrix is the padding embedding, row i the embedding of words[i - 1] and
+    the last row the unknown word embedding.
+  """
+  vocab_size, embedding_size = _CountEmbeddings(embeddings_path,
+                                                max_vocab_size)
+  if not vocab_size:
     raise ValueError('No embeddings loaded from %s.' % embeddings_path)
 
+  embeddings_matrix = np.empty((vocab_size + 2, embedding_size),
+                               dtype=np.float32)
   # Add the padding "embedding"
-  word_embeddings.insert(0, np.random.randn(len(word_embeddings[0])))
+  embeddings_matrix[0] = np.random.randn(embedding_size)
+
+  words = []  # type: List[str]
+  with tf.gfile.Open(embeddings_path) as f:
+    lines = itertools.islice(f, vocab_size)
+    while len(words) < vocab_size:
+      chunk = list(itertools.islice(lines, _PARSE_CHUNK_LINES))
+      if not chunk:
+        raise ValueError('%s changed while loading embeddings.' %
+                         embeddings_path)
+      start = len(words) + 1
+      embeddings_matrix[start:start + len(chunk)] = _ParseEmbeddingsChunk(
+          chunk, embedding_size, words)
+
+  # The unknown word embedding is the mean of all other embeddings.
+  embeddings_matrix[-1] = embeddings_matrix[:-1].mean(axis=0)
+
+  return words, embeddings_matrix
+
+
+def _CountEmbeddings(embeddings_path: str,
+                     max_vocab_size: Optional[int]) -> Tuple[int, int]:
+  """Returns the number of words to load and the embedding size."""
+  vocab_size = 0
+  embedding_size = 0
+  with tf.gfile.Open(embeddings_path) as f:
+    for line in itertools.islice(f, max_vocab_size):
+      if not vocab_size:
+        embedding_size = len(line.split()) - 1
+      vocab_size += 1
+  return vocab_size, embedding_size
+
+
+def _ParseEmbeddingsChunk(lines: List[str], embedding_size: int,
+                          words: List[str]) -> np.ndarray:
+  """Converts lines of an embeddings file to a matrix, appending their words.
+
+  All the vectors of the chunk are converted by a single np.fromstring call.
+  Some embedding files (e.g. glove.840B) contain words with spaces; chunks with
+  such lines fail the size check and are parsed again line by line, splitting
+  the embedding_size values off the right of each line.
+  """
+  split_lines = [line.partition(' ') for line in lines]
+  try:
+    with warnings.catch_warnings():
+      # np.fromstring warns (or raises, in newer numpy versions) when it can
+      # not parse the whole string; a short result fails the size check below.
+      warnings.simplefilter('ignore', DeprecationWarning)
+      values = np.fromstring(
+          ' '.join([vector for _, _, vector in split_lines]),
+          dtype=np.float32,
+          sep=' ')
+  except ValueError:
+    values = np.empty(0, dtype=np.float32)
+
+  if values.size == len(lines) * embedding_size:
+    words.extend([word for word, _, _ in split_lines])
+    return values.reshape((len(lines), embedding_size))
+
+  chunk_matrix = np.empty((len(lines), embedding_size), dtype=np.float32)
+  for row, line in enumerate(lines):
+    values = line.rsplit(None, embedding_size)
+    if len(values) != embedding_size + 1:
+      raise ValueError('Expected a word and %d values, got: %s' %
+                       (embedding_size, line[:100]))
+    words.append(values[0])
+    chunk_matrix[row] = np.asarray(values[1:], dtype=np.float32)
+  return chunk_matrix
+
+
+def _BuildResult(words: List[str], embeddings_matrix: np.ndarray) \
+  -> Tuple[Dict[str, int], np.ndarray, int, int]:
+  """Builds the LoadTokenIdxEmbeddings result from words and their matrix."""
+  # Reserve first row for padding
+  word_to_idx = {word: idx + 1 for idx, word in enumerate(words)}
+  unknown_token = embeddings_matrix.shape[0] - 1
+  return word_to_idx, embeddings_matrix, unknown_token, \
+    embeddings_matrix.shape[1]
+
+
+def _CachePrefix(embeddings_path: str, cache_dir: str,
+                 max_vocab_size: Optional[int]) -> str:
+  """Returns the path prefix of the cache files for an embeddings file.
+
+  The prefix includes a fingerprint of the path, size and modification time of
+  the embeddings file, so that a changed file is never read from a stale cache.
+  """
+  stat = tf.gfile.Stat(embeddings_path)
+  fingerprint = hashlib.sha1('{}:{}:{}:{}'.format(
+      embeddings_path, stat.length, stat.mtime_nsec,
+      max_vocab_size).encode('utf-8'))
+  return os.path.join(
+      cache_dir, '{}.{}'.format(
+          os.path.basename(embeddings_path), fingerprint.hexdigest()[:12]))
+
+
+def _LoadCache(cache_prefix: str) \
+  -> Tuple[Dict[str, int], np.ndarray, int, int]:
+  """Loads the vocabulary and memory-maps the matrix of an embeddings cache."""
+  with open(cache_prefix + _CACHE_VOCAB_SUFFIX, encoding='utf-8') as f:
+    words = f.read().split('\n')
+  embeddings_matrix = np.load(cache_prefix + _CACHE_MATRIX_SUFFIX,
+                              mmap_mode='r')
+  return _BuildResult(words, embeddings_matrix)
+
+
+def _WriteCache(cache_prefix: str, words: List[str],
+                embeddings_matrix: np.ndarray) -> None:
+  """Writes an embeddings cache.
+
+  Files are written under a temporary name and renamed, and the matrix is
+  written last, so concurrent jobs never read a partially written cache.
+  """
+  os.makedirs(os.path.dirname(cache_prefix), exist_ok=True)
+  tmp_suffix = '.tmp{}'.format(os.getpid())
 
-  # Convert embedding to numpy array and append the unknown word embedding,
-  # which is the mean of all other embeddings.
-  unknown_token = len(word_embeddings)
-  embeddings_matrix = np.asarray(word_embeddings, dtype=np.float32)
-  embeddings_matrix = np.append(
-      embeddings_matrix, [embeddings_matrix.mean(axis=0)], axis=0)
+  vocab_path = cache_prefix + _CACHE_VOCAB_SUFFIX
+  with open(vocab_path + tmp_suffix, 'w', encoding='utf-8') as f:
+    f.write('\n'.join(words))
+  os.rename(vocab_path + tmp_suffix, vocab_path)
 
-  return word_to_idx, embeddings_matrix, unknown_token, len(word_embeddings[0])
+  matrix_path = cache_prefix + _CACHE_MATRIX_SUFFIX
+  with open(matrix_path + tmp_suffix, 'wb') as f:
+    np.save(f, embeddings_matrix)
+  os.rename(matrix_path + tmp_suffix, matrix_path)
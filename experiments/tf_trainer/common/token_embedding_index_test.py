@@ -18,6 +18,9 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+
+import numpy as np
 import tensorflow as tf
 
 from tf_trainer.common.token_embedding_index import LoadTokenIdxEmbeddings
@@ -38,5 +41,40 @@ class LoadTokenIdxEmbeddingsTest(tf.test.TestCase):
     # Note: padding embedding will be random, and is index 0. Also the unknown
     # token embedding will be random, and is index n+1; 7 in this case.
 
+  def test_LoadTokenIdxEmbeddings_max_vocab_size(self):
+    idx, embeddings, unknown_idx, embedding_size = LoadTokenIdxEmbeddings(
+        'testdata/cats_and_dogs_onehot.vocab.txt', max_vocab_size=2)
+    self.assertEqual(embedding_size, 6)
+    self.assertEqual(unknown_idx, 3)
+    self.assertEqual(idx, {'dogs': 1, 'cats': 2})
+    self.assertEqual(embeddings.shape, (4, 6))
+    self.assertEqual(embeddings[2][1], 1.0)
+
+  def test_LoadTokenIdxEmbeddings_word_with_spaces(self):
+    embeddings_path = os.path.join(self.get_temp_dir(), 'spaces.vocab.txt')
+    with open(embeddings_path, 'w') as f:
+      f.write('dogs 1.0 0.0\n. . . 0.0 1.0\ncats 0.5 0.5\n')
+    idx, embeddings, unknown_idx, embedding_size = LoadTokenIdxEmbeddings(
+        embeddings_path)
+    self.assertEqual(embedding_size, 2)
+    self.assertEqual(unknown_idx, 4)
+    self.assertEqual(idx, {'dogs': 1, '. . .': 2, 'cats': 3})
+    self.assertEqual(list(embeddings[2]), [0.0, 1.0])
+    self.assertEqual(list(embeddings[3]), [0.5, 0.5])
+
+  def test_LoadTokenIdxEmbeddings_cache(self):
+    cache_dir = self.get_temp_dir()
+    idx, embeddings, unknown_idx, embedding_size = LoadTokenIdxEmbeddings(
+        'testdata/cats_and_dogs_onehot.vocab.txt', cache_dir)
+    cached_idx, cached_embeddings, cached_unknown_idx, cached_embedding_size = \
+      LoadTokenIdxEmbeddings('testdata/cats_and_dogs_onehot.vocab.txt',
+                             cache_dir)
+    self.assertIsInstance(cached_embeddings, np.memmap)
+    self.assertEqual(cached_idx, idx)
+    self.assertEqual(cached_unknown_idx, unknown_idx)
+    self.assertEqual(cached_embedding_size, embedding_size)
+    # The cache stores the random padding embedding too.
+    np.testing.assert_array_equal(cached_embeddings, embeddings)
+
 if __name__ == '__main__':
   tf.test.main()
@@ -36,12 +36,25 @@ def main(argv):
 
   embeddings_path = FLAGS.embeddings_path
 
-  preprocessor = text_preprocessor.TextPreprocessor(embeddings_path)
-
-  nltk.download("punkt")
-  train_preprocess_fn = preprocessor.train_preprocess_fn(nltk.word_tokenize)
+  preprocessor = text_preprocessor.TextPreprocessor(
+      embeddings_path, FLAGS.embeddings_cache_dir,
+      FLAGS.embeddings_max_vocab_size)
+
+  if FLAGS.tokenize_in_graph:
+    train_preprocess_fn = preprocessor.in_graph_train_preprocess_fn()
+    train_preprocess_batch_fn = None
+    pretokenized_fingerprint = None
+  else:
+    nltk.download("punkt")
+    train_preprocess_fn = preprocessor.train_preprocess_fn(nltk.word_tokenize)
+    train_preprocess_batch_fn = preprocessor.train_preprocess_batch_fn(
+        nltk.word_tokenize)
+    pretokenized_fingerprint = preprocessor.tokenization_fingerprint(
+        nltk.word_tokenize)
   dataset = tfrecord_input.TFRecordInputWithTokenizer(
-      train_preprocess_fn=train_preprocess_fn)
+      train_preprocess_fn=train_preprocess_fn,
+      train_preprocess_batch_fn=train_preprocess_batch_fn,
+      pretokenized_fingerprint=pretokenized_fingerprint)
 
   # TODO: Move embedding *into* Keras model.
   model_tf = tf_cnn.TFCNNModel(dataset.labels())
@@ -25,12 +25,26 @@ tf.app.flags.DEFINE_string('embeddings_path',
 def main(argv):
   del argv  # unused
 
-  preprocessor = text_preprocessor.TextPreprocessor(FLAGS.embeddings_path)
-
-  nltk.download('punkt')
-  train_preprocess_fn = preprocessor.train_preprocess_fn(nltk.word_tokenize)
+  preprocessor = text_preprocessor.TextPreprocessor(
+      FLAGS.embeddings_path, FLAGS.embeddings_cache_dir,
+      FLAGS.embeddings_max_vocab_size)
+
+  if FLAGS.tokenize_in_graph:
+    train_preprocess_fn = preprocessor.in_graph_train_preprocess_fn()
+    train_preprocess_batch_fn = None
+    pretokenized_fingerprint = None
+  else:
+    nltk.download('punkt')
+    train_preprocess_fn = preprocessor.train_preprocess_fn(nltk.word_tokenize)
+    train_preprocess_batch_fn = preprocessor.train_preprocess_batch_fn(
+        nltk.word_tokenize)
+    pretokenized_fingerprint = preprocessor.tokenization_fingerprint(
+        nltk.word_tokenize)
   dataset = tfrecord_input.TFRecordInputWithTokenizer(
-      train_preprocess_fn=train_preprocess_fn, max_seq_len=5000)
+      train_preprocess_fn=train_preprocess_fn,
+      max_seq_len=5000,
+      train_preprocess_batch_fn=train_preprocess_batch_fn,
+      pretokenized_fingerprint=pretokenized_fingerprint)
 
   model_tf = tf_word_label_embedding.TFWordLabelEmbeddingModel(dataset.labels())
   model = preprocessor.add_embedding_to_model(model_tf,
@@ -0,0 +1,83 @@
+# coding=utf-8
+# Copyright 2018 The Conversation-AI.github.io Authors.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Tokenizes the training and validation TFRecords once, for many runs.
+
+Writes the copies of train_path and validate_path which
+TFRecordInputWithTokenizer reads instead of tokenizing the text with NLTK, when
+it is run with the same --pretokenized_cache_dir, --text_feature and embeddings
+flags. Run from the experiments directory:
+
+  python -m tools.pretokenize_tfrecords \
+    --embeddings_path=local_data/glove.6B/glove.6B.100d.txt \
+    --train_path=... --validate_path=... \
+    --pretokenized_cache_dir=local_data/pretokenized
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import functools
+
+import nltk
+import tensorflow as tf
+
+from tf_trainer.common import pretokenized_cache
+from tf_trainer.common import text_preprocessor
+from tf_trainer.common import tfrecord_input
+
+FLAGS = tf.app.flags.FLAGS
+
+tf.app.flags.DEFINE_string("embeddings_path",
+                           "local_data/glove.6B/glove.6B.100d.txt",
+                           "Path to the embeddings file.")
+tf.app.flags.DEFINE_integer("num_shards", 10,
+                            "Number of TFRecord files to write per input.")
+
+
+def main(argv):
+  del argv  # unused
+
+  assert FLAGS.pretokenized_cache_dir
+  nltk.download("punkt")
+  preprocessor = text_preprocessor.TextPreprocessor(
+      FLAGS.embeddings_path, FLAGS.embeddings_cache_dir,
+      FLAGS.embeddings_max_vocab_size)
+  fingerprint = preprocessor.tokenization_fingerprint(nltk.word_tokenize)
+  text_to_indexes = functools.partial(
+      preprocessor.text_to_indexes, tokenizer=nltk.word_tokenize,
+      lowercase=True)
+
+  for source_pattern in [FLAGS.train_path, FLAGS.validate_path]:
+    if not source_pattern:
+      continue
+    cache_path = pretokenized_cache.CachePath(FLAGS.pretokenized_cache_dir,
+                                              fingerprint, source_pattern,
+                                              FLAGS.text_feature)
+    if pretokenized_cache.IsComplete(cache_path):
+      tf.logging.info("%s is already tokenized at %s.", source_pattern,
+                      cache_path)
+      continue
+    tf.logging.info("Tokenizing %s to %s.", source_pattern, cache_path)
+    num_examples = pretokenized_cache.WriteCache(source_pattern, cache_path,
+                                                 FLAGS.text_feature,
+                                                 text_to_indexes,
+                                                 FLAGS.num_shards)
+    tf.logging.info("Tokenized %d examples.", num_examples)
+
+
+if __name__ == "__main__":
+  tf.logging.set_verbosity(tf.logging.INFO)
+  tf.app.run(main)
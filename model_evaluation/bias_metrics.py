@@ -0,0 +1,215 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Computes unintended bias metrics of models over a scored DataFrame.
+
+For every subgroup (identity column) and every model column, computes:
+  * subgroup_auc: AUC restricted to the examples of the subgroup.
+  * bpsn_auc: AUC of background positive and subgroup negative examples.
+  * bnsp_auc: AUC of background negative and subgroup positive examples.
+  * positive_rate: Fraction of the subgroup scored above the threshold.
+
+The metrics of all subgroups are computed together: the scores of a model are
+sorted once, and the AUCs are Mann-Whitney statistics computed from cumulative
+counts of positive and negative examples (see `model_bias_metrics`).
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+SUBGROUP = 'subgroup'
+SUBGROUP_SIZE = 'subgroup_size'
+SUBGROUP_AUC = 'subgroup_auc'
+BPSN_AUC = 'bpsn_auc'
+BNSP_AUC = 'bnsp_auc'
+POSITIVE_RATE = 'positive_rate'
+
+METRICS = [SUBGROUP_AUC, BPSN_AUC, BNSP_AUC, POSITIVE_RATE]
+
+
+def _starts(keys):
+  """Returns a boolean array, True where sorted keys change."""
+  starts = np.ones(len(keys), dtype=bool)
+  starts[1:] = keys[1:] != keys[:-1]
+  return starts
+
+
+def _safe_divide(numerator, denominator):
+  with np.errstate(invalid='ignore', divide='ignore'):
+    return np.where(denominator > 0, numerator / denominator, np.nan)
+
+
+def model_bias_metrics(scores, labels, subgroup_masks, threshold=0.5):
+  """Computes the bias metrics of one model for all subgroups.
+
+  The AUCs are Mann-Whitney statistics: the number of (positive, negative)
+  pairs ranked in the right order, ties counting for one half, divided by the
+  number of pairs. With U the statistic of the subgroup AUC, the statistic of
+  BPSN is the sum over subgroup negatives of the positives ranked above them,
+  minus U; the statistic of BNSP is the sum over subgroup positives of the
+  negatives ranked below them, minus U. So only the examples of each subgroup
+  are visited, with per-score counts over all examples computed once.
+
+  Args:
+    scores: Array [examples] of model scores.
+    labels: Boolean array [examples] of true labels.
+    subgroup_masks: Boolean array [examples, subgroups], True where the example
+      belongs to the subgroup.
+    threshold: Score above which an example is predicted positive.
+
+  Returns:
+    A dict mapping each of METRICS to an array [subgroups].
+  """
+  scores = np.asarray(scores)
+  labels = np.asarray(labels, dtype=bool)
+  subgroup_masks = np.asarray(subgroup_masks, dtype=bool)
+  n_subgroups = subgroup_masks.shape[1]
+
+  order = np.argsort(scores, kind='mergesort')
+  sorted_scores = scores[order]
+  sorted_labels = labels[order]
+
+  # Examples with equal scores share a tie group, numbered by increasing score.
+  groups = np.cumsum(_starts(sorted_scores)) - 1
+  n_groups = groups[-1] + 1 if len(groups) else 0
+  positive_counts = np.bincount(groups, sorted_labels, n_groups)
+  negative_counts = np.bincount(groups, ~sorted_labels, n_groups)
+  n_positives = positive_counts.sum()
+  # Positives ranked above each tie group, and negatives ranked below it.
+  positives_above = (n_positives - np.cumsum(positive_counts) +
+                     0.5 * positive_counts)
+  negatives_below = (np.cumsum(negative_counts) - 0.5 * negative_counts)
+
+  # (subgroup, sorted position) of the members of each subgroup, by subgroup
+  # then by increasing score.
+  subgroups, positions = np.nonzero(subgroup_masks[order].T)
+  member_groups = groups[positions]
+  member_labels = sorted_labels[positions]
+  member_negatives = (~member_labels).astype(np.float64)
+
+  # Negatives of the same subgroup ranked below each member: members of a
+  # run share a subgroup and a tie group.
+  negatives_before = np.cumsum(member_negatives) - member_negatives
+  run_keys = subgroups * n_groups + member_groups
+  new_run = _starts(run_keys)
+  run_ids = np.cumsum(new_run) - 1
+  run_starts = np.flatnonzero(new_run)
+  run_negatives = np.bincount(run_ids, member_negatives)
+  subgroup_start = np.maximum.accumulate(
+      np.where(_starts(subgroups), np.arange(len(subgroups)), 0))
+  subgroup_negatives_below = (
+      negatives_before[run_starts][run_ids] -
+      negatives_before[subgroup_start] + 0.5 * run_negatives[run_ids])
+
+  def _sum(weights):
+    return np.bincount(subgroups, weights, n_subgroups)
+
+  subgroup_sizes = np.bincount(subgroups, minlength=n_subgroups)
+  subgroup_positives = _sum(member_labels)
+  subgroup_negatives = subgroup_sizes - subgroup_positives
+  background_positives = n_positives - subgroup_positives
+  background_negatives = len(labels) - n_positives - subgroup_negatives
+
+  subgroup_u = _sum(member_labels * subgroup_negatives_below)
+  bpsn_u = _sum(member_negatives * positives_above[member_groups]) - subgroup_u
+  bnsp_u = _sum(member_labels * negatives_below[member_groups]) - subgroup_u
+  predicted_positives = _sum(sorted_scores[positions] >= threshold)
+
+  return {
+      SUBGROUP_AUC:
+          _safe_divide(subgroup_u, subgroup_positives * subgroup_negatives),
+      BPSN_AUC:
+          _safe_divide(bpsn_u, background_positives * subgroup_negatives),
+      BNSP_AUC:
+          _safe_divide(bnsp_u, subgroup_positives * background_negatives),
+      POSITIVE_RATE:
+          _safe_divide(predicted_positives, subgroup_sizes),
+  }
+
+
+# Labels, subgroup masks and threshold shared by the workers of a pool, so
+# that they are sent once per worker rather than once per model.
+_shared_inputs = None
+
+
+def _init_shared_inputs(labels, subgroup_masks, threshold):
+  global _shared_inputs
+  _shared_inputs = (labels, subgroup_masks, threshold)
+
+
+def _shared_model_bias_metrics(scores):
+  labels, subgroup_masks, threshold = _shared_inputs
+  return model_bias_metrics(scores, labels, subgroup_masks, threshold)
+
+
+def compute_bias_metrics_for_models(df,
+                                    subgroups,
+                                    model_names,
+                                    label_col,
+                                    threshold=0.5,
+                                    n_processes=None):
+  """Computes the bias metrics of several models for several subgroups.
+
+  Args:
+    df: a pandas `DataFrame` with a score column per model, a label column
+      and a boolean column per subgroup.
+    subgroups: List of the subgroup column names.
+    model_names: List of the model score column names.
+    label_col: Name of the label column (True for positive examples).
+    threshold: Score above which an example is predicted positive.
+    n_processes (optional): If given, models are evaluated in a pool of
+      n_processes processes.
+
+  Returns:
+    A pandas `DataFrame` with a row per subgroup, a `subgroup` and a
+    `subgroup_size` column, and a `{model}_{metric}` column per model and
+    metric of METRICS.
+  """
+  labels = df[label_col].values.astype(bool)
+  subgroup_masks = df[subgroups].values.astype(bool)
+  model_scores = [df[model_name].values for model_name in model_names]
+
+  if n_processes:
+    pool = multiprocessing.Pool(
+        n_processes,
+        initializer=_init_shared_inputs,
+        initargs=(labels, subgroup_masks, threshold))
+    try:
+      results = pool.map(_shared_model_bias_metrics, model_scores)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    results = [
+        model_bias_metrics(scores, labels, subgroup_masks, threshold)
+        for scores in model_scores
+    ]
+
+  columns = [SUBGROUP, SUBGROUP_SIZE]
+  data = {
+      SUBGROUP: list(subgroups),
+      SUBGROUP_SIZE: subgroup_masks.sum(axis=0),
+  }
+  for model_name, metrics in zip(model_names, results):
+    for metric in METRICS:
+      column = '{}_{}'.format(model_name, metric)
+      columns.append(column)
+      data[column] = metrics[metric]
+  return pd.DataFrame(data, columns=columns)
@@ -0,0 +1,119 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Benchmarks bias_metrics against per-subgroup sklearn computations.
+
+Usage:
+  python bias_metrics_benchmark.py --n_examples 100000 --n_models 10
+  python bias_metrics_benchmark.py --n_models 10 --n_processes 4
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+from sklearn import metrics
+
+import bias_metrics
+
+
+def synthetic_scored_df(n_examples, n_models, n_subgroups, seed=0):
+  """Returns a DataFrame of random labels, subgroups and model scores."""
+  rng = np.random.RandomState(seed)
+  df = pd.DataFrame({'label': rng.rand(n_examples) < 0.3})
+  subgroups = ['subgroup_{}'.format(i) for i in range(n_subgroups)]
+  for subgroup in subgroups:
+    df[subgroup] = rng.rand(n_examples) < 0.05
+  model_names = ['model_{}'.format(i) for i in range(n_models)]
+  for model_name in model_names:
+    df[model_name] = 0.7 * rng.rand(n_examples) + 0.3 * df['label']
+  return df, subgroups, model_names
+
+
+def _sklearn_auc(labels, scores):
+  if len(set(labels)) < 2:
+    return np.nan
+  return metrics.roc_auc_score(labels, scores)
+
+
+def sklearn_bias_metrics(df, subgroups, model_names, label_col, threshold=0.5):
+  """Computes the bias metrics one subgroup and one model at a time."""
+  rows = []
+  for subgroup in subgroups:
+    in_subgroup = df[subgroup]
+    positive = df[label_col]
+    subgroup_df = df[in_subgroup]
+    bpsn_df = df[(in_subgroup & ~positive) | (~in_subgroup & positive)]
+    bnsp_df = df[(in_subgroup & positive) | (~in_subgroup & ~positive)]
+    row = {
+        bias_metrics.SUBGROUP: subgroup,
+        bias_metrics.SUBGROUP_SIZE: len(subgroup_df)
+    }
+    for model_name in model_names:
+      row['{}_{}'.format(model_name, bias_metrics.SUBGROUP_AUC)] = _sklearn_auc(
+          subgroup_df[label_col], subgroup_df[model_name])
+      row['{}_{}'.format(model_name, bias_metrics.BPSN_AUC)] = _sklearn_auc(
+          bpsn_df[label_col], bpsn_df[model_name])
+      row['{}_{}'.format(model_name, bias_metrics.BNSP_AUC)] = _sklearn_auc(
+          bnsp_df[label_col], bnsp_df[model_name])
+      row['{}_{}'.format(model_name, bias_metrics.POSITIVE_RATE)] = np.mean(
+          subgroup_df[model_name] >= threshold)
+    rows.append(row)
+  return pd.DataFrame(rows)
+
+
+def main(FLAGS):
+  df, subgroups, model_names = synthetic_scored_df(
+      FLAGS.n_examples, FLAGS.n_models, FLAGS.n_subgroups)
+
+  start = time.time()
+  results = bias_metrics.compute_bias_metrics_for_models(
+      df, subgroups, model_names, 'label', n_processes=FLAGS.n_processes)
+  vectorized_time = time.time() - start
+
+  start = time.time()
+  expected = sklearn_bias_metrics(df, subgroups, model_names, 'label')
+  sklearn_time = time.time() - start
+
+  max_diff = np.nanmax(
+      np.abs(results[results.columns[2:]].values -
+             expected[results.columns[2:]].values))
+  logging.info('bias_metrics: {0:.2f} secs'.format(vectorized_time))
+  logging.info('sklearn per subgroup: {0:.2f} secs'.format(sklearn_time))
+  logging.info('speedup: {0:.1f}x, max metric difference: {1:.2g}'.format(
+      sklearn_time / vectorized_time, max_diff))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--n_examples', type=int, default=100000, help='Number of examples.')
+  parser.add_argument(
+      '--n_models', type=int, default=4, help='Number of model columns.')
+  parser.add_argument(
+      '--n_subgroups', type=int, default=24, help='Number of subgroups.')
+  parser.add_argument(
+      '--n_processes',
+      type=int,
+      default=None,
+      help='Number of processes evaluating the models.')
+
+  logging.basicConfig(level=logging.INFO)
+  main(parser.parse_args())
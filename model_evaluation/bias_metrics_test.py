@@ -0,0 +1,100 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for bias metrics."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import unittest
+
+import numpy as np
+import pandas as pd
+from sklearn import metrics
+
+import bias_metrics
+
+
+def random_scored_df(n_examples, model_names, subgroups, seed=0):
+  """Returns a DataFrame of random labels, subgroups and tied scores."""
+  rng = np.random.RandomState(seed)
+  df = pd.DataFrame({'label': rng.rand(n_examples) < 0.3})
+  for subgroup in subgroups:
+    df[subgroup] = rng.rand(n_examples) < 0.1
+  for model_name in model_names:
+    noise = rng.rand(n_examples)
+    df[model_name] = np.round(0.7 * noise + 0.3 * df['label'], 2)
+  return df
+
+
+def sklearn_auc(labels, scores):
+  if len(set(labels)) < 2:
+    return np.nan
+  return metrics.roc_auc_score(labels, scores)
+
+
+class TestBiasMetrics(unittest.TestCase):
+  """Compares the metrics with per-subgroup sklearn computations."""
+
+  def setUp(self):
+    self._model_names = ['model_1', 'model_2']
+    self._subgroups = ['male', 'female', 'muslim']
+    self._df = random_scored_df(2000, self._model_names, self._subgroups)
+    # A subgroup without negative examples has no subgroup AUC.
+    self._df['empty'] = self._df['label'] & (np.arange(2000) < 10)
+    self._subgroups.append('empty')
+    self._df['nobody'] = False
+    self._subgroups.append('nobody')
+
+  def _check(self, results):
+    df = self._df
+    self.assertEqual(list(results['subgroup']), self._subgroups)
+    for i, subgroup in enumerate(self._subgroups):
+      in_subgroup = df[subgroup]
+      self.assertEqual(results['subgroup_size'][i], in_subgroup.sum())
+      for model_name in self._model_names:
+        row = results.iloc[i]
+        subgroup_df = df[in_subgroup]
+        positive = df['label']
+        bpsn_df = df[(in_subgroup & ~positive) | (~in_subgroup & positive)]
+        bnsp_df = df[(in_subgroup & positive) | (~in_subgroup & ~positive)]
+        expected = {
+            'subgroup_auc':
+                sklearn_auc(subgroup_df['label'], subgroup_df[model_name]),
+            'bpsn_auc':
+                sklearn_auc(bpsn_df['label'], bpsn_df[model_name]),
+            'bnsp_auc':
+                sklearn_auc(bnsp_df['label'], bnsp_df[model_name]),
+            'positive_rate':
+                np.mean(subgroup_df[model_name] >= 0.5),
+        }
+        for metric, value in expected.items():
+          np.testing.assert_allclose(
+              row['{}_{}'.format(model_name, metric)], value, rtol=1e-10)
+
+  def test_matches_sklearn(self):
+    results = bias_metrics.compute_bias_metrics_for_models(
+        self._df, self._subgroups, self._model_names, 'label')
+    self._check(results)
+    self.assertTrue(np.isnan(results['model_1_subgroup_auc'].iloc[-1]))
+
+  def test_process_pool(self):
+    results = bias_metrics.compute_bias_metrics_for_models(
+        self._df, self._subgroups, self._model_names, 'label', n_processes=2)
+    self._check(results)
+
+
+if __name__ == '__main__':
+  unittest.main()
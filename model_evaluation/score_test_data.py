@@ -22,7 +22,7 @@ import random
 import tensorflow as tf
 
 import input_fn_example
-from utils_export.dataset import Dataset, Model
+from utils_export.dataset import Dataset, LocalBackend, Model
 from utils_export import utils_cloudml
 from utils_export import utils_tfrecords
 
@@ -44,6 +44,14 @@ tf.app.flags.DEFINE_string('prediction_name', 'probabilities',
                            'Name of output prediction.')
 tf.app.flags.DEFINE_integer('dataset_size', 100000,
                             'Maximum size of dataset to score.')
+tf.app.flags.DEFINE_string(
+    'saved_model_dirs', None,
+    'Comma separated list of SavedModel directories, one per model name.'
+    ' If given, models are scored locally instead of on ML Engine.')
+tf.app.flags.DEFINE_integer('local_batch_size', 256,
+                            'Batch size of local predictions.')
+tf.app.flags.DEFINE_integer('local_num_workers', 4,
+                            'Number of concurrent local predictions.')
 
 FLAGS = tf.app.flags.FLAGS
 
@@ -85,7 +93,10 @@ def score_data(model_names,
                text_feature_name,
                sentence_key,
                prediction_name,
-               dataset_size):
+               dataset_size,
+               saved_model_dirs=None,
+               local_batch_size=256,
+               local_num_workers=4):
   """Scores a test dataset with ML engine models and writes output as csv.
 
   Args:
@@ -98,6 +109,11 @@ def score_data(model_names,
     sentence_key: name of input key (see serving function call in run.py).
     prediction_name: name of output prediction.
     dataset_size: maximum size of dataset to score.
+    saved_model_dirs (optional): list of SavedModel directories, aligned with
+      model_names. If given, models are scored locally in one pass over the
+      data instead of with ML Engine batch prediction jobs.
+    local_batch_size: batch size of local predictions.
+    local_num_workers: number of concurrent local predictions.
   """
   os.environ['GCS_READ_CACHE_MAX_SIZE_MB'] = '0' #Faster to access GCS file + https://github.com/tensorflow/tensorflow/issues/15530
   nltk.download('punkt')
@@ -113,7 +129,14 @@ def score_data(model_names,
       'tfrecords',
       'performance_dataset_dir_3')
 
-  dataset = Dataset(input_fn, performance_dataset_dir)
+  if saved_model_dirs:
+    backend = LocalBackend(
+        dict(zip(model_names, saved_model_dirs)),
+        batch_size=local_batch_size,
+        num_workers=local_num_workers)
+  else:
+    backend = None
+  dataset = Dataset(input_fn, performance_dataset_dir, backend=backend)
   random.seed(2018) # Need to set seed before loading data to be able to reload same data in the future
 
   # Define and call model.
@@ -139,6 +162,12 @@ if __name__ == "__main__":
   print(model_names)
   class_names = [name.strip() for name in FLAGS.class_names.split(',')]
   print(class_names)
+  saved_model_dirs = None
+  if FLAGS.saved_model_dirs:
+    saved_model_dirs = [
+        path.strip() for path in FLAGS.saved_model_dirs.split(',')]
+    if len(saved_model_dirs) != len(model_names):
+      raise ValueError('saved_model_dirs should have one path per model name.')
   score_data(model_names,
              class_names,
              FLAGS.test_data,
@@ -147,4 +176,7 @@ if __name__ == "__main__":
              FLAGS.text_feature_name,
              FLAGS.sentence_key,
              FLAGS.prediction_name,
-             FLAGS.dataset_size)
+             FLAGS.dataset_size,
+             saved_model_dirs,
+             FLAGS.local_batch_size,
+             FLAGS.local_num_workers)
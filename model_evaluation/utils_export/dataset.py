@@ -21,11 +21,14 @@ from __future__ import print_function
 import inspect
 import os
 
+import numpy as np
 import pandas as pd
 import tensorflow as tf
 from tensorflow.python.platform import tf_logging as logging
 
+import utils_export.prediction_cache as prediction_cache
 import utils_export.utils_cloudml as utils_cloudml
+import utils_export.utils_local as utils_local
 import utils_export.utils_tfrecords as utils_tfrecords
 
 # Quota for concurrent prediction jobs
@@ -98,6 +101,120 @@ class Model(object):
     return self._job_ids_prediction
 
 
+def _split_model_name(model_name_full):
+  """Splits `$MODEL_NAME:$VERSION` into (model_name, version or None)."""
+  model_name_split = model_name_full.split(':')
+  model_name = model_name_split[0]
+  if len(model_name_split) > 1:
+    version = model_name_split[1]
+  else:
+    version = None
+  return model_name, version
+
+
+class CloudMLEBackend(object):
+  """Runs predictions with Cloud MLE batch prediction jobs."""
+
+  # Number of model versions that can be scored at the same time.
+  max_models_per_call = CMLE_QUOTA_PREDICTION
+
+  def call_prediction(self, model, input_tf_records, output_prediction_paths):
+    """Starts a batch prediction job per model version.
+
+    Args:
+      model: a `Model` instance.
+      input_tf_records: path to the input tf-records.
+      output_prediction_paths: Dict mapping each of model.model_names() to the
+        directory where to write its predictions.
+    """
+    if len(model.model_names()) > CMLE_QUOTA_PREDICTION:
+      raise ValueError('Model should not contain more than {} versions.'
+                       ' If you need more, split the version into two'
+                       ' different models.'.format(CMLE_QUOTA_PREDICTION))
+
+    job_ids = []
+    for model_name_full in model.model_names():
+      model_name, version = _split_model_name(model_name_full)
+      job_id = utils_cloudml.call_model_predictions_from_df(
+          project_name=model.project_name(),
+          input_tf_records=input_tf_records,
+          output_prediction_path=output_prediction_paths[model_name_full],
+          model_name=model_name,
+          version_name=version)
+      job_ids.append(job_id)
+    model.set_job_ids_prediction(job_ids)
+
+  def prediction_source(self, model_name):
+    """Identifies what model_name is scored with: the deployed version."""
+    return model_name
+
+  def wait_predictions(self, model):
+    """Loops until the prediction jobs of the model completed."""
+
+    if not hasattr(model, 'job_ids_prediction'):
+      raise ValueError(
+          'Model does not have any `job_ids_prediction`.'
+          ' You need to run `call_prediction` for CMLE batch prediction job.')
+
+    for job_id in model.job_ids_prediction():
+      utils_cloudml.check_job_over(model.project_name(), job_id)
+
+
+class LocalBackend(object):
+  """Runs predictions locally on exported SavedModels.
+
+  Predictions are written in the layout of Cloud MLE batch prediction jobs,
+  so `Dataset.collect_prediction` is the same for both backends.
+  """
+
+  max_models_per_call = None
+
+  def __init__(self, saved_model_dirs=None, batch_size=256, num_workers=1):
+    """Initializes a local backend.
+
+    Args:
+      saved_model_dirs (optional): Dict mapping model names (as given in
+        `Model.model_names()`) to the directory of their SavedModel. Model
+        names missing from it are used as SavedModel directories.
+      batch_size: Number of examples scored by one call to a model.
+      num_workers: Number of (model, batch) pairs scored concurrently. The
+        input is read once and shared by all the models.
+    """
+    self._saved_model_dirs = saved_model_dirs or {}
+    self._batch_size = batch_size
+    self._num_workers = num_workers
+
+  def call_prediction(self, model, input_tf_records, output_prediction_paths):
+    """Runs the predictions of all model versions in one pass over the input."""
+    model_names = model.model_names()
+    if not model_names:
+      return
+    utils_local.predict_tf_records_models(
+        [self._saved_model_dir(name) for name in model_names],
+        input_tf_records,
+        [output_prediction_paths[name] for name in model_names],
+        batch_size=self._batch_size,
+        num_workers=self._num_workers)
+
+  def wait_predictions(self, model):
+    """Predictions are over when `call_prediction` returns."""
+    del model
+
+  def prediction_source(self, model_name):
+    """Identifies what model_name is scored with: its SavedModel directory."""
+    return '{}@{}'.format(model_name, self._saved_model_dir(model_name))
+
+  def _saved_model_dir(self, model_name):
+    return self._saved_model_dirs.get(model_name, model_name)
+
+
+def _prediction_columns(model_name, class_names):
+  """Returns the columns added by `collect_prediction` for a model version."""
+  if class_names is None:
+    return [model_name]
+  return ['{}_{}'.format(model_name, class_name) for class_name in class_names]
+
+
 class Dataset(object):
   """Defines a format for every dataset to work with evaluation pipeline.
 
@@ -115,17 +232,27 @@ class Dataset(object):
   dataset.show_data()
   """
 
-  def __init__(self, input_fn, dataset_dir):
+  def __init__(self,
+               input_fn,
+               dataset_dir,
+               backend=None,
+               prediction_cache=None):
     """Initialises a `Dataset` instance.
 
     Args:
       input_fn: function that returns a pandas `Dataframe`.
       dataset_dir: Directory where to save the temporary files, in particular
         tf_records inputs and outputs of CMLE.
+      backend (optional): Backend running the predictions, a
+        `CloudMLEBackend` (default) or a `LocalBackend`.
+      prediction_cache (optional): A `PredictionCache`. If given, predictions
+        are only computed for the rows that are not in the cache.
     """
     self.check_input_fn(input_fn)
     self._input_fn = input_fn
     self._dataset_dir = dataset_dir
+    self._backend = backend or CloudMLEBackend()
+    self._prediction_cache = prediction_cache
 
   def show_data(self):
     if not hasattr(self, 'data'):
@@ -210,37 +337,19 @@ class Dataset(object):
                                                path_input_tf, example_key)
 
   def call_prediction(self, model):
-    """Starts a CMLE batch prediction job for the model."""
+    """Starts the predictions of the model with the dataset backend."""
 
     path_input_tf = self.get_path_input_tf()
     if not tf.gfile.Exists(path_input_tf):
       raise ValueError('Dataset does not have input_tf_records yet.'
                        ' You need to run `convert_data_to_tf` first.')
-    
-    if len(model.model_names()) > CMLE_QUOTA_PREDICTION:
-      raise ValueError('Model should not contain more than {} versions.'
-                       ' If you need more, split the version into two'
-                       ' different models.'.format(CMLE_QUOTA_PREDICTION))
-
-    job_ids = []
-    for model_name_full in model.model_names():
 
-      model_name_split = model_name_full.split(':')
-      model_name = model_name_split[0]
-      if len(model_name_split) > 1:
-        version = model_name_split[1]
-      else:
-        version = None
-
-      output_pred_path = self.get_path_prediction(model_name_full)
-      job_id = utils_cloudml.call_model_predictions_from_df(
-          project_name=model.project_name(),
-          input_tf_records=path_input_tf,
-          output_prediction_path=output_pred_path,
-          model_name=model_name,
-          version_name=version)
-      job_ids.append(job_id)
-    model.set_job_ids_prediction(job_ids)
+    output_prediction_paths = {
+        model_name: self.get_path_prediction(model_name)
+        for model_name in model.model_names()
+    }
+    self._backend.call_prediction(model, path_input_tf,
+                                  output_prediction_paths)
 
   def collect_prediction(self, model, class_names):
     """Collects the predictions of CMLE jobs and adds it to dataframe."""
@@ -256,15 +365,8 @@ class Dataset(object):
           class_names=class_names)
 
   def wait_predictions(self, model):
-    """Loops until the prediction jobs of the model completed."""
-
-    if not hasattr(model, 'job_ids_prediction'):
-      raise ValueError(
-          'Model does not have any `job_ids_prediction`.'
-          ' You need to run `call_prediction` for CMLE batch prediction job.')
-
-    for job_id in model.job_ids_prediction():
-      utils_cloudml.check_job_over(model.project_name(), job_id)
+    """Waits until the predictions of the model completed."""
+    self._backend.wait_predictions(model)
 
   def add_model_prediction_to_data(self, model, recompute_predictions=True, class_names=None):
     """Computes the prediction of the model and adds it to dataframe.
@@ -277,7 +379,26 @@ class Dataset(object):
         order).
       class_names (optional): If the model is a multiclass model, you can specify class names.
           The model will then return a logit value per class instead of a single value.
+
+    If the dataset has a prediction cache and recompute_predictions is True,
+    only the rows missing from the cache are scored, and the cache is saved.
     """
+    self.check_compatibility(model)
+
+    if recompute_predictions and self._prediction_cache is not None:
+      self._add_cached_predictions(model, class_names)
+    elif recompute_predictions:
+      self._compute_predictions(model)
+      self.collect_prediction(model, class_names)
+    else:
+      logging.warning(
+          'Using past predictions. '
+          'the data must match exactly (same number of lines and same order).')
+      self.collect_prediction(model, class_names)
+
+  def _compute_predictions(self, model):
+    """Runs the predictions of all the model versions on self.data."""
+
     def _compute_predictions_less_than_quota(self, model, need_to_convert_data=True):
       """Runs predictions for a model that has less than $QUOTA versions."""
       if need_to_convert_data:
@@ -285,28 +406,64 @@ class Dataset(object):
       self.call_prediction(model)
       self.wait_predictions(model)
 
-    self.check_compatibility(model)
-
-    if recompute_predictions:
-
-      num_epochs = int(len(model.model_names()) / CMLE_QUOTA_PREDICTION)
-      for i in range(0, num_epochs + 1):
-        logging.info('Doing batch {}/{}'.format(i, num_epochs))
-        min_index = i*CMLE_QUOTA_PREDICTION
-        max_index = min((i + 1) * CMLE_QUOTA_PREDICTION, len(model.model_names()))
-        sub_model_names = model.model_names()[min_index:max_index]
-        sub_model = Model(
-          model.feature_keys_spec(),
-          model.prediction_keys(),
-          sub_model_names,
-          model.project_name(),
-          model.example_key())
-        need_to_convert_data = (i == 0)
-        _compute_predictions_less_than_quota(self, sub_model, need_to_convert_data)
-
-    else:
-      logging.warning(
-          'Using past predictions. '
-          'the data must match exactly (same number of lines and same order).')
+    models_per_call = (self._backend.max_models_per_call or
+                       max(len(model.model_names()), 1))
+    num_epochs = int(len(model.model_names()) / models_per_call)
+    for i in range(0, num_epochs + 1):
+      logging.info('Doing batch {}/{}'.format(i, num_epochs))
+      min_index = i*models_per_call
+      max_index = min((i + 1) * models_per_call, len(model.model_names()))
+      sub_model_names = model.model_names()[min_index:max_index]
+      sub_model = Model(
+        model.feature_keys_spec(),
+        model.prediction_keys(),
+        sub_model_names,
+        model.project_name(),
+        model.example_key())
+      need_to_convert_data = (i == 0)
+      _compute_predictions_less_than_quota(self, sub_model, need_to_convert_data)
+
+  def _add_cached_predictions(self, model, class_names):
+    """Adds the predictions of the model, scoring only rows not in the cache."""
+    cache = self._prediction_cache
+    n_values = 1 if class_names is None else len(class_names)
+    hashes = prediction_cache.hash_examples(
+        utils_tfrecords.serialize_pandas_to_examples(
+            self.data, model.feature_keys_spec()))
+
+    # Predictions are cached by model version, by where it is run from and by
+    # predicted output, so that none of them changing can return stale values.
+    cache_keys = {
+        model_name: '{}|{}'.format(
+            self._backend.prediction_source(model_name),
+            model.prediction_keys()) for model_name in model.model_names()
+    }
+    cached_values = {}
+    missing = np.zeros(len(self.data), dtype=bool)
+    for model_name in model.model_names():
+      values, found = cache.lookup(cache_keys[model_name], hashes, n_values)
+      cached_values[model_name] = values
+      missing |= ~found
+    logging.info('{}/{} rows are not in the prediction cache.'.format(
+        missing.sum(), len(self.data)))
+
+    if missing.any():
+      data = self.data
+      self.data = data[missing].reset_index(drop=True)
+      try:
+        self._compute_predictions(model)
+        self.collect_prediction(model, class_names)
+        scored = self.data
+      finally:
+        self.data = data
+      for model_name in model.model_names():
+        columns = _prediction_columns(model_name, class_names)
+        values = scored[columns].values
+        cached_values[model_name][missing] = values
+        cache.update(cache_keys[model_name], hashes[missing], values)
+      cache.save()
 
-    self.collect_prediction(model, class_names)
+    for model_name in model.model_names():
+      columns = _prediction_columns(model_name, class_names)
+      for i, column in enumerate(columns):
+        self.data[column] = cached_values[model_name][:, i]
@@ -0,0 +1,150 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Defines a cache of model predictions keyed by example content."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import io
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.platform import tf_logging as logging
+
+
+def hash_examples(serialized_examples):
+  """Returns the SHA-1 digests of serialized examples, as a bytes array."""
+  return np.array(
+      [hashlib.sha1(example).digest() for example in serialized_examples],
+      dtype='S20')
+
+
+class PredictionCache(object):
+  """Cache of predictions keyed by (model key, hash of the input example).
+
+  Rows are identified by their content rather than their position, so the
+  cache can be reused by datasets that overlap or are ordered differently.
+  The model key identifies both the model version and the predicted output
+  (see `Dataset`), as the same model can be asked for different outputs.
+  When it holds more than `max_entries` predictions, the least recently used
+  ones are evicted.
+
+  Usage:
+
+  cache = PredictionCache(os.path.join(cache_dir, 'predictions.npz'))
+  dataset = Dataset(input_fn, dataset_dir, prediction_cache=cache)
+  dataset.add_model_prediction_to_data(model)  # Saves the cache.
+  """
+
+  def __init__(self, path, max_entries=1000000):
+    """Initializes a cache, loading it from `path` if it exists.
+
+    Args:
+      path: Path of the .npz file storing the cache (local or GCS).
+      max_entries: Maximum number of (model, example) predictions kept.
+    """
+    self._path = path
+    self._max_entries = max_entries
+    # Maps (model key, hash) to the prediction values, oldest use first.
+    self._entries = collections.OrderedDict()
+    if tf.gfile.Exists(path):
+      self._load()
+
+  def __len__(self):
+    return len(self._entries)
+
+  def _load(self):
+    with tf.gfile.Open(self._path, 'rb') as fileobj:
+      arrays = np.load(io.BytesIO(fileobj.read()))
+    model_names = arrays['model_names']
+    for model, key, values, width in zip(arrays['models'], arrays['hashes'],
+                                         arrays['values'], arrays['widths']):
+      self._entries[(model_names[model], key)] = values[:width]
+    logging.info('Loaded {} cached predictions from {}.'.format(
+        len(self._entries), self._path))
+
+  def save(self):
+    """Writes the cache to a compressed .npz file, oldest use first."""
+    model_names = sorted(set(model for model, _ in self._entries))
+    model_indexes = {model: i for i, model in enumerate(model_names)}
+    n_entries = len(self._entries)
+    max_width = max([len(v) for v in self._entries.values()] or [0])
+
+    models = np.zeros(n_entries, dtype=np.int32)
+    hashes = np.zeros(n_entries, dtype='S20')
+    values = np.full((n_entries, max_width), np.nan)
+    widths = np.zeros(n_entries, dtype=np.int32)
+    for i, ((model, key), value) in enumerate(self._entries.items()):
+      models[i] = model_indexes[model]
+      hashes[i] = key
+      values[i, :len(value)] = value
+      widths[i] = len(value)
+
+    buf = io.BytesIO()
+    np.savez_compressed(
+        buf,
+        model_names=np.array(model_names, dtype=np.str_),
+        models=models,
+        hashes=hashes,
+        values=values,
+        widths=widths)
+    # Written next to the cache and renamed, so that an interrupted save does
+    # not leave a truncated cache behind.
+    tmp_path = self._path + '.tmp'
+    with tf.gfile.Open(tmp_path, 'wb') as fileobj:
+      fileobj.write(buf.getvalue())
+    tf.gfile.Rename(tmp_path, self._path, overwrite=True)
+
+  def lookup(self, model_key, hashes, n_values):
+    """Returns the cached predictions of a model for examples.
+
+    Args:
+      model_key: String identifying the model version and its output.
+      hashes: Array of example hashes, as returned by `hash_examples`.
+      n_values: Number of prediction values per example.
+
+    Returns:
+      values: Array of shape (len(hashes), n_values), NaN where not cached.
+      found: Boolean array, True for the examples found in the cache.
+    """
+    values = np.full((len(hashes), n_values), np.nan)
+    found = np.zeros(len(hashes), dtype=bool)
+    for i, key in enumerate(hashes):
+      value = self._entries.pop((model_key, key), None)
+      if value is None:
+        continue
+      # Re-inserting marks the entry as most recently used.
+      self._entries[(model_key, key)] = value
+      if len(value) == n_values:
+        values[i] = value
+        found[i] = True
+    return values, found
+
+  def update(self, model_key, hashes, values):
+    """Adds the predictions of a model, evicting the least recently used.
+
+    Args:
+      model_key: String identifying the model version and its output.
+      hashes: Array of example hashes, as returned by `hash_examples`.
+      values: Array of shape (len(hashes), n_values) of predictions.
+    """
+    for key, value in zip(hashes, np.asarray(values, dtype=np.float64)):
+      self._entries.pop((model_key, key), None)
+      self._entries[(model_key, key)] = value
+    while len(self._entries) > self._max_entries:
+      self._entries.popitem(last=False)
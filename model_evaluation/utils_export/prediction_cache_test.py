@@ -0,0 +1,85 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for the prediction cache."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+import prediction_cache
+
+
+class TestPredictionCache(unittest.TestCase):
+  """Tests lookups, LRU eviction and persistence of `PredictionCache`."""
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._path = os.path.join(self._dir, 'cache.npz')
+    self._hashes = prediction_cache.hash_examples(
+        [b'a', b'b', b'c', b'd'])
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_lookup(self):
+    cache = prediction_cache.PredictionCache(self._path)
+    cache.update('model:v1', self._hashes[:2], [[.1], [.2]])
+
+    values, found = cache.lookup('model:v1', self._hashes[::-1], 1)
+    np.testing.assert_array_equal(found, [False, False, True, True])
+    np.testing.assert_array_equal(values[2:], [[.2], [.1]])
+    self.assertTrue(np.isnan(values[:2]).all())
+
+    _, found = cache.lookup('model:v2', self._hashes, 1)
+    self.assertFalse(found.any())
+    _, found = cache.lookup('model:v1', self._hashes, 2)
+    self.assertFalse(found.any())
+
+  def test_least_recently_used_are_evicted(self):
+    cache = prediction_cache.PredictionCache(self._path, max_entries=3)
+    cache.update('model:v1', self._hashes[:3], [[.1], [.2], [.3]])
+    cache.lookup('model:v1', self._hashes[:1], 1)
+    cache.update('model:v1', self._hashes[3:], [[.4]])
+
+    self.assertEqual(len(cache), 3)
+    _, found = cache.lookup('model:v1', self._hashes, 1)
+    np.testing.assert_array_equal(found, [True, False, True, True])
+
+  def test_save_and_load(self):
+    cache = prediction_cache.PredictionCache(self._path)
+    cache.update('model:v1', self._hashes[:2], [[.1], [.2]])
+    cache.update('model:v2', self._hashes[1:], [[.1, .9], [.2, .8], [.3, .7]])
+    cache.save()
+    self.assertEqual(os.listdir(self._dir), ['cache.npz'])
+
+    loaded = prediction_cache.PredictionCache(self._path)
+    self.assertEqual(len(loaded), 5)
+    values, found = loaded.lookup('model:v2', self._hashes, 2)
+    np.testing.assert_array_equal(found, [False, True, True, True])
+    np.testing.assert_array_equal(values[1:], [[.1, .9], [.2, .8], [.3, .7]])
+    values, found = loaded.lookup('model:v1', self._hashes, 1)
+    np.testing.assert_array_equal(found, [True, True, False, False])
+    np.testing.assert_array_equal(values[:2], [[.1], [.2]])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -20,16 +20,23 @@ from __future__ import print_function
 
 import datetime
 import json
+import numbers
 import os
 import re
 import time
 
 import googleapiclient.discovery as discovery
 import googleapiclient.errors as errors
+import numpy as np
 import tensorflow as tf
 from tensorflow.python.lib.io import file_io
 from tensorflow.python.platform import tf_logging as logging
 
+try:
+  import ujson as json_decoder
+except ImportError:
+  json_decoder = json
+
 
 def call_model_predictions_from_df(project_name,
                                    input_tf_records,
@@ -181,14 +188,32 @@ def check_job_over(project_name, job_name):
   logging.info('Prediction job completed.')
 
 
+def _read_prediction_lines(prediction_files):
+  """Yields (file, line number, line) for the non-empty prediction lines."""
+  for prediction_file in prediction_files:
+    with file_io.FileIO(prediction_file, 'r') as f:
+      for line_number, line in enumerate(f, 1):
+        if line.strip():
+          yield prediction_file, line_number, line
+
+
+def _describe_keys(keys, max_keys=10):
+  """Formats a few example keys for error messages."""
+  keys = list(keys)
+  description = ', '.join(str(key) for key in keys[:max_keys])
+  if len(keys) > max_keys:
+    description += ', ...'
+  return '{} ({})'.format(len(keys), description)
+
+
 def add_model_predictions_to_df(df, prediction_file, model_col_name,
-                                prediction_name, example_key, class_names):
+                                prediction_name, example_key, class_names=None):
   """Loads the prediction files and adds the model scores to a DataFrame.
 
   Args:
     df: a pandas `DataFrame`.
     prediction_file: Path to the prediction files (outputs of CMLE prediction
-      job).
+      job). All the `prediction.results-*` shards in it are read.
     model_col_name: Column name of the prediction values in df (added column).
     prediction_name: Name of the column to retrieve from CMLE predictions.
     example_key: key identifier of an example.
@@ -200,60 +225,88 @@ def add_model_predictions_to_df(df, prediction_file, model_col_name,
 
   Raises:
     ValueError: dataframe and  prediction file do not correspond exactly
-      In particular, they must have same number of lines and same order.
-    ValueError: prediction file does not exist.
-
-  This function reads the prediction file and extracts the fields
-  'prediction_name'
-    and example_key. It orders the results based on example_key and then adds
-    them to df
-    in a new column called 'model_col_name'.
+      In particular, every row of df must have exactly one prediction.
+    ValueError: prediction file does not exist or can not be parsed.
+
+  This function streams the prediction files and extracts the fields
+  'prediction_name' and example_key. The example keys are the row positions in
+  df (as written by `encode_pandas_to_tfrecords`), and each prediction is
+  stored at the row of its key in a new column called 'model_col_name'.
+  Without class_names, the first value of each prediction is used; with
+  class_names, predictions must have exactly one value per class.
   """
 
-  prediction_file = os.path.join(prediction_file,
-                                 'prediction.results-00000-of-00001')
-  if not tf.gfile.Exists(prediction_file):
+  prediction_files = sorted(
+      tf.gfile.Glob(os.path.join(prediction_file, 'prediction.results-*')))
+  if not prediction_files:
     raise ValueError(
         'Prediction file does not exist.'
         ' You need to call prediction job and wait for completion.')
 
-  def _load_predictions(pred_file):
-    with file_io.FileIO(pred_file, 'r') as f:
-      # prediction file needs to fit in memory.
-      try:
-        predictions = [json.loads(line) for line in f]
-      except:
-        predictions = []
-    return predictions
-
-  predictions = _load_predictions(prediction_file)
-
-  if not predictions:
+  n_values = 1 if class_names is None else len(class_names)
+  values = np.full((len(df), n_values), np.nan)
+  n_predictions = np.zeros(len(df), dtype=np.int64)
+  unexpected_keys = []
+
+  lines = _read_prediction_lines(prediction_files)
+  for path, line_number, line in lines:
+    try:
+      prediction = json_decoder.loads(line)
+    except ValueError as e:
+      raise ValueError('Could not parse line {} of prediction file {}: {}'
+                       .format(line_number, path, e))
+    for parameter, field in [('example_key', example_key),
+                             ('prediction_name', prediction_name)]:
+      if field not in prediction:
+        raise ValueError(
+            "Predictions do not contain the '{0}' field."
+            " Verify that your '{0}' parameter (set to {1}) matches the CMLE"
+            " model signature (line {2} of prediction file {3}).".format(
+                parameter, field, line_number, path))
+
+    key = prediction[example_key]
+    if (not isinstance(key, numbers.Integral) or isinstance(key, bool) or
+        not 0 <= key < len(df)):
+      unexpected_keys.append(key)
+      continue
+    scores = prediction[prediction_name]
+    if class_names is None and isinstance(scores, list):
+      scores = scores[:1]
+    if not isinstance(scores, list) or len(scores) != n_values:
+      raise ValueError(
+          'Line {} of prediction file {}: {} should be a list of {} values,'
+          ' got {}.'.format(line_number, path, prediction_name, n_values,
+                            scores))
+    n_predictions[key] += 1
+    values[key] = scores
+
+  if not n_predictions.any() and not unexpected_keys:
     raise ValueError(
         'The prediction file returned by CMLE is empty.'
-        ' It might be due to a badly formatted tfrecord input file that can not be'
-        ' parsed by CMLE (wrong input signature given by a `Model` instance).'
-        ' Check the logs of your CMLE job for further details.')
-  if example_key not in predictions[0]:
-    raise ValueError(
-        "Predictions do not contain the 'example_key' field."
-        " Verify that your 'example_key' parameter (set to {})"
-        " matches the CMLE model signature.".format(example_key))
-  if prediction_name not in predictions[0]:
-    raise ValueError(
-        "Predictions do not contain the 'prediction_name' field."
-        " Verify that your 'prediction_name' parameter (set to {})"
-        " matches the CMLE model signature.".format(prediction_name))
-  if len(predictions) != len(df):
-    raise ValueError('The dataframe and the prediction file do not contain'
-                     ' the same number of lines.')
-
-  predictions = sorted(predictions, key=lambda x: x[example_key])
+        ' It might be due to a badly formatted tfrecord input file that can'
+        ' not be parsed by CMLE (wrong input signature given by a `Model`'
+        ' instance). Check the logs of your CMLE job for further details.')
+
+  mismatches = []
+  if unexpected_keys:
+    mismatches.append('{} example keys are not rows of the dataframe.'.format(
+        _describe_keys(unexpected_keys)))
+  missing_keys = np.flatnonzero(n_predictions == 0)
+  if len(missing_keys):
+    mismatches.append('{} example keys have no prediction.'.format(
+        _describe_keys(missing_keys)))
+  duplicate_keys = np.flatnonzero(n_predictions > 1)
+  if len(duplicate_keys):
+    mismatches.append('{} example keys have several predictions.'.format(
+        _describe_keys(duplicate_keys)))
+  if mismatches:
+    raise ValueError('The dataframe and the prediction files do not match: '
+                     + ' '.join(mismatches))
+
   if class_names is None:
-      prediction_proba = [x[prediction_name][0] for x in predictions]
-      df[model_col_name] = prediction_proba
+    df[model_col_name] = values[:, 0]
   else:
-      for i, class_name in enumerate(class_names):
-            df['{}_{}'.format(model_col_name,class_name)] = [x[prediction_name][i] for x in predictions]
+    for i, class_name in enumerate(class_names):
+      df['{}_{}'.format(model_col_name, class_name)] = values[:, i]
 
   return df
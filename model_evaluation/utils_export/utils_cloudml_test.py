@@ -18,9 +18,14 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
-import pandas as pd
+import json
+import os
+import shutil
+import tempfile
 import unittest
 
+import pandas as pd
+
 import utils_cloudml
 
 
@@ -126,5 +131,100 @@ class AddModelPredictionsToDf(unittest.TestCase):
         output_df.sort_index(axis=1), right_output.sort_index(axis=1))
 
 
+class AddModelPredictionsToDfLocalShards(unittest.TestCase):
+  """Tests `add_model_predictions_to_df` on local prediction shards."""
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._df = pd.DataFrame({'text': ['a', 'b', 'c', 'd']})
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def _write_shards(self, shards):
+    for i, predictions in enumerate(shards):
+      path = os.path.join(
+          self._dir, 'prediction.results-{:05d}-of-{:05d}'.format(
+              i, len(shards)))
+      with open(path, 'w') as f:
+        for prediction in predictions:
+          f.write(json.dumps(prediction) + '\n')
+
+  def _add_predictions(self, class_names=None):
+    return utils_cloudml.add_model_predictions_to_df(
+        self._df, self._dir, 'model', 'scores', 'key', class_names)
+
+  def test_shards_are_joined_by_key(self):
+    self._write_shards([
+        [{'key': 3, 'scores': [.3, .7]}, {'key': 0, 'scores': [.0, 1.]}],
+        [{'key': 2, 'scores': [.2, .8]}, {'key': 1, 'scores': [.1, .9]}],
+    ])
+    output_df = self._add_predictions(class_names=['neg', 'pos'])
+    self.assertEqual(list(output_df['model_neg']), [.0, .1, .2, .3])
+    self.assertEqual(list(output_df['model_pos']), [1., .9, .8, .7])
+
+  def test_missing_and_duplicate_keys(self):
+    self._write_shards([
+        [{'key': 0, 'scores': [.0]}, {'key': 1, 'scores': [.1]}],
+        [{'key': 1, 'scores': [.1]}, {'key': 7, 'scores': [.7]}],
+    ])
+    with self.assertRaises(ValueError) as context:
+      self._add_predictions()
+    message = str(context.exception)
+    self.assertIn('1 (7) example keys are not rows of the dataframe.', message)
+    self.assertIn('2 (2, 3) example keys have no prediction.', message)
+    self.assertIn('1 (1) example keys have several predictions.', message)
+
+  def test_first_value_without_class_names(self):
+    self._write_shards([[{'key': i, 'scores': [i / 10., 1 - i / 10.]}
+                         for i in range(4)]])
+    output_df = self._add_predictions()
+    self.assertEqual(list(output_df['model']), [.0, .1, .2, .3])
+
+  def test_missing_field_after_first_line(self):
+    self._write_shards([
+        [{'key': 0, 'scores': [.0]}, {'key': 1, 'scores': [.1]}],
+        [{'key': 2, 'scores': [.2]}, {'key': 3}],
+    ])
+    with self.assertRaises(ValueError) as context:
+      self._add_predictions()
+    message = str(context.exception)
+    self.assertIn("Predictions do not contain the 'prediction_name' field.",
+                  message)
+    self.assertIn('line 2 of prediction file', message)
+    self.assertIn('prediction.results-00001-of-00002', message)
+
+  def test_non_integer_keys(self):
+    self._write_shards([[
+        {'key': 0, 'scores': [.0]}, {'key': 1.5, 'scores': [.1]},
+        {'key': '2', 'scores': [.2]}, {'key': 3, 'scores': [.3]}
+    ]])
+    with self.assertRaises(ValueError) as context:
+      self._add_predictions()
+    message = str(context.exception)
+    self.assertIn('2 (1.5, 2) example keys are not rows of the dataframe.',
+                  message)
+    self.assertIn('2 (1, 2) example keys have no prediction.', message)
+
+  def test_wrong_number_of_values(self):
+    self._write_shards([[{'key': 0, 'scores': [.0, 1.]},
+                         {'key': 1, 'scores': [.1]}]])
+    with self.assertRaises(ValueError) as context:
+      self._add_predictions(class_names=['neg', 'pos'])
+    self.assertIn('Line 2 of prediction file', str(context.exception))
+    self.assertIn('scores should be a list of 2 values',
+                  str(context.exception))
+
+  def test_malformed_line(self):
+    self._write_shards([[{'key': 0, 'scores': [.0]}]])
+    with open(os.path.join(self._dir, 'prediction.results-00000-of-00001'),
+              'a') as f:
+      f.write('{"key": 1, "scores"\n')
+    with self.assertRaises(ValueError) as context:
+      self._add_predictions()
+    self.assertIn('Could not parse line 2 of prediction file',
+                  str(context.exception))
+
+
 if __name__ == '__main__':
   unittest.main()
\ No newline at end of file
@@ -0,0 +1,199 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Defines some utilities to run batch predictions locally on SavedModels.
+
+The prediction files follow the layout of Cloud MLE batch prediction jobs
+(JSON lines in `prediction.results-00000-of-00001`), so they can be parsed
+by `utils_cloudml.add_model_predictions_to_df`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import json
+import os
+import time
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.lib.io import file_io
+from tensorflow.python.platform import tf_logging as logging
+
+PREDICTION_FILE_NAME = 'prediction.results-00000-of-00001'
+
+
+def _read_batches(input_tf_records, batch_size):
+  """Yields lists of serialized examples from the tf-records files."""
+  filenames = sorted(tf.gfile.Glob(input_tf_records))
+  if not filenames:
+    raise ValueError('tf_records do not exist.')
+  batch = []
+  for filename in filenames:
+    for serialized in tf.python_io.tf_record_iterator(filename):
+      batch.append(serialized)
+      if len(batch) == batch_size:
+        yield batch
+        batch = []
+  if batch:
+    yield batch
+
+
+def _to_json_value(value):
+  """Converts a numpy prediction value to a JSON serializable value."""
+  if isinstance(value, np.ndarray):
+    return [_to_json_value(x) for x in value]
+  if isinstance(value, bytes):
+    return value.decode('utf-8')
+  if isinstance(value, np.generic):
+    return value.item()
+  return value
+
+
+def load_predictor(saved_model_dir):
+  """Loads a SavedModel and returns a function scoring serialized examples.
+
+  Args:
+    saved_model_dir: Directory of a SavedModel, as written by
+      `ModelTrainer.export`. Its serving signature must take serialized
+      tf.Examples as single input.
+
+  Returns:
+    A function mapping a list of serialized examples to a dict of numpy
+    arrays, one entry per model output, batched on the first dimension.
+
+  Raises:
+    ValueError: if the serving signature does not have a single input.
+  """
+  predictor = tf.contrib.predictor.from_saved_model(saved_model_dir)
+  if len(predictor.feed_tensors) != 1:
+    raise ValueError(
+        'The serving signature of {} should take serialized examples as'
+        ' single input, got {}.'.format(saved_model_dir,
+                                        list(predictor.feed_tensors)))
+  input_key = list(predictor.feed_tensors)[0]
+
+  def _predict(serialized_examples):
+    return predictor({input_key: serialized_examples})
+
+  return _predict
+
+
+def predict_tf_records(saved_model_dir,
+                       input_tf_records,
+                       output_prediction_path,
+                       batch_size=256,
+                       num_workers=1):
+  """Runs predictions of a SavedModel over tf-records.
+
+  Args:
+    saved_model_dir: Directory of the SavedModel to run.
+    input_tf_records: path (or glob pattern) to input tf_records.
+    output_prediction_path: Directory where to write the predictions, in the
+      same layout as a Cloud MLE batch prediction job.
+    batch_size: Number of examples scored by one call to the model.
+    num_workers: Number of batches scored concurrently.
+
+  Returns:
+    The number of scored examples.
+
+  Raises:
+    ValueError: if input_tf_records does not exist.
+  """
+  return predict_tf_records_models([saved_model_dir], input_tf_records,
+                                   [output_prediction_path], batch_size,
+                                   num_workers)
+
+
+def predict_tf_records_models(saved_model_dirs,
+                              input_tf_records,
+                              output_prediction_paths,
+                              batch_size=256,
+                              num_workers=1):
+  """Runs predictions of several SavedModels over the same tf-records.
+
+  The input is read and batched once. Each batch is scored by every model,
+  with up to num_workers (model, batch) pairs running concurrently. Pairs are
+  submitted as earlier ones complete, so only the batches being scored are
+  held in memory.
+
+  Args:
+    saved_model_dirs: List of directories of the SavedModels to run.
+    input_tf_records: path (or glob pattern) to input tf_records.
+    output_prediction_paths: List of directories where to write the
+      predictions of each model, in the same layout as a Cloud MLE batch
+      prediction job.
+    batch_size: Number of examples scored by one call to a model.
+    num_workers: Number of (model, batch) pairs scored concurrently.
+
+  Returns:
+    The number of scored examples.
+
+  Raises:
+    ValueError: if input_tf_records does not exist.
+  """
+  predictors = [load_predictor(path) for path in saved_model_dirs]
+  n_models = len(predictors)
+
+  def _score(index, batch):
+    start_time = time.time()
+    outputs = predictors[index](batch)
+    return index, outputs, time.time() - start_time
+
+  files = []
+  for output_prediction_path in output_prediction_paths:
+    file_io.recursive_create_dir(output_prediction_path)
+    files.append(
+        file_io.FileIO(
+            os.path.join(output_prediction_path, PREDICTION_FILE_NAME), 'w'))
+
+  counts = [0] * n_models
+  seconds = [0.] * n_models
+
+  def _write(index, outputs, duration):
+    keys = sorted(outputs)
+    n_examples = len(outputs[keys[0]])
+    for i in range(n_examples):
+      prediction = {key: _to_json_value(outputs[key][i]) for key in keys}
+      files[index].write(json.dumps(prediction) + '\n')
+    counts[index] += n_examples
+    seconds[index] += duration
+    if index == 0 and not counts[0] % (100 * batch_size):
+      logging.info('Scored {} examples.'.format(counts[0]))
+
+  pool = ThreadPool(num_workers)
+  # Results are written in submission order, which keeps the order of the
+  # batches for each model.
+  pending = collections.deque()
+  try:
+    for batch in _read_batches(input_tf_records, batch_size):
+      for index in range(n_models):
+        if len(pending) >= num_workers:
+          _write(*pending.popleft().get())
+        pending.append(pool.apply_async(_score, (index, batch)))
+    while pending:
+      _write(*pending.popleft().get())
+  finally:
+    pool.close()
+    pool.join()
+    for f in files:
+      f.close()
+
+  for path, count, duration in zip(saved_model_dirs, counts, seconds):
+    logging.info('Scored {} examples with {} in {:.1f}s ({:.0f} examples/s).'
+                 .format(count, path, duration, count / max(duration, 1e-9)))
+  return counts[0] if counts else 0
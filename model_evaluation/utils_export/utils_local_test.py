@@ -0,0 +1,251 @@
+# Copyright 2016 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for local prediction utilities."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import pandas as pd
+import tensorflow as tf
+
+from dataset import Dataset
+from dataset import LocalBackend
+from dataset import Model
+from prediction_cache import PredictionCache
+import utils_local
+import utils_tfrecords
+
+
+def export_half_model(export_dir):
+  """Exports a SavedModel predicting `x / 2` and `2 x`, with `comment_key`."""
+  with tf.Graph().as_default():
+    serialized = tf.placeholder(
+        shape=[None], dtype=tf.string, name='input_example_tensor')
+    features = tf.parse_example(
+        serialized, {
+            'x':
+                tf.FixedLenFeature([], dtype=tf.int64),
+            'comment_key':
+                tf.FixedLenFeature([], dtype=tf.int64, default_value=-1)
+        })
+    x = tf.expand_dims(tf.cast(features['x'], tf.float32), 1)
+    signature = tf.saved_model.signature_def_utils.predict_signature_def(
+        inputs={'examples': serialized},
+        outputs={
+            'score': x / 2.,
+            'double_score': x * 2.,
+            'comment_key': features['comment_key']
+        })
+    with tf.Session() as sess:
+      builder = tf.saved_model.builder.SavedModelBuilder(export_dir)
+      builder.add_meta_graph_and_variables(
+          sess, [tf.saved_model.tag_constants.SERVING],
+          signature_def_map={
+              tf.saved_model.signature_constants
+              .DEFAULT_SERVING_SIGNATURE_DEF_KEY:
+                  signature
+          })
+      builder.save()
+
+
+class PredictTfRecords(unittest.TestCase):
+  """Tests for `predict_tf_records`."""
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._export_dir = os.path.join(self._dir, 'model')
+    export_half_model(self._export_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_correct(self):
+    input_tf_records = os.path.join(self._dir, 'input.tfrecords')
+    utils_tfrecords.encode_pandas_to_tfrecords(
+        pd.DataFrame({'x': [4, 2, 6, 8, 1]}),
+        {'x': utils_tfrecords.EncodingFeatureSpec.INTEGER}, input_tf_records,
+        'comment_key')
+    output_path = os.path.join(self._dir, 'predictions')
+
+    count = utils_local.predict_tf_records(
+        self._export_dir,
+        input_tf_records,
+        output_path,
+        batch_size=2,
+        num_workers=2)
+
+    self.assertEqual(count, 5)
+    with open(os.path.join(output_path, utils_local.PREDICTION_FILE_NAME)) as f:
+      predictions = [json.loads(line) for line in f]
+    self.assertEqual(predictions, [
+        {'comment_key': 0, 'double_score': [8.], 'score': [2.]},
+        {'comment_key': 1, 'double_score': [4.], 'score': [1.]},
+        {'comment_key': 2, 'double_score': [12.], 'score': [3.]},
+        {'comment_key': 3, 'double_score': [16.], 'score': [4.]},
+        {'comment_key': 4, 'double_score': [2.], 'score': [.5]},
+    ])
+
+
+class PredictTfRecordsModels(unittest.TestCase):
+  """Tests for `predict_tf_records_models`."""
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._export_dir = os.path.join(self._dir, 'model')
+    export_half_model(self._export_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_models_share_input(self):
+    input_tf_records = os.path.join(self._dir, 'input.tfrecords')
+    utils_tfrecords.encode_pandas_to_tfrecords(
+        pd.DataFrame({'x': list(range(7))}),
+        {'x': utils_tfrecords.EncodingFeatureSpec.INTEGER}, input_tf_records,
+        'comment_key')
+    output_paths = [
+        os.path.join(self._dir, 'predictions_{}'.format(i)) for i in range(3)
+    ]
+
+    count = utils_local.predict_tf_records_models(
+        [self._export_dir] * 3,
+        input_tf_records,
+        output_paths,
+        batch_size=3,
+        num_workers=4)
+
+    self.assertEqual(count, 7)
+    for output_path in output_paths:
+      with open(os.path.join(output_path,
+                             utils_local.PREDICTION_FILE_NAME)) as f:
+        predictions = [json.loads(line) for line in f]
+      self.assertEqual([p['comment_key'] for p in predictions], list(range(7)))
+      self.assertEqual([p['score'][0] for p in predictions],
+                       [i / 2. for i in range(7)])
+
+
+class DatasetLocalBackend(unittest.TestCase):
+  """Tests `Dataset` predictions with a `LocalBackend`."""
+
+  def setUp(self):
+    self._dir = tempfile.mkdtemp()
+    self._export_dir = os.path.join(self._dir, 'model')
+    export_half_model(self._export_dir)
+
+  def tearDown(self):
+    shutil.rmtree(self._dir)
+
+  def test_correct(self):
+
+    def input_fn(max_n_examples):
+      return pd.DataFrame({'x': list(range(max_n_examples))})
+
+    dataset = Dataset(
+        input_fn,
+        self._dir,
+        backend=LocalBackend({'half:v1': self._export_dir}, batch_size=2))
+    dataset.load_data(5)
+    model = Model(
+        feature_keys_spec={'x': utils_tfrecords.EncodingFeatureSpec.INTEGER},
+        prediction_keys='score',
+        model_names=['half:v1'],
+        project_name=None,
+        example_key='comment_key')
+
+    dataset.add_model_prediction_to_data(model)
+
+    self.assertEqual(list(dataset.show_data()['half:v1']),
+                     [0., .5, 1., 1.5, 2.])
+
+  def test_prediction_cache(self):
+    rows = {'x': [3, 1, 4, 1, 5]}
+
+    def input_fn(max_n_examples):
+      return pd.DataFrame({'x': rows['x'][:max_n_examples]})
+
+    cache = PredictionCache(os.path.join(self._dir, 'cache.npz'))
+    dataset = Dataset(
+        input_fn,
+        self._dir,
+        backend=LocalBackend({'half:v1': self._export_dir}),
+        prediction_cache=cache)
+    model = Model(
+        feature_keys_spec={'x': utils_tfrecords.EncodingFeatureSpec.INTEGER},
+        prediction_keys='score',
+        model_names=['half:v1'],
+        project_name=None,
+        example_key='comment_key')
+    dataset.load_data(5)
+    dataset.add_model_prediction_to_data(model)
+    self.assertEqual(len(cache), 4)
+
+    # New rows, in another order: only 9 and 2 are scored.
+    rows['x'] = [9, 5, 1, 2, 3]
+    dataset.load_data(5)
+    dataset.add_model_prediction_to_data(model)
+
+    self.assertEqual(list(dataset.show_data()['half:v1']),
+                     [4.5, 2.5, .5, 1., 1.5])
+    scored = list(tf.python_io.tf_record_iterator(dataset.get_path_input_tf()))
+    self.assertEqual(len(scored), 2)
+    self.assertEqual(len(PredictionCache(os.path.join(self._dir,
+                                                      'cache.npz'))), 6)
+
+
+  def test_prediction_cache_misses_other_outputs_and_exports(self):
+    cache = PredictionCache(os.path.join(self._dir, 'cache.npz'))
+    other_export_dir = os.path.join(self._dir, 'other_model')
+    export_half_model(other_export_dir)
+
+    def input_fn(max_n_examples):
+      return pd.DataFrame({'x': [1, 2, 3][:max_n_examples]})
+
+    def add_predictions(prediction_keys, export_dir):
+      dataset = Dataset(
+          input_fn,
+          self._dir,
+          backend=LocalBackend({'half:v1': export_dir}),
+          prediction_cache=cache)
+      dataset.load_data(3)
+      dataset.add_model_prediction_to_data(
+          Model(
+              feature_keys_spec={
+                  'x': utils_tfrecords.EncodingFeatureSpec.INTEGER
+              },
+              prediction_keys=prediction_keys,
+              model_names=['half:v1'],
+              project_name=None,
+              example_key='comment_key'))
+      return list(dataset.show_data()['half:v1'])
+
+    self.assertEqual(add_predictions('score', self._export_dir), [.5, 1., 1.5])
+    # Another output of the same width is not read from the cache.
+    self.assertEqual(
+        add_predictions('double_score', self._export_dir), [2., 4., 6.])
+    self.assertEqual(len(cache), 6)
+    # Nor are the predictions of the model exported to another directory.
+    add_predictions('score', other_export_dir)
+    self.assertEqual(len(cache), 9)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -18,11 +18,15 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import multiprocessing
 import os
-import pandas as pd
 import random
 import re
 
+import numpy as np
+import pandas as pd
+
 import tensorflow as tf
 from tensorflow.python.lib.io import file_io
 from tensorflow.python.platform import tf_logging as logging
@@ -69,10 +73,83 @@ def is_valid_spec(spec):
               EncodingFeatureSpec.CONSTRUCTOR_PER_TYPE.keys()))
 
 
+def shard_path(tf_records_path, shard, num_shards):
+  """Returns the path of one shard, e.g. `path-00001-of-00004`."""
+  return '{}-{:05d}-of-{:05d}'.format(tf_records_path, shard, num_shards)
+
+
+def _serialize_rows(columns,
+                    constructors,
+                    example_key,
+                    start,
+                    deterministic=False):
+  """Yields serialized Examples for rows of column lists.
+
+  Args:
+    columns: List of (feature name, list of values), one entry per feature.
+    constructors: List of feature constructors, aligned with columns.
+    example_key: Name of the example key field, or None.
+    start: Value of the example key for the first row.
+    deterministic: Whether to serialize features in sorted order, so that
+      equal examples always have equal bytes.
+  """
+  names = [name for name, _ in columns]
+  values = [column for _, column in columns]
+  for i, row in enumerate(zip(*values)):
+    feature_dict = {}
+    for name, constructor, value in zip(names, constructors, row):
+      feature_dict[name] = constructor(value)
+    if example_key:
+      feature_dict[example_key] = _int64_feature(start + i)
+    example = tf.train.Example(features=tf.train.Features(feature=feature_dict))
+    if deterministic:
+      yield example.SerializeToString(deterministic=True)
+    else:
+      yield example.SerializeToString()
+
+
+def _write_records(args):
+  """Writes one shard of rows to `path`. Runs in a worker process."""
+  path, columns, feature_types, example_key, start = args
+  constructors = [
+      EncodingFeatureSpec.CONSTRUCTOR_PER_TYPE[feature_type]
+      for feature_type in feature_types
+  ]
+  writer = tf.python_io.TFRecordWriter(path)
+  n_rows = 0
+  for serialized in _serialize_rows(columns, constructors, example_key, start):
+    if not n_rows % 10000:
+      logging.info('Writing {}: {} rows.'.format(path, n_rows))
+    writer.write(serialized)
+    n_rows += 1
+  writer.close()
+  return n_rows
+
+
+def serialize_pandas_to_examples(df, feature_keys_spec):
+  """Returns the serialized tf.Examples of the rows of df, without example key.
+
+  Features are serialized in sorted order, so the bytes only depend on the
+  content of a row. They identify rows across datasets (see
+  `PredictionCache`).
+  """
+  is_valid_spec(feature_keys_spec)
+  features = list(feature_keys_spec)
+  columns = [(feature, df[feature].tolist()) for feature in features]
+  constructors = [
+      EncodingFeatureSpec.CONSTRUCTOR_PER_TYPE[feature_keys_spec[feature]]
+      for feature in features
+  ]
+  return list(
+      _serialize_rows(columns, constructors, None, 0, deterministic=True))
+
+
 def encode_pandas_to_tfrecords(df,
                                feature_keys_spec,
                                tf_records_path,
-                               example_key=None):
+                               example_key=None,
+                               num_shards=None,
+                               num_processes=None):
   """Write a pandas `DataFrame` to a tf_record.
 
   Args:
@@ -84,6 +161,15 @@ def encode_pandas_to_tfrecords(df,
     example_key: key identifier of an example (string). This key will be added
       to data automatically and should not be part of df. If none, no
       example_key will be created.
+    num_shards (optional): If given, rows are split in contiguous blocks
+      written to `num_shards` files named by `shard_path` instead of a single
+      file at tf_records_path. Example keys are the row positions in df, as
+      for a single file.
+    num_processes (optional): Number of worker processes writing shards.
+      Defaults to num_shards.
+
+  Returns:
+    The list of written files.
 
   Raises:
     ValueError if feature_keys_spec does not follow a FeatureSpec format.
@@ -94,26 +180,77 @@ def encode_pandas_to_tfrecords(df,
 
   is_valid_spec(feature_keys_spec)
 
-  writer = tf.python_io.TFRecordWriter(tf_records_path)
-  for i in range(len(df)):
-
-    if not i % 10000:
-      logging.info('Preparing train data: {}/{}'.format(i, len(df)))
-
-    # Create a feature
-    feature_dict = {}
-    for feature in feature_keys_spec:
-      constructor = EncodingFeatureSpec.CONSTRUCTOR_PER_TYPE[
-          feature_keys_spec[feature]]
-      feature_dict[feature] = constructor(df[feature].iloc[i])
-      if example_key:
-        feature_dict[example_key] = _int64_feature(i)
-    example = tf.train.Example(features=tf.train.Features(feature=feature_dict))
-
-    # Serialize to string and write on the file
-    writer.write(example.SerializeToString())
+  # Columns are pulled once: positional access per row and feature dominates
+  # the runtime on large DataFrames.
+  features = list(feature_keys_spec)
+  feature_types = [feature_keys_spec[feature] for feature in features]
+  columns = [df[feature].tolist() for feature in features]
+
+  if not num_shards:
+    _write_records((tf_records_path, list(zip(features, columns)),
+                    feature_types, example_key, 0))
+    return [tf_records_path]
+
+  bounds = [len(df) * shard // num_shards for shard in range(num_shards + 1)]
+  tasks = []
+  for shard in range(num_shards):
+    start, end = bounds[shard], bounds[shard + 1]
+    shard_columns = [(feature, column[start:end])
+                     for feature, column in zip(features, columns)]
+    tasks.append((shard_path(tf_records_path, shard, num_shards),
+                  shard_columns, feature_types, example_key, start))
+
+  pool = multiprocessing.Pool(min(num_processes or num_shards, num_shards))
+  try:
+    pool.map(_write_records, tasks)
+  finally:
+    pool.close()
+    pool.join()
+  return [task[0] for task in tasks]
+
+
+def _feature_decoder(name, feature_spec):
+  """Returns a function extracting one FixedLenFeature from a tf.train.Example.
+
+  The function returns python values for scalar features and numpy arrays of
+  the feature shape otherwise. Also returns the numpy dtype of the decoded
+  column, or None if it should be kept as objects.
+  """
+  if not isinstance(feature_spec, tf.FixedLenFeature):
+    raise ValueError(
+        'Feature {} should be a FixedLenFeature.'.format(name))
+  if feature_spec.dtype == tf.string:
+    kind, np_dtype = 'bytes_list', np.object_
+  elif feature_spec.dtype == tf.int64:
+    kind, np_dtype = 'int64_list', np.int64
+  elif feature_spec.dtype == tf.float32:
+    kind, np_dtype = 'float_list', np.float32
+  else:
+    raise ValueError('Feature {} has an unsupported dtype {}.'.format(
+        name, feature_spec.dtype))
+  shape = list(feature_spec.shape)
+  size = int(np.prod(shape)) if shape else 1
+  default_value = feature_spec.default_value
+
+  def _decode(example):
+    features = example.features.feature
+    if name in features:
+      values = getattr(features[name], kind).value
+      if len(values) != size:
+        raise ValueError('Feature {} should have {} values, got {}.'.format(
+            name, size, len(values)))
+      if not shape:
+        return values[0]
+    elif default_value is None:
+      raise ValueError('Feature {} is missing and has no default.'.format(name))
+    else:
+      values = default_value
+      if not shape:
+        return values
+    return np.array(list(values), dtype=np_dtype).reshape(shape)
 
-  writer.close()
+  column_dtype = np_dtype if not shape and np_dtype != np.object_ else None
+  return _decode, column_dtype
 
 
 def decode_tf_records_to_pandas(decoding_features_spec,
@@ -123,10 +260,14 @@ def decode_tf_records_to_pandas(decoding_features_spec,
                                 filter_fn=None):
   """Loads tf-records into a pandas dataframe.
 
+  Records are parsed directly from the files, without building a graph or a
+  session, so the function can be called repeatedly in one process.
+
   Args:
     decoding_features_spec: A dict mapping feature keys to FixedLenFeature
       values. Spec of the tf-records.
-    tf_records_path: path to the file
+    tf_records_path: path to the file. Can be a glob pattern; matching files
+      are read in sorted order.
     max_n_examples: Maximum number of examples to extract.
     random_filter_keep_rate: Probability for each line to be kept in training
       data. For each line, we generate a random number x and keep it if x <
@@ -136,49 +277,49 @@ def decode_tf_records_to_pandas(decoding_features_spec,
 
   Returns:
     A pandas `DataFrame`.
+
+  Raises:
+    ValueError: if no file matches tf_records_path, or a record does not
+      match decoding_features_spec.
   """
 
   if not max_n_examples:
     max_n_examples = float('inf')
 
-  reader = tf.TFRecordReader()
-  filenames = tf.train.match_filenames_once(tf_records_path)
-  filename_queue = tf.train.string_input_producer(filenames,
-                                                  num_epochs=1)
+  filenames = sorted(tf.gfile.Glob(tf_records_path))
+  if not filenames:
+    raise ValueError('No tf-records match {}.'.format(tf_records_path))
 
-  _, serialized_example = reader.read(filename_queue)
-  read_data = tf.parse_single_example(
-      serialized=serialized_example, features=decoding_features_spec)
+  names = sorted(decoding_features_spec)
+  decoders, column_dtypes = zip(*[
+      _feature_decoder(name, decoding_features_spec[name]) for name in names
+  ])
+  columns = [[] for _ in names]
 
-  sess = tf.InteractiveSession()
-  sess.run(tf.global_variables_initializer())
-  sess.run(tf.local_variables_initializer())
-  sess.run(tf.tables_initializer())
-  tf.train.start_queue_runners(sess)
-
-  d = []
-  new_line = sess.run(read_data)
   count = 0
-  while new_line:
-    if filter_fn:
-      keep_line = filter_fn(new_line)
-    else:
-      keep_line = True
-    keep_line = keep_line and (random.random() < random_filter_keep_rate)
-
-    if keep_line:
-      d.append(new_line)
+  for filename in filenames:
+    for serialized in tf.python_io.tf_record_iterator(filename):
+      example = tf.train.Example.FromString(serialized)
+      row = [decode(example) for decode in decoders]
+      if filter_fn:
+        keep_line = filter_fn(dict(zip(names, row)))
+      else:
+        keep_line = True
+      keep_line = keep_line and (random.random() < random_filter_keep_rate)
+      if not keep_line:
+        continue
+
+      for column, value in zip(columns, row):
+        column.append(value)
       count += 1
       if count >= max_n_examples:
         break
       if not (count % 100000):
         logging.info('Loaded {} lines.'.format(count))
-
-    try:
-      new_line = sess.run(read_data)
-    except tf.errors.OutOfRangeError:
-      logging.info('End of file.')
+    if count >= max_n_examples:
       break
 
-  res = pd.DataFrame(d)
-  return res
+  data = collections.OrderedDict()
+  for name, column, dtype in zip(names, columns, column_dtypes):
+    data[name] = np.array(column, dtype=dtype) if dtype else column
+  return pd.DataFrame(data, columns=names)
@@ -57,6 +57,97 @@ class TestEncodingAndDecoding(unittest.TestCase):
       self.fail('Dataset raised an exception unexpectedly!')
 
 
+class TestShardedEncoding(unittest.TestCase):
+  """Test that sharded tf-records hold the same examples as a single file."""
+
+  def testShardsMatchSingleFile(self):
+    input_df = pd.DataFrame({
+        'x': list(range(7)),
+        'y': [str(i).encode() for i in range(7)],
+    })
+    encoding_feature_spec = {
+        'x': utils_tfrecords.EncodingFeatureSpec.INTEGER,
+        'y': utils_tfrecords.EncodingFeatureSpec.STRING,
+    }
+    tf_records_path = 'unittest_sharded.tf_records'
+    utils_tfrecords.encode_pandas_to_tfrecords(
+        input_df, encoding_feature_spec, tf_records_path, 'example_key')
+    paths = utils_tfrecords.encode_pandas_to_tfrecords(
+        input_df,
+        encoding_feature_spec,
+        tf_records_path,
+        'example_key',
+        num_shards=3)
+
+    self.assertEqual(paths, [
+        'unittest_sharded.tf_records-00000-of-00003',
+        'unittest_sharded.tf_records-00001-of-00003',
+        'unittest_sharded.tf_records-00002-of-00003',
+    ])
+    single = list(tf.python_io.tf_record_iterator(tf_records_path))
+    sharded = [
+        record for path in paths
+        for record in tf.python_io.tf_record_iterator(path)
+    ]
+    self.assertEqual(len(single), 7)
+    self.assertEqual(single, sharded)
+
+    keys = [
+        tf.train.Example.FromString(record)
+        .features.feature['example_key'].int64_list.value[0]
+        for record in sharded
+    ]
+    self.assertEqual(keys, list(range(7)))
+
+
+class TestDecoding(unittest.TestCase):
+  """Test the decoding options of decode_tf_records_to_pandas."""
+
+  def setUp(self):
+    input_df = pd.DataFrame({'x': list(range(10))})
+    encoding_feature_spec = {'x': utils_tfrecords.EncodingFeatureSpec.INTEGER}
+    self.tf_records_path = 'unittest_decoding.tf_records'
+    utils_tfrecords.encode_pandas_to_tfrecords(
+        input_df, encoding_feature_spec, self.tf_records_path, num_shards=2)
+
+  def testGlobFilterAndMaxExamples(self):
+    decoding_spec = {
+        'x': tf.FixedLenFeature([], dtype=tf.int64),
+        'y': tf.FixedLenFeature([], dtype=tf.float32, default_value=-1.),
+    }
+    seen = []
+
+    def filter_fn(example):
+      seen.append(example)
+      return example['x'] % 2 == 0
+
+    output_df = utils_tfrecords.decode_tf_records_to_pandas(
+        decoding_spec,
+        self.tf_records_path + '-*',
+        max_n_examples=4,
+        filter_fn=filter_fn)
+
+    self.assertEqual(list(output_df['x']), [0, 2, 4, 6])
+    self.assertEqual(list(output_df['y']), [-1.] * 4)
+    self.assertEqual(len(seen), 7)
+    self.assertEqual(seen[0], {'x': 0, 'y': -1.})
+
+  def testCalledTwice(self):
+    decoding_spec = {'x': tf.FixedLenFeature([], dtype=tf.int64)}
+    path = self.tf_records_path + '-*'
+    first = utils_tfrecords.decode_tf_records_to_pandas(decoding_spec, path)
+    second = utils_tfrecords.decode_tf_records_to_pandas(decoding_spec, path)
+    self.assertEqual(list(first['x']), list(range(10)))
+    pd.testing.assert_frame_equal(first, second)
+
+  def testMissingFeature(self):
+    decoding_spec = {'y': tf.FixedLenFeature([], dtype=tf.float32)}
+    with self.assertRaises(ValueError) as context:
+      utils_tfrecords.decode_tf_records_to_pandas(
+          decoding_spec, self.tf_records_path + '-*')
+    self.assertIn('Feature y is missing', str(context.exception))
+
+
 class TestFeatureKeySpec(unittest.TestCase):
   """Verifies the format of Feature Spec"""
 